@@ -0,0 +1,454 @@
+"""
+Benchmark of the FAAS service in the local, pull and push modes
+
+Structure:
+1. Starts the web service, a dispatcher in the given mode and N workers on localhost (or uses a stack already running)
+2. Submits tasks open-loop: they arrive at the target rate whatever the latency, so a saturated service shows up as a
+   growing latency rather than as a lower submission rate. The functions are picked at random from a weighted mix
+3. Records the throughput and the latency percentiles of every run, with the commit it ran on, to JSON and CSV. Runs
+   are appended to the files, so they can be compared across commits
+
+Sweeps:
+- strong: the same rate for every number of workers
+- weak: a rate proportional to the number of workers (-rate is then the rate per worker)
+
+Example:
+$ python benchmark.py -mode push -sweep strong -workers 1,2,4 -rate 20 -duration 30 -mix no_op=1,fibonacci=1,sleep=1
+"""
+import argparse
+import csv
+import hashlib
+import json
+import os
+import random
+import signal
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+import requests
+
+from test.serialize import serialize
+from test.utils import no_op, calculate_fibonacci, sleep_for, bruteforce_password
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+TERMINAL = ('COMPLETED', 'FAILED')
+
+CSV_FIELDS = [
+    'commit', 'timestamp', 'store', 'mode', 'sweep', 'workers', 'processes', 'rate', 'duration', 'mix', 'workload',
+    'submitted', 'completed', 'failed', 'timed_out', 'rejected', 'throughput', 'p50', 'p90', 'p99', 'mean', 'max',
+    'max_lag'
+]
+
+
+class Workload:
+    """
+    A function of the benchmark and the arguments it is called with
+    """
+
+    def __init__(self, name: str, function: Callable, arguments: Callable[[random.Random], tuple]):
+        self.name = name
+        self.function = function
+        self.arguments = arguments
+
+    def payload(self, generator: random.Random) -> str:
+        return serialize((self.arguments(generator), {}))
+
+
+def create_workloads(options) -> Dict[str, Workload]:
+    def bruteforce_arguments(generator: random.Random):
+        pin = generator.randrange(options.bruteforce)
+        return hashlib.md5(f'{pin}'.encode()).hexdigest(), 0, options.bruteforce
+
+    workloads = [
+        Workload('no_op', no_op, lambda generator: ()),
+        Workload('fibonacci', calculate_fibonacci, lambda generator: (options.fibonacci, )),
+        Workload('sleep', sleep_for, lambda generator: (options.sleep, )),
+        Workload('bruteforce', bruteforce_password, bruteforce_arguments)
+    ]
+    return {workload.name: workload for workload in workloads}
+
+
+def parse_mix(value: str) -> Dict[str, float]:
+    """
+    :param value: Comma separated workloads with their weight, e.g. no_op=1,sleep=2. The weight defaults to 1
+    :return: Weight per workload
+    """
+    mix = {}
+    for item in value.split(','):
+        name, _, weight = item.partition('=')
+        mix[name.strip()] = float(weight or 1)
+
+    return mix
+
+
+class Cluster:
+    """
+    The web service, a dispatcher and its workers. Every component runs in its own process group, so the pool processes
+    are stopped along with it
+    """
+
+    STARTUP_TIMEOUT = 30  # (in seconds)
+    REGISTRATION_TIME = 2  # (in seconds)
+    STOP_TIMEOUT = 5  # (in seconds)
+
+    def __init__(self, mode: str, workers: int, processes: int, api_port: int, dispatcher_port: int,
+                 logs: Optional[str] = None, store: str = 'redis'):
+        self.mode = mode
+        self.workers = workers
+        self.processes = processes
+        self.api_port = api_port
+        self.dispatcher_port = dispatcher_port
+        self.logs = logs
+        self.store = store
+
+        self.children = []
+        self.environment = {}
+        self.directory = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.api_port}'
+
+    def spawn(self, name: str, arguments: List[str]):
+        log = open(os.path.join(self.logs, f'{name}.log'), 'w') if self.logs else subprocess.DEVNULL
+        child = subprocess.Popen(
+            [sys.executable] + arguments, cwd=ROOT, stdout=log, stderr=subprocess.STDOUT, start_new_session=True,
+            env={**os.environ, **self.environment}
+        )
+        self.children.append(child)
+
+    def start(self):
+        if self.logs:
+            os.makedirs(self.logs, exist_ok=True)
+
+        # Every run gets a fresh file, so runs do not see each other's tasks
+        self.environment = {'FAAS_STORE': self.store}
+        if self.store == 'sqlite':
+            self.directory = tempfile.mkdtemp(prefix='faas-benchmark-')
+            self.environment['FAAS_SQLITE_PATH'] = os.path.join(self.directory, 'faas.db')
+
+        # In local mode the workers are the processes of the dispatcher's pool
+        workers = self.workers * self.processes if self.mode == 'local' else self.workers
+
+        # With the memory store the dispatcher runs inside the web service, the only process that can reach the store
+        if self.store == 'memory':
+            self.environment['FAAS_EMBEDDED_WORKERS'] = str(workers)
+
+        self.spawn('api', ['-m', 'uvicorn', 'main:app', '--port', str(self.api_port)])
+
+        if self.store != 'memory':
+            self.spawn('dispatcher', [
+                'task_dispatcher.py', '-mode', self.mode, '-port', str(self.dispatcher_port), '-workers', str(workers)
+            ])
+
+        if self.mode != 'local':
+            master = f'tcp://127.0.0.1:{self.dispatcher_port}'
+            for index in range(self.workers):
+                self.spawn(f'worker-{index}', [f'{self.mode}_worker.py', str(self.processes), master])
+
+        self.wait_until_ready()
+
+    def wait_until_ready(self):
+        deadline = time.monotonic() + self.STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            try:
+                if requests.get(f'{self.url}/metrics', timeout=1).status_code == 200:
+                    break
+            except requests.ConnectionError:
+                pass
+            time.sleep(0.2)
+        else:
+            self.stop()
+            raise RuntimeError(f'The web service did not start within {self.STARTUP_TIMEOUT}s')
+
+        # Workers register with the dispatcher on their own, there is nothing to poll
+        time.sleep(self.REGISTRATION_TIME)
+
+    def stop(self):
+        for child in self.children:
+            try:
+                os.killpg(child.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+        for child in self.children:
+            try:
+                child.wait(self.STOP_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                os.killpg(child.pid, signal.SIGKILL)
+                child.wait()
+
+        self.children = []
+
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+class LoadGenerator:
+    """
+    Open-loop load: tasks are submitted at their scheduled arrival time from a thread pool, and latencies are measured
+    from that scheduled time. A client that falls behind its schedule would otherwise hide the queueing it causes
+    """
+
+    LONG_POLL = 30  # (in seconds)
+
+    def __init__(self, url: str, workloads: Dict[str, Workload], mix: Dict[str, float], rate: float, duration: float,
+                 poisson: bool = True, timeout: float = 60, concurrency: int = 512, seed: int = 0):
+        self.url = url
+        self.workloads = workloads
+        self.mix = mix
+        self.rate = rate
+        self.duration = duration
+        self.poisson = poisson
+        self.timeout = timeout
+        self.concurrency = concurrency
+
+        # Arrivals, mix and payloads are all drawn on the main thread from this generator, so a seed gives the same run
+        self.random = random.Random(seed)
+        self.function_ids = {}
+
+    def register(self):
+        for name in self.mix:
+            workload = self.workloads[name]
+            data = {'name': f'benchmark-{name}', 'payload': serialize(workload.function)}
+            response = requests.post(f'{self.url}/register_function', json=data)
+
+            assert response.status_code == 201
+            self.function_ids[name] = response.json()['function_id']
+
+    def warm_up(self):
+        # Every function is executed once before the measurement, so no worker measures its first deserialization
+        for name in self.mix:
+            sample = self.call(name, self.workloads[name].payload(self.random), time.monotonic(), time.monotonic())
+            if sample['status'] not in TERMINAL:
+                raise RuntimeError(f'Warm-up of {name} did not complete: {sample["status"]}')
+
+    def interarrival(self) -> float:
+        return self.random.expovariate(self.rate) if self.poisson else 1 / self.rate
+
+    def run(self) -> List[dict]:
+        names, weights = list(self.mix), list(self.mix.values())
+
+        futures = []
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            start = time.monotonic()
+            arrival = 0.0
+            while arrival < self.duration:
+                delay = start + arrival - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+                name = self.random.choices(names, weights)[0]
+                payload = self.workloads[name].payload(self.random)
+                futures.append(executor.submit(self.call, name, payload, start + arrival, start))
+                arrival += self.interarrival()
+
+            return [future.result() for future in futures]
+
+    def call(self, name: str, payload: str, scheduled: float, start: float) -> dict:
+        sample = {'workload': name, 'scheduled': scheduled - start, 'lag': time.monotonic() - scheduled}
+
+        data = {'function_id': self.function_ids[name], 'payload': payload}
+        response = requests.post(f'{self.url}/execute_function', json=data)
+        if response.status_code != 201:
+            sample['status'] = 'REJECTED'
+            return sample
+
+        task_id = response.json()['task_id']
+        deadline = scheduled + self.timeout
+        while time.monotonic() < deadline:
+            wait = min(self.LONG_POLL, max(deadline - time.monotonic(), 0.1))
+            record = requests.get(f'{self.url}/result/{task_id}', params={'wait': wait}).json()
+
+            if record['status'] in TERMINAL:
+                now = time.monotonic()
+                sample.update(status=record['status'], latency=now - scheduled, finished=now - start)
+                return sample
+
+        sample['status'] = 'TIMED_OUT'
+        return sample
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    # Nearest rank
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, round(q * len(values)) - 1))]
+
+
+def summarize(samples: List[dict]) -> dict:
+    terminated = [sample for sample in samples if sample['status'] in TERMINAL]
+    latencies = sorted(sample['latency'] for sample in terminated)
+
+    # Throughput over the time from the first arrival to the last completion
+    makespan = max((sample['finished'] for sample in terminated), default=0)
+
+    def count(status):
+        return sum(1 for sample in samples if sample['status'] == status)
+
+    return {
+        'submitted': len(samples),
+        'completed': count('COMPLETED'),
+        'failed': count('FAILED'),
+        'timed_out': count('TIMED_OUT'),
+        'rejected': count('REJECTED'),
+        'throughput': len(terminated) / makespan if makespan else 0.0,
+        'p50': percentile(latencies, 0.5),
+        'p90': percentile(latencies, 0.9),
+        'p99': percentile(latencies, 0.99),
+        'mean': sum(latencies) / len(latencies) if latencies else None,
+        'max': latencies[-1] if latencies else None,
+        'max_lag': max((sample['lag'] for sample in samples), default=0)
+    }
+
+
+def current_commit() -> Optional[str]:
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+        dirty = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT, text=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    return f'{commit}-dirty' if dirty.strip() else commit
+
+
+def save(runs: List[dict], output: str):
+    """
+    Appends the runs to <output>.json and, one row per workload and one for the whole mix, to <output>.csv
+    :param runs: Results of the runs
+    :param output: Path of the files, without the extension
+    :return:
+    """
+    directory = os.path.dirname(output)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    previous = []
+    if os.path.exists(f'{output}.json'):
+        with open(f'{output}.json') as file:
+            previous = json.load(file)
+
+    with open(f'{output}.json', 'w') as file:
+        json.dump(previous + runs, file, indent=2)
+
+    new_file = not os.path.exists(f'{output}.csv')
+    with open(f'{output}.csv', 'a', newline='') as file:
+        writer = csv.DictWriter(file, CSV_FIELDS, extrasaction='ignore')
+        if new_file:
+            writer.writeheader()
+
+        for run in runs:
+            for workload, summary in [('all', run['summary'])] + list(run['workloads'].items()):
+                writer.writerow({**run, **summary, 'workload': workload})
+
+
+def benchmark(options, workers: int, rate: float) -> dict:
+    workloads = create_workloads(options)
+    mix = parse_mix(options.mix)
+
+    cluster = Cluster(
+        options.mode, workers, options.processes, options.api_port, options.port, options.logs, options.store
+    )
+    url = f'http://127.0.0.1:{options.api_port}'
+
+    if not options.no_spawn:
+        cluster.start()
+
+    try:
+        generator = LoadGenerator(url, workloads, mix, rate, options.duration, options.arrivals == 'poisson',
+                                  options.timeout, options.concurrency, options.seed)
+        generator.register()
+        generator.warm_up()
+        samples = generator.run()
+    finally:
+        cluster.stop()
+
+    run = {
+        'commit': current_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'store': options.store,
+        'mode': options.mode,
+        'sweep': options.sweep,
+        'workers': workers,
+        'processes': options.processes,
+        'rate': rate,
+        'duration': options.duration,
+        'mix': options.mix,
+        'summary': summarize(samples),
+        'workloads': {
+            name: summarize([sample for sample in samples if sample['workload'] == name]) for name in mix
+        }
+    }
+
+    summary = run['summary']
+    print(f'{options.mode} workers={workers} rate={rate:g}/s: {summary["completed"]}/{summary["submitted"]} completed, '
+          f'throughput={summary["throughput"]:.2f}/s p50={summary["p50"]} p99={summary["p99"]}')
+    return run
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the FAAS service')
+    parser.add_argument('-mode', type=str, default='local', choices=['local', 'pull', 'push'],
+                        help='Mode of the dispatcher')
+    parser.add_argument('-workers', type=str, default='1',
+                        help='Comma separated numbers of workers, one run each (processes of the pool in LOCAL mode)')
+    parser.add_argument('-processes', type=int, default=1, help='Processes of every worker')
+    parser.add_argument('-sweep', type=str, default='strong', choices=['strong', 'weak'],
+                        help='strong: the same rate for every number of workers, weak: -rate per worker')
+    parser.add_argument('-rate', type=float, default=10, help='Tasks submitted per second')
+    parser.add_argument('-duration', type=float, default=30, help='Seconds during which tasks are submitted')
+    parser.add_argument('-arrivals', type=str, default='poisson', choices=['poisson', 'uniform'],
+                        help='Distribution of the time between two submissions')
+    parser.add_argument('-mix', type=str, default='no_op=1,fibonacci=1,sleep=1,bruteforce=1',
+                        help='Workloads with their weight, among no_op, fibonacci, sleep and bruteforce')
+    parser.add_argument('-fibonacci', type=int, default=20, help='Number computed by the fibonacci workload')
+    parser.add_argument('-sleep', type=float, default=1, help='Seconds slept by the sleep workload')
+    parser.add_argument('-bruteforce', type=int, default=10000,
+                        help='Range of pins searched by the bruteforce workload')
+    parser.add_argument('-timeout', type=float, default=60, help='Seconds after which a task counts as timed out')
+    parser.add_argument('-concurrency', type=int, default=512, help='Tasks the client waits for at once')
+    parser.add_argument('-seed', type=int, default=0, help='Seed of the arrivals, the mix and the payloads')
+    parser.add_argument('-api-port', type=int, default=8000, help='Port of the web service')
+    parser.add_argument('-port', type=int, default=5555, help='Port of the dispatcher (PULL and PUSH mode)')
+    parser.add_argument('-store', type=str, default='redis', choices=['redis', 'memory', 'sqlite'],
+                        help='Store of the spawned processes. The memory store runs the dispatcher in the web service '
+                             '(LOCAL mode only), the SQLite store uses a new file for every run')
+    parser.add_argument('-no-spawn', action='store_true', help='Benchmarks the stack already running')
+    parser.add_argument('-logs', type=str, default=None, help='Directory for the logs of the spawned processes')
+    parser.add_argument('-output', type=str, default='benchmark_results',
+                        help='Path of the JSON and CSV files the runs are appended to, without the extension')
+    options = parser.parse_args()
+
+    unknown = set(parse_mix(options.mix)) - set(create_workloads(options))
+    if unknown:
+        parser.error(f'Unknown workloads: {", ".join(sorted(unknown))}')
+
+    sweep = [int(workers) for workers in options.workers.split(',')]
+    if options.no_spawn and len(sweep) > 1:
+        parser.error('A stack already running cannot be swept over numbers of workers')
+    if options.store == 'memory' and options.mode != 'local':
+        parser.error('The memory store only runs in LOCAL mode')
+
+    runs = []
+    for workers in sweep:
+        rate = options.rate * workers if options.sweep == 'weak' else options.rate
+        runs.append(benchmark(options, workers, rate))
+
+    save(runs, options.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+import math
+from typing import Callable, List, Optional, Tuple
+
+from utils import deserialize, serialize
+
+# A map job is split into chunks that each run as one task. A chunk either calls the function once per item, on a list
+# of argument payloads, or calls it once on a sub-range, with the bounds of the sub-range appended to the arguments (as
+# bruteforce_password takes them)
+ITEMS = 'items'
+RANGE = 'range'
+
+# Chunks per worker process, so that a slow chunk can be balanced by the others
+CHUNKS_PER_PROCESS = 4
+
+# A chunk should take at least this long, or dispatching it costs more than running it
+MIN_CHUNK_TIME = 0.05  # (in seconds)
+
+
+def chunk_size(units: int, processes: int, unit_cost: Optional[float] = None) -> int:
+    """
+    :param units: Items, or length of the range
+    :param processes: Worker processes available, 1 if unknown
+    :param unit_cost: Measured time per item (in seconds), None if the function has not been mapped yet
+    :return: Number of units per chunk
+    """
+    size = math.ceil(units / (max(processes, 1) * CHUNKS_PER_PROCESS))
+
+    if unit_cost:
+        size = max(size, math.ceil(MIN_CHUNK_TIME / unit_cost))
+
+    return max(1, min(size, units))
+
+
+def item_chunks(payloads: List[str], size: int) -> List[str]:
+    return [serialize({ITEMS: payloads[start:start + size]}) for start in range(0, len(payloads), size)]
+
+
+def range_chunks(payload: str, start: int, stop: int, size: int) -> List[str]:
+    return [serialize({RANGE: (payload, low, min(low + size, stop))}) for low in range(start, stop, size)]
+
+
+def run_chunk(function: Callable, chunk: dict, first_result: bool = False) -> Tuple[object, int, bool]:
+    """
+    Runs the function over a chunk
+    :param function: Function of the job
+    :param chunk: Deserialized chunk payload
+    :param first_result: Stops at the first result that is not None
+    :return: The result (a list of results for items), the number of units run, and whether a result was found
+    """
+    if RANGE in chunk:
+        payload, low, high = chunk[RANGE]
+        args, kwargs = deserialize(payload)
+
+        result = function(*args, low, high, **kwargs)
+        return result, high - low, result is not None
+
+    results = []
+    for payload in chunk[ITEMS]:
+        args, kwargs = deserialize(payload)
+        results.append(function(*args, **kwargs))
+
+        if first_result and results[-1] is not None:
+            break
+
+    return results, len(results), any(result is not None for result in results)
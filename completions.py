@@ -0,0 +1,61 @@
+import asyncio
+from collections import defaultdict
+from typing import Callable, Iterable
+
+from task import async_redis_queue
+
+
+class CompletionListener:
+    """
+    Holds the single subscription of a web service process to the completion channel and fans the task ids out to
+    the requests waiting on them
+    """
+
+    RECONNECT_DELAY = 1  # (in seconds)
+
+    def __init__(self):
+        self.waiters = defaultdict(set)
+        self.callbacks = []
+        self.listener = None
+
+    def start(self):
+        self.listener = asyncio.create_task(self.listen())
+
+    async def stop(self):
+        if self.listener is not None:
+            self.listener.cancel()
+
+    async def listen(self):
+        while True:
+            try:
+                async for task_id in async_redis_queue.completions():
+                    for queue in self.waiters.get(task_id, ()):
+                        queue.put_nowait(task_id)
+                    for callback in self.callbacks:
+                        callback(task_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                print(f'Completion listener disconnected: {exc}')
+                await asyncio.sleep(self.RECONNECT_DELAY)
+
+    def add_callback(self, callback: Callable[[str], None]):
+        # Called with every completed task id, it must not block the listener
+        self.callbacks.append(callback)
+
+    def subscribe(self, task_ids: Iterable[str], queue: asyncio.Queue):
+        for task_id in task_ids:
+            self.waiters[task_id].add(queue)
+
+    def unsubscribe(self, task_ids: Iterable[str], queue: asyncio.Queue):
+        for task_id in task_ids:
+            waiters = self.waiters.get(task_id)
+            if waiters is None:
+                continue
+
+            waiters.discard(queue)
+            if not waiters:
+                del self.waiters[task_id]
+
+
+completion_listener = CompletionListener()
@@ -0,0 +1,148 @@
+import os
+import threading
+import time
+from multiprocessing import Pool
+from typing import Optional
+
+
+class ElasticPool:
+    """
+    Process pool whose size can change while it runs. Every process is a single-process Pool, so a process can be
+    retired on its own: a busy one is closed once its task has finished. Tasks go to the least busy process
+    """
+
+    def __init__(self, min_processes: int, max_processes: int = None):
+        self.min_processes = min_processes
+        self.max_processes = max(max_processes or min_processes, min_processes)
+
+        # Pool callbacks run in the result thread of each process, the counters are shared with them
+        self.lock = threading.Lock()
+        self.processes = []
+        self.busy = {}
+        self.retiring = set()
+
+        self.resize(min_processes)
+
+    @property
+    def size(self) -> int:
+        return len(self.processes)
+
+    @property
+    def running(self) -> int:
+        with self.lock:
+            return sum(self.busy.values())
+
+    def apply_async(self, func, callback):
+        with self.lock:
+            process = min(self.processes, key=self.busy.get)
+            self.busy[process] += 1
+
+        def done(result):
+            self.release(process)
+            callback(result)
+
+        process.apply_async(func, callback=done)
+
+    def release(self, process):
+        with self.lock:
+            self.busy[process] -= 1
+            if process in self.retiring and not self.busy[process]:
+                self.retire(process)
+
+    def resize(self, size: int) -> int:
+        """
+        Starts or retires processes, idle ones first
+        :param size: Number of processes wanted, bounded by the minimum and maximum of the pool
+        :return: The new size
+        """
+        size = min(max(size, self.min_processes), self.max_processes)
+
+        with self.lock:
+            while len(self.processes) < size:
+                process = Pool(processes=1)
+                self.processes.append(process)
+                self.busy[process] = 0
+
+            while len(self.processes) > size:
+                process = min(self.processes, key=self.busy.get)
+                self.processes.remove(process)
+
+                if self.busy[process]:
+                    self.retiring.add(process)
+                else:
+                    self.retire(process)
+
+        return self.size
+
+    def retire(self, process):
+        self.retiring.discard(process)
+        del self.busy[process]
+
+        process.close()
+        threading.Thread(target=process.join, daemon=True).start()
+
+
+class Autoscaler:
+    """
+    Decides the size of an ElasticPool from the tasks waiting for it, how long they have waited, and the load of the
+    machine. The pool grows when every process is busy and tasks have waited for a while, and shrinks when at most half
+    of the processes have been busy for much longer, so it does not flap around a steady load
+    """
+
+    INTERVAL = 1  # (in seconds)
+    SCALE_UP_AFTER = 2  # (in seconds)
+    SCALE_DOWN_AFTER = 30  # (in seconds)
+    MAX_WAIT = 0.5  # (in seconds)
+
+    # No process is added once the load average per CPU reaches this, more processes would only share the same CPUs
+    CPU_LIMIT = 0.9
+
+    def __init__(self, pool: ElasticPool):
+        self.pool = pool
+        self.last_check = 0
+        self.pressure_since = None
+        self.slack_since = None
+
+    @staticmethod
+    def cpu_utilization() -> float:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+
+    def check(self, queue_depth: int, oldest_wait: Optional[float] = None) -> Optional[int]:
+        """
+        :param queue_depth: Tasks waiting for a process
+        :param oldest_wait: How long the oldest of them has waited (in seconds), None if unknown
+        :return: The size the pool should have, or None to keep it
+        """
+        now = time.monotonic()
+        if now - self.last_check < self.INTERVAL:
+            return None
+        self.last_check = now
+
+        size, running = self.pool.size, self.pool.running
+        waited = oldest_wait is None or oldest_wait >= self.MAX_WAIT
+
+        pressure = queue_depth > 0 and running >= size and waited and size < self.pool.max_processes
+        slack = queue_depth == 0 and running <= size // 2 and size > self.pool.min_processes
+
+        if pressure and self.cpu_utilization() < self.CPU_LIMIT:
+            self.slack_since = None
+            self.pressure_since = self.pressure_since or now
+
+            if now - self.pressure_since >= self.SCALE_UP_AFTER:
+                self.pressure_since = None
+                # Grows by up to half its size at once, so a large backlog does not take many steps
+                return size + max(1, min(queue_depth, size // 2))
+
+        elif slack:
+            self.pressure_since = None
+            self.slack_since = self.slack_since or now
+
+            if now - self.slack_since >= self.SCALE_DOWN_AFTER:
+                self.slack_since = None
+                return max(size - 1, running)
+
+        else:
+            self.pressure_since = None
+            self.slack_since = None
+
+        return None
@@ -0,0 +1,119 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
+
+from elastic_pool import ElasticPool
+from task import Function, Task
+
+
+class ThreadExecutor:
+    """
+    Threads of this process for functions that block on I/O: tasks are neither pickled nor copied to another process,
+    and many more of them wait at once than there are processes
+    """
+
+    THREADS = 64
+
+    def __init__(self, threads: int = THREADS):
+        self.threads = threads
+        self.pool = ThreadPoolExecutor(threads, thread_name_prefix='task')
+
+        self.lock = threading.Lock()
+        self.busy = 0
+
+    @property
+    def size(self) -> int:
+        return self.threads
+
+    @property
+    def running(self) -> int:
+        with self.lock:
+            return self.busy
+
+    def apply_async(self, func, callback):
+        with self.lock:
+            self.busy += 1
+
+        def done(future):
+            with self.lock:
+                self.busy -= 1
+            callback(future.result())
+
+        self.pool.submit(func).add_done_callback(done)
+
+
+class AsyncExecutor:
+    """
+    Event loop in a thread of its own for coroutine functions. A task only holds the loop until its first await, so
+    the number of tasks running at once is only bounded by the limit given
+    """
+
+    COROUTINES = 256
+
+    def __init__(self, coroutines: int = COROUTINES):
+        self.coroutines = coroutines
+
+        self.lock = threading.Lock()
+        self.busy = 0
+
+        # Started on the first task, processes that only run CPU-bound functions never have it
+        self.loop = None
+
+    @property
+    def size(self) -> int:
+        return self.coroutines
+
+    @property
+    def running(self) -> int:
+        with self.lock:
+            return self.busy
+
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    def apply_async(self, coroutine_function, callback):
+        with self.lock:
+            if self.loop is None:
+                self.start()
+            self.busy += 1
+
+        def done(future):
+            with self.lock:
+                self.busy -= 1
+            callback(future.result())
+
+        asyncio.run_coroutine_threadsafe(coroutine_function(), self.loop).add_done_callback(done)
+
+
+class Executors:
+    """
+    Runs every task on the executor of its execution class: the process pool, the thread pool or the event loop. Each
+    one has its own capacity, a class only waits for its own executor to have room
+    """
+
+    def __init__(self, pool: ElasticPool, threads: int = ThreadExecutor.THREADS,
+                 coroutines: int = AsyncExecutor.COROUTINES):
+        self.pool = pool
+        self.executors = {
+            Function.Executor.PROCESS: pool,
+            Function.Executor.THREAD: ThreadExecutor(threads),
+            Function.Executor.ASYNC: AsyncExecutor(coroutines)
+        }
+
+    def size(self, executor: str) -> int:
+        return self.executors[executor].size
+
+    def running(self, executor: str) -> int:
+        return self.executors[executor].running
+
+    @property
+    def capacity(self) -> Dict[str, int]:
+        return {executor: self.size(executor) for executor in self.executors}
+
+    def apply_async(self, task: Task, callback):
+        if task.executor == Function.Executor.ASYNC:
+            self.executors[task.executor].apply_async(task.execute_async, callback)
+        else:
+            self.executors[task.executor].apply_async(task.execute, callback)
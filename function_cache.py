@@ -0,0 +1,71 @@
+import threading
+from collections import OrderedDict
+
+from utils import deserialize
+
+
+class FunctionCache:
+
+    MAX_SIZE = 128
+
+    def __init__(self, max_size: int = MAX_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, function_hash: str, payload: str = None):
+        """
+        Returns the deserialized function stored under its content hash. On a miss the function is deserialized from
+        the payload (if given) and cached. Since entries are keyed by content, a re-registered function with a new body
+        gets a new key and the stale entry simply ages out
+        :param function_hash: SHA-256 of the serialized function
+        :param payload: Serialized function, used to fill the cache on a miss
+        :return: The function, or None on a miss without a payload
+        """
+        with self.lock:
+            function = self.entries.get(function_hash)
+            if function is not None:
+                self.entries.move_to_end(function_hash)
+                self.hits += 1
+                return function
+
+            self.misses += 1
+
+        if payload is None:
+            return None
+
+        function = deserialize(payload)
+        self.put(function_hash, function)
+        return function
+
+    def put(self, function_hash: str, function):
+        with self.lock:
+            self.entries[function_hash] = function
+            self.entries.move_to_end(function_hash)
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def __contains__(self, function_hash):
+        with self.lock:
+            return function_hash in self.entries
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    @property
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self.entries),
+                'max_size': self.max_size
+            }
+
+
+# Shared by every Task built in this process: the API, the dispatchers and the workers
+function_cache = FunctionCache()
@@ -0,0 +1,35 @@
+import os
+from collections import deque
+
+
+class Inbox:
+    """
+    Thread-safe hand-off to an event loop. Items are kept in a deque and every put writes a byte to a pipe, whose read
+    end can be registered in a zmq.Poller next to the sockets
+    """
+
+    def __init__(self):
+        self.items = deque()
+        self.fd, self.write_fd = os.pipe()
+        os.set_blocking(self.fd, False)
+        os.set_blocking(self.write_fd, False)
+
+    def put(self, item):
+        self.items.append(item)
+        try:
+            os.write(self.write_fd, b'\0')
+        except BlockingIOError:
+            # The pipe is full, so the loop has a wake-up pending anyway
+            pass
+
+    def drain(self) -> list:
+        try:
+            os.read(self.fd, 65536)
+        except BlockingIOError:
+            pass
+
+        items = []
+        while self.items:
+            items.append(self.items.popleft())
+
+        return items
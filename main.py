@@ -1,9 +1,89 @@
-from fastapi import FastAPI
+import asyncio
+import os
+import threading
+import uuid
+from typing import List
 
-from response_classes import RegisterFnRep, RegisterFn, ExecuteFnRep, ExecuteFnReq, TaskResultRep, TaskStatusRep
-from task import Task, Function, redis_queue
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
+
+import chunking
+from completions import completion_listener
+from function_cache import function_cache
+from metrics import Metrics, render
+
+from result_cache import result_cache
+from sharding import ShardRouter
+from store import MEMORY, STORE
+from response_classes import (
+    RegisterFnRep, RegisterFn, DagRep, DagReq, ExecuteFnRep, ExecuteFnReq, ExecuteBatchRep, ExecuteBatchReq, MapRep,
+    MapReq, MapStatusRep, TaskResultRep, TaskStatusRep
+)
+from task import Task, Function, async_redis_queue
+from task_dispatcher import LocalTaskDispatcher
 
 app = FastAPI()
+router = ShardRouter(async_redis_queue)
+
+metrics = Metrics()
+INSTANCE = str(uuid.uuid4())
+
+MAX_WAIT = 60  # (in seconds)
+KEEP_ALIVE_INTERVAL = 15  # (in seconds)
+
+# Processes of a LOCAL dispatcher run by the web service itself, none by default. The memory store cannot be reached by
+# a dispatcher in another process
+EMBEDDED_WORKERS = int(os.environ.get('FAAS_EMBEDDED_WORKERS', os.cpu_count() if STORE == MEMORY else 0))
+
+
+@app.on_event('startup')
+async def start_completion_listener():
+    completion_listener.add_callback(cache_result)
+    completion_listener.start()
+
+
+@app.on_event('startup')
+async def start_embedded_dispatcher():
+    if not EMBEDDED_WORKERS:
+        return
+
+    # Its event loop polls sockets and the store, it gets a thread of its own
+    dispatcher = LocalTaskDispatcher(EMBEDDED_WORKERS)
+    threading.Thread(target=dispatcher.execute, daemon=True).start()
+
+
+@app.on_event('shutdown')
+async def close_redis():
+    await completion_listener.stop()
+    await async_redis_queue.close()
+
+
+@app.middleware('http')
+async def count_requests(request: Request, call_next):
+    response = await call_next(request)
+
+    # Counted by route, not by path, so task ids do not make a series each
+    route = request.scope.get('route')
+    metrics.inc('faas_requests_total', {'endpoint': route.path if route else 'unknown', 'code': response.status_code})
+
+    return response
+
+
+@app.get('/metrics', response_class=PlainTextResponse)
+async def get_metrics():
+    """
+    Metrics of the web service, along with the ones the dispatchers and workers publish to the store, in the Prometheus
+    text format
+    """
+    for name, value in result_cache.stats.items():
+        metrics.set('faas_result_cache', value, {'counter': name})
+    metrics.set('faas_function_cache_hits_total', function_cache.hits)
+    metrics.set('faas_function_cache_misses_total', function_cache.misses)
+
+    snapshots = [({'component': 'api', 'instance': INSTANCE}, metrics.snapshot())]
+    snapshots += await async_redis_queue.read_metrics()
+
+    return PlainTextResponse(render(snapshots), media_type='text/plain; version=0.0.4')
 
 
 @app.post('/register_function', response_model=RegisterFnRep, status_code=201)
@@ -11,8 +91,8 @@ async def register_function(function: RegisterFn):
     name = function.name
     payload = function.payload
 
-    function = Function(name, payload)
-    function.register()
+    function = Function(name, payload, function.cacheable, function.executor)
+    await function.register_async()
 
     return function.db_record
 
@@ -22,20 +102,286 @@ async def execute_function(request: ExecuteFnReq):
     function_id = request.function_id
     payload = request.payload
 
-    task = Task(function_id, payload)
-    task.insert()
-    redis_queue.publish_to_channel(task)
+    task = await Task.create_async(function_id, payload, request.priority)
+    if task.cacheable:
+        return await execute_cacheable(task)
+
+    await submit_tasks([task])
 
     return task.db_record
 
 
+async def submit_tasks(tasks: List[Task], waiting: List[Task] = ()):
+    """
+    Records the tasks and queues them on the stream of their shard
+    :param tasks: Tasks to queue
+    :param waiting: Tasks only recorded, because they are submitted later by a dispatcher (DAG tasks with inputs)
+    :return:
+    """
+    for task in tasks:
+        task.stamp(Task.Event.ENQUEUED)
+        for stage, duration in task.durations('accept').items():
+            metrics.observe('faas_stage_seconds', duration, {'stage': stage})
+
+    # Every record exists before any task can complete and look up the records it depends on
+    await Task.insert_many_async(list(tasks) + list(waiting))
+    for stream, partition in (await router.partition(tasks)).items():
+        await async_redis_queue.enqueue_many(partition, stream)
+
+
+async def execute_cacheable(task: Task):
+    key = result_cache.key(task.function_hash, task.payload)
+
+    result = result_cache.get(key)
+    if result is not None:
+        # The task is recorded as completed right away, and never reaches a dispatcher
+        task.status = Task.TaskState.COMPLETED
+        task.result = result
+        await task.insert_async()
+        return task.db_record
+
+    # Identical calls share the task already executing. There is no await between the lookup and start(), so two
+    # requests cannot both miss
+    task_id = result_cache.running(key)
+    if task_id is not None:
+        return {'task_id': task_id}
+
+    result_cache.start(key, task.task_id)
+    await submit_tasks([task])
+
+    return task.db_record
+
+
+def cache_result(task_id):
+    if result_cache.key_of(task_id) is not None:
+        asyncio.create_task(store_result(task_id))
+
+
+async def store_result(task_id):
+    key = result_cache.key_of(task_id)
+    try:
+        record = await async_redis_queue.read_fields(task_id, ('status', 'result'))
+        # Failures are not cached, the next call executes the function again
+        if record is not None and record['status'] == Task.TaskState.COMPLETED:
+            result_cache.put(key, record['result'])
+    finally:
+        result_cache.finish(task_id)
+
+
+@app.post('/execute_batch', response_model=ExecuteBatchRep, status_code=201)
+async def execute_batch(request: ExecuteBatchReq):
+    tasks = await Task.from_payloads_async(request.function_id, request.payloads, request.priority)
+    await submit_tasks(tasks)
+
+    return {'task_ids': [task.task_id for task in tasks]}
+
+
+@app.post('/map', response_model=MapRep, status_code=201)
+async def map_function(request: MapReq):
+    """
+    Runs the function over many items (or over a range), in chunks that each run as one task. The results of the chunks
+    are streamed from /map/{job_id}/stream in the order they complete
+    """
+    function_id = str(request.function_id)
+    units = len(request.payloads) if request.payloads is not None else request.range.stop - request.range.start
+    if units <= 0:
+        raise HTTPException(status_code=422, detail='Nothing to map')
+
+    size = request.chunk_size or chunking.chunk_size(
+        units, await async_redis_queue.total_capacity(), await async_redis_queue.unit_cost(function_id)
+    )
+    if request.payloads is not None:
+        chunks = chunking.item_chunks(request.payloads, size)
+    else:
+        chunks = chunking.range_chunks(request.range.payload, request.range.start, request.range.stop, size)
+
+    job_id = str(uuid.uuid4())
+    tasks = await Task.from_payloads_async(function_id, chunks, request.priority)
+    for task in tasks:
+        task.job_id = job_id
+        task.first_result = request.first_result
+
+    task_ids = [task.task_id for task in tasks]
+    job = {'job_id': job_id, 'function_id': function_id, 'task_ids': task_ids, 'cancelled': False}
+
+    await async_redis_queue.insert(job_id, job)
+    await submit_tasks(tasks)
+
+    return {'job_id': job_id, 'task_ids': task_ids, 'chunk_size': size}
+
+
+@app.post('/dag', response_model=DagRep, status_code=201)
+async def execute_dag(request: DagReq):
+    """
+    Runs a DAG of tasks. Only the tasks without inputs are queued here, the others are submitted by the dispatcher that
+    completes their last input, with the results of their inputs, so intermediate results never come back to the web
+    service or the client
+    """
+    nodes = {node.name: node for node in request.nodes}
+    if len(nodes) != len(request.nodes):
+        raise HTTPException(status_code=422, detail='Node names must be unique')
+
+    unknown = {name for node in request.nodes for name in node.inputs if name not in nodes}
+    if unknown:
+        raise HTTPException(status_code=422, detail=f'Unknown inputs {sorted(unknown)}')
+
+    if has_cycle(nodes):
+        raise HTTPException(status_code=422, detail='The nodes must not form a cycle')
+
+    function_records = {}
+    for node in request.nodes:
+        if node.function_id not in function_records:
+            function_records[node.function_id] = await async_redis_queue.read(str(node.function_id))
+
+    tasks = {
+        name: Task(node.function_id, node.payload, function_records[node.function_id], request.priority)
+        for name, node in nodes.items()
+    }
+    for name, node in nodes.items():
+        task = tasks[name]
+        task.inputs = [tasks[input_name].task_id for input_name in node.inputs]
+        task.pending_inputs = len(node.inputs)
+
+        for input_name in node.inputs:
+            tasks[input_name].dependents = list(tasks[input_name].dependents) + [task.task_id]
+
+    roots = [tasks[name] for name, node in nodes.items() if not node.inputs]
+    await submit_tasks(roots, [tasks[name] for name, node in nodes.items() if node.inputs])
+
+    return {'task_ids': {name: task.task_id for name, task in tasks.items()}}
+
+
+def has_cycle(nodes) -> bool:
+    # Kahn's algorithm: nodes left once every node without pending inputs is removed are on a cycle
+    pending = {name: len(set(node.inputs)) for name, node in nodes.items()}
+    dependents = {name: [] for name in nodes}
+    for name, node in nodes.items():
+        for input_name in set(node.inputs):
+            dependents[input_name].append(name)
+
+    ready = [name for name, count in pending.items() if not count]
+    while ready:
+        for dependent in dependents[ready.pop()]:
+            pending[dependent] -= 1
+            if not pending[dependent]:
+                ready.append(dependent)
+
+    return any(pending.values())
+
+
+async def read_job(job_id):
+    job = await async_redis_queue.read_fields(job_id, ['task_ids', 'cancelled'])
+    if job is None:
+        raise HTTPException(status_code=404, detail=f'Job {job_id} not found')
+
+    return job
+
+
+@app.get('/map/{job_id}', response_model=MapStatusRep)
+async def get_map_status(job_id):
+    job = await read_job(job_id)
+    records = await async_redis_queue.read_fields_many(job['task_ids'], ['status'])
+    completed = sum(record is not None and record['status'] in Task.TaskState.TERMINAL for record in records)
+
+    return {
+        'job_id': job_id,
+        'status': Task.TaskState.COMPLETED if completed == len(records) else Task.TaskState.RUNNING,
+        'cancelled': job['cancelled'],
+        'completed': completed,
+        'total': len(records)
+    }
+
+
+@app.get('/map/{job_id}/stream')
+async def stream_map_results(job_id):
+    job = await read_job(job_id)
+    return await stream_results(job['task_ids'])
+
+
+@app.get('/result_cache')
+async def get_result_cache_stats():
+    return result_cache.stats
+
+
+async def read_task(task_id, response_model):
+    # Polls only need the fields of the response, so the task is never rebuilt (and its function never unpickled). The
+    # task id is the key itself, which leaves a single field to read for /status
+    fields = [field for field in response_model.__fields__ if field != 'task_id']
+    record = await async_redis_queue.read_fields(task_id, fields)
+    if record is None:
+        raise HTTPException(status_code=404, detail=f'Task {task_id} not found')
+
+    record['task_id'] = task_id
+    return record
+
+
 @app.get('/status/{task_id}', response_model=TaskStatusRep)
 async def get_status(task_id):
-    task = Task.from_db(task_id)
-    return task.db_record
+    return await read_task(task_id, TaskStatusRep)
 
 
 @app.get('/result/{task_id}', response_model=TaskResultRep)
-async def get_result(task_id):
-    task = Task.from_db(task_id)
-    return task.db_record
+async def get_result(task_id, wait: float = Query(0, ge=0, le=MAX_WAIT)):
+    if not wait:
+        return await read_task(task_id, TaskResultRep)
+
+    # Long-poll: subscribe before reading so a completion between the read and the wait is not missed
+    queue = asyncio.Queue()
+    completion_listener.subscribe([task_id], queue)
+
+    try:
+        record = await read_task(task_id, TaskResultRep)
+        if record['status'] in Task.TaskState.TERMINAL:
+            return record
+
+        try:
+            await asyncio.wait_for(queue.get(), wait)
+        except asyncio.TimeoutError:
+            return record
+
+        return await read_task(task_id, TaskResultRep)
+    finally:
+        completion_listener.unsubscribe([task_id], queue)
+
+
+@app.get('/results/stream')
+async def stream_results(task_ids: List[str] = Query(...)):
+    """
+    Server-sent events stream that pushes the result of every given task as soon as it terminates, and closes once all
+    of them have been sent
+    """
+    queue = asyncio.Queue()
+    completion_listener.subscribe(task_ids, queue)
+
+    records = await async_redis_queue.read_fields_many(task_ids, TaskResultRep.__fields__)
+    unknown = [task_id for task_id, record in zip(task_ids, records) if record is None]
+    if unknown:
+        completion_listener.unsubscribe(task_ids, queue)
+        raise HTTPException(status_code=404, detail=f'Tasks {unknown} not found')
+
+    async def events():
+        pending = set(task_ids)
+
+        try:
+            for record in records:
+                if record['status'] in Task.TaskState.TERMINAL:
+                    pending.discard(record['task_id'])
+                    yield f'data: {TaskResultRep(**record).json()}\n\n'
+
+            while pending:
+                try:
+                    task_id = await asyncio.wait_for(queue.get(), KEEP_ALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    yield ': keep-alive\n\n'
+                    continue
+
+                if task_id not in pending:
+                    continue
+
+                pending.discard(task_id)
+                record = await read_task(task_id, TaskResultRep)
+                yield f'data: {TaskResultRep(**record).json()}\n\n'
+        finally:
+            completion_listener.unsubscribe(task_ids, queue)
+
+    return StreamingResponse(events(), media_type='text/event-stream')
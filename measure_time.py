@@ -59,7 +59,8 @@ def register_function() -> str:
 def get_result(task_id):
     result_url = f'http://127.0.0.1:8000/result/{task_id}'
     while True:
-        response = requests.get(result_url)
+        # Long-poll: the service answers as soon as the task terminates
+        response = requests.get(result_url, params={'wait': 30})
         response_data = response.json()
 
         assert response.status_code == 200
@@ -70,9 +71,6 @@ def get_result(task_id):
             result = deserialize(response_data['result'])
             return True, result
 
-        # Wait before querying again
-        time.sleep(0.1)
-
 
 def aggregate_results(task_ids):
     futures = []
@@ -0,0 +1,235 @@
+import json
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from store import Store, decode_fields, decode_record, encode_record, entry_id
+from utils import deserialize, serialize
+
+
+class ExpiringValues:
+    """
+    Values that expire after a TTL, as redis keys set with EX
+    """
+
+    def __init__(self):
+        self.values = {}
+
+    def set(self, key: str, value, ttl: float):
+        self.values[key] = (value, time.monotonic() + ttl)
+
+    def get(self, key: str):
+        value, expiry = self.values.get(key, (None, 0))
+        if expiry <= time.monotonic():
+            self.values.pop(key, None)
+            return None
+
+        return value
+
+    def matching(self, prefix: str) -> Dict[str, Any]:
+        values = {key: self.get(key) for key in list(self.values) if key.startswith(prefix)}
+        return {key: value for key, value in values.items() if value is not None}
+
+
+class MemoryStore(Store):
+    """
+    Store held in the memory of one process, for a single node deployment running the dispatcher inside the web
+    service: records and tasks never leave the process. Records are kept encoded, as the other stores keep them, so
+    the web service and the dispatcher never share the objects they write
+    """
+
+    BLOCKING = False
+
+    def __init__(self):
+        # The web service and the threads of the dispatcher share the store
+        self.condition = threading.Condition()
+
+        self.records = defaultdict(dict)
+
+        # Per stream: entries by id, the ids not delivered yet, and the delivered ones with (consumer, delivery time)
+        self.entries = defaultdict(OrderedDict)
+        self.undelivered = defaultdict(OrderedDict)
+        self.pending = defaultdict(dict)
+        self.last_id = (0, 0)
+
+        self.shards = {}
+        self.expiring = ExpiringValues()
+        self.costs = {}
+        self.subscribers = []
+
+    def insert(self, key: str, value: dict):
+        with self.condition:
+            self.records[key].update(encode_record(value))
+
+    def insert_many(self, records: Dict[str, dict]):
+        with self.condition:
+            for key, value in records.items():
+                self.records[key].update(encode_record(value))
+
+    def read(self, key: str) -> Optional[dict]:
+        with self.condition:
+            record = dict(self.records.get(key, {}))
+
+        return decode_record(record) or None
+
+    def read_fields(self, key: str, fields: Iterable[str]) -> Optional[dict]:
+        fields = list(fields)
+        with self.condition:
+            record = self.records.get(key, {})
+            values = [record.get(field) for field in fields]
+
+        return decode_fields(fields, values)
+
+    def read_fields_many(self, keys: List[str], fields: Iterable[str]) -> List[Optional[dict]]:
+        fields = list(fields)
+        return [self.read_fields(key, fields) for key in keys]
+
+    def increment(self, key: str, field: str, amount: int = 1) -> int:
+        with self.condition:
+            value = json.loads(self.records[key].get(field, '0')) + amount
+            self.records[key][field] = json.dumps(value)
+
+        return value
+
+    def update_and_notify(self, key: str, value: dict, fields: Iterable[str] = None):
+        self.update(key, value, fields)
+
+        for callback in list(self.subscribers):
+            callback(key)
+
+    def subscribe(self, callback: Callable[[str], None]) -> Callable[[], None]:
+        self.subscribers.append(callback)
+        return lambda: self.subscribers.remove(callback)
+
+    def create_group(self, stream: str = Store.STREAM):
+        pass
+
+    def next_id(self) -> str:
+        # Ids increase even if the clock goes back
+        milliseconds = max(int(time.time() * 1000), self.last_id[0])
+        sequence = self.last_id[1] + 1 if milliseconds == self.last_id[0] else 0
+        self.last_id = (milliseconds, sequence)
+
+        return entry_id(milliseconds / 1000, sequence)
+
+    def enqueue(self, message: Any, stream: str = Store.STREAM):
+        self.enqueue_many([message], stream)
+
+    def enqueue_many(self, messages: Iterable[Any], stream: str = Store.STREAM):
+        # Serialized like in the other stores, the dispatcher gets its own copy of every task
+        messages = [message if type(message) == str else serialize(message) for message in messages]
+
+        with self.condition:
+            for message in messages:
+                new_id = self.next_id()
+                self.entries[stream][new_id] = message
+                self.undelivered[stream][new_id] = True
+
+            self.condition.notify_all()
+
+    def dequeue(self, consumer: str, streams: Iterable[str] = (Store.STREAM, ), count: int = Store.READ_COUNT,
+                block: int = Store.READ_BLOCK_TIME) -> List[Tuple[str, str, Any]]:
+        streams = list(streams)
+        delivered = []
+
+        with self.condition:
+            self.condition.wait_for(lambda: any(self.undelivered[stream] for stream in streams), block / 1000)
+
+            for stream in streams:
+                while self.undelivered[stream] and len(delivered) < count:
+                    new_id, _ = self.undelivered[stream].popitem(last=False)
+                    self.pending[stream][new_id] = (consumer, time.monotonic())
+                    delivered.append((stream, new_id, self.entries[stream][new_id]))
+
+        return [(stream, new_id, deserialize(message)) for stream, new_id, message in delivered]
+
+    def acknowledge(self, *entry_ids: str, stream: str = Store.STREAM):
+        with self.condition:
+            for acknowledged in entry_ids:
+                self.pending[stream].pop(acknowledged, None)
+                self.entries[stream].pop(acknowledged, None)
+
+    def reclaim(self, consumer: str, stream: str = Store.STREAM, min_idle_time: int = Store.RECLAIM_IDLE_TIME,
+                count: int = Store.READ_COUNT) -> List[Tuple[str, str, Any]]:
+        claimed = []
+        now = time.monotonic()
+
+        with self.condition:
+            for pending_id, (_, delivered_at) in list(self.pending[stream].items()):
+                if len(claimed) == count:
+                    break
+
+                if now - delivered_at >= min_idle_time / 1000:
+                    self.pending[stream][pending_id] = (consumer, now)
+                    claimed.append((stream, pending_id, self.entries[stream][pending_id]))
+
+        return [(stream, pending_id, deserialize(message)) for stream, pending_id, message in claimed]
+
+    def touch(self, consumer: str, *entry_ids: str, stream: str = Store.STREAM):
+        now = time.monotonic()
+        with self.condition:
+            for touched in entry_ids:
+                if self.pending[stream].get(touched, (None, ))[0] == consumer:
+                    self.pending[stream][touched] = (consumer, now)
+
+    def stream_length(self, stream: str) -> int:
+        with self.condition:
+            return len(self.entries[stream])
+
+    def heartbeat(self, shard: str):
+        with self.condition:
+            self.shards[shard] = time.time()
+
+    def live_shards(self, timeout: float = Store.SHARD_TIMEOUT) -> List[str]:
+        with self.condition:
+            return sorted(shard for shard, seen in self.shards.items() if seen >= time.time() - timeout)
+
+    def dead_shards(self, timeout: float = Store.SHARD_TIMEOUT) -> List[str]:
+        with self.condition:
+            return sorted(shard for shard, seen in self.shards.items() if seen < time.time() - timeout)
+
+    def remove_shard(self, shard: str):
+        with self.condition:
+            self.shards.pop(shard, None)
+
+    def take_over(self, shard: str, owner: str, timeout: float = Store.SHARD_TIMEOUT) -> bool:
+        key = f'{self.TAKEOVER}:{shard}'
+        with self.condition:
+            if self.expiring.get(key) not in (None, owner):
+                return False
+
+            self.expiring.set(key, owner, timeout)
+            return True
+
+    def set_capacity(self, consumer: str, processes: int, ttl: int = Store.CAPACITY_TTL):
+        with self.condition:
+            self.expiring.set(f'{self.CAPACITY}:{consumer}', processes, ttl)
+
+    def total_capacity(self) -> int:
+        with self.condition:
+            return sum(self.expiring.matching(f'{self.CAPACITY}:').values())
+
+    def publish_metrics(self, component: str, instance: str, snapshot: dict, ttl: int = Store.METRICS_TTL):
+        with self.condition:
+            self.expiring.set(f'{self.METRICS}:{component}:{instance}', json.dumps(snapshot), ttl)
+
+    def read_metrics(self) -> List[Tuple[dict, dict]]:
+        with self.condition:
+            snapshots = self.expiring.matching(f'{self.METRICS}:')
+
+        metrics = []
+        for key, snapshot in snapshots.items():
+            _, component, instance = key.split(':', 2)
+            metrics.append(({'component': component, 'instance': instance}, json.loads(snapshot)))
+
+        return metrics
+
+    def observe_cost(self, function_id: str, seconds: float, weight: float = Store.COST_WEIGHT):
+        with self.condition:
+            previous = self.costs.get(function_id)
+            self.costs[function_id] = seconds if previous is None else weight * seconds + (1 - weight) * previous
+
+    def unit_cost(self, function_id: str) -> Optional[float]:
+        with self.condition:
+            return self.costs.get(function_id)
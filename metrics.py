@@ -0,0 +1,169 @@
+import bisect
+import math
+from collections import defaultdict
+from typing import List, Tuple
+
+
+class LatencyCounters:
+
+    def __init__(self):
+        self.count = defaultdict(int)
+        self.total = defaultdict(float)
+        self.max = defaultdict(float)
+
+    def observe(self, stage: str, seconds: float):
+        self.count[stage] += 1
+        self.total[stage] += seconds
+        self.max[stage] = max(self.max[stage], seconds)
+
+    @property
+    def stats(self):
+        return {
+            stage: {'count': count, 'mean': self.total[stage] / count, 'max': self.max[stage]}
+            for stage, count in self.count.items()
+        }
+
+    def __str__(self):
+        return ', '.join(
+            f'{stage}: n={stats["count"]} mean={stats["mean"] * 1000:.2f}ms max={stats["max"] * 1000:.2f}ms'
+            for stage, stats in self.stats.items()
+        )
+
+
+# Upper bounds of the latency buckets (in seconds), the last one catches everything
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, math.inf)
+
+DESCRIPTIONS = {
+    'faas_stage_seconds': ('histogram', 'Time spent by tasks in each stage of their lifecycle'),
+    'faas_stage_quantile_seconds': ('gauge', 'p50 and p99 of the stage latencies, estimated from the histograms'),
+    'faas_tasks_total': ('counter', 'Tasks terminated, by status'),
+    'faas_requests_total': ('counter', 'Requests handled by the web service, by endpoint'),
+    'faas_queue_depth': ('gauge', 'Tasks waiting for a worker, by execution class and priority'),
+    'faas_worker_load': ('gauge', 'Tasks outstanding on each worker'),
+    'faas_worker_processes': ('gauge', 'Processes executing tasks'),
+    'faas_result_cache': ('gauge', 'Counters of the result cache of the web service'),
+    'faas_function_cache_hits_total': ('counter', 'Functions found deserialized in the cache of the process'),
+    'faas_function_cache_misses_total': ('counter', 'Functions missing from the cache of the process'),
+    'faas_worker_run_seconds': ('histogram', 'Execution time of the tasks on each worker'),
+    'faas_worker_tasks_total': ('counter', 'Tasks executed by each worker, by status'),
+}
+
+
+class Histogram:
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        # Interpolated linearly inside the bucket the quantile falls in, as Prometheus' histogram_quantile does
+        rank = q * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                lower = self.buckets[index - 1] if index else 0.0
+                upper = self.buckets[index] if self.buckets[index] != math.inf else lower
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+
+        return 0.0
+
+    def to_dict(self) -> dict:
+        return {'counts': self.counts, 'sum': self.sum, 'count': self.count}
+
+    @classmethod
+    def from_dict(cls, value: dict) -> 'Histogram':
+        histogram = cls()
+        histogram.counts, histogram.sum, histogram.count = value['counts'], value['sum'], value['count']
+        return histogram
+
+
+class Metrics:
+    """
+    Counters, gauges and histograms of one process, keyed by name and labels. Dispatchers and workers publish a
+    snapshot to the store, and the web service renders all of them on /metrics
+    """
+
+    def __init__(self):
+        self.counters = defaultdict(float)
+        self.gauges = {}
+        self.histograms = defaultdict(Histogram)
+
+    @staticmethod
+    def key(name: str, labels: dict = None):
+        return name, tuple(sorted((labels or {}).items()))
+
+    def inc(self, name: str, labels: dict = None, amount: float = 1):
+        self.counters[self.key(name, labels)] += amount
+
+    def set(self, name: str, value: float, labels: dict = None):
+        self.gauges[self.key(name, labels)] = value
+
+    def observe(self, name: str, value: float, labels: dict = None):
+        self.histograms[self.key(name, labels)].observe(value)
+
+    def snapshot(self) -> dict:
+        return {
+            'counters': [[name, dict(labels), value] for (name, labels), value in self.counters.items()],
+            'gauges': [[name, dict(labels), value] for (name, labels), value in self.gauges.items()],
+            'histograms': [
+                [name, dict(labels), histogram.to_dict()] for (name, labels), histogram in self.histograms.items()
+            ]
+        }
+
+
+def format_labels(labels: dict) -> str:
+    if not labels:
+        return ''
+
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+def format_value(value: float) -> str:
+    return '+Inf' if value == math.inf else repr(float(value))
+
+
+def render(snapshots: List[Tuple[dict, dict]]) -> str:
+    """
+    Renders metric snapshots in the Prometheus text format, one family at a time
+    :param snapshots: Snapshots with the labels identifying the process they come from
+    :return:
+    """
+    families = defaultdict(list)
+
+    for process_labels, snapshot in snapshots:
+        for kind in ('counters', 'gauges'):
+            for name, labels, value in snapshot[kind]:
+                families[name].append(f'{name}{format_labels({**process_labels, **labels})} {format_value(value)}')
+
+        for name, labels, value in snapshot['histograms']:
+            labels = {**process_labels, **labels}
+            histogram = Histogram.from_dict(value)
+
+            cumulative = 0
+            for bucket, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                bucket_labels = format_labels({**labels, 'le': format_value(bucket)})
+                families[name].append(f'{name}_bucket{bucket_labels} {cumulative}')
+            families[name].append(f'{name}_sum{format_labels(labels)} {format_value(histogram.sum)}')
+            families[name].append(f'{name}_count{format_labels(labels)} {histogram.count}')
+
+            quantiles = 'faas_stage_quantile_seconds' if name == 'faas_stage_seconds' else f'{name}_quantile'
+            for q in (0.5, 0.99):
+                quantile_labels = format_labels({**labels, 'quantile': q})
+                families[quantiles].append(f'{quantiles}{quantile_labels} {format_value(histogram.quantile(q))}')
+
+    lines = []
+    for name, samples in families.items():
+        kind, description = DESCRIPTIONS.get(name, ('untyped', name))
+        lines += [f'# HELP {name} {description}', f'# TYPE {name} {kind}'] + samples
+
+    return '\n'.join(lines) + '\n'
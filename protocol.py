@@ -1,13 +1,19 @@
-import threading
+import struct
+import time
 import uuid
 from abc import abstractmethod, ABC
-from multiprocessing import Queue, Pool
-from threading import Lock
-from typing import Callable
+from collections import OrderedDict
+from typing import Any, List, Optional
 
+import dill
 import zmq
 
-from task import Task
+from elastic_pool import Autoscaler, ElasticPool
+from executors import Executors
+from function_cache import FunctionCache, function_cache
+from inbox import Inbox
+from metrics import Metrics
+from task import Function, Task, redis_queue
 from utils import serialize, deserialize
 
 
@@ -20,7 +26,39 @@ class Message:
         RESULT_READY = 'RESULT_READY'
         REGISTRATION = 'REGISTRATION'
 
-    def __init__(self, message_type, sender_id: str, body: Task = None):
+        # Work stealing between push workers: a worker with idle processes says so, the dispatcher asks a busy worker for
+        # tasks it has not started, and the busy worker hands them back
+        IDLE = 'IDLE'
+        STEAL = 'STEAL'
+        STOLEN = 'STOLEN'
+
+        # Sent by a worker whose pool has grown or shrunk
+        CAPACITY = 'CAPACITY'
+
+    class Protocol:
+        # STRING: the whole message is dill-pickled, base64-encoded and sent as one text frame (original protocol)
+        # BINARY: a fixed header frame followed by a raw dill frame for the body
+        STRING = 'string'
+        BINARY = 'binary'
+
+        SUPPORTED = (BINARY, STRING)
+
+        @classmethod
+        def negotiate(cls, offered) -> str:
+            return cls.BINARY if offered and cls.BINARY in offered else cls.STRING
+
+    # Header frame: magic byte, message type, sender id, task id (ids as raw UUID bytes). The magic byte is not part of
+    # the base64 alphabet, which is how receivers tell both protocols apart
+    MAGIC = b'\xfa'
+    HEADER = struct.Struct('!cB16s16s')
+    TYPES = (
+        Type.ACK, Type.NO_TASK, Type.NEW_TASK, Type.REQUEST_TASK, Type.RESULT_READY, Type.REGISTRATION,
+        Type.IDLE, Type.STEAL, Type.STOLEN, Type.CAPACITY
+    )
+    TYPE_CODES = {message_type: code for code, message_type in enumerate(TYPES)}
+    NO_ID = bytes(16)
+
+    def __init__(self, message_type, sender_id: str, body: Any = None):
         self.message_type = message_type
         self.sender = sender_id
         self.body = body
@@ -32,25 +70,102 @@ class Message:
     def retrieve(cls, message_string):
         return deserialize(message_string)
 
+    @property
+    def task_id(self):
+        return self.body.task_id if isinstance(self.body, Task) else None
+
+    @property
+    def tasks(self) -> List[Task]:
+        # Batched pull workers exchange several tasks per NEW_TASK / RESULT_READY message, and push workers send their
+        # results along with the changes to their warm functions
+        if isinstance(self.body, dict):
+            return self.body['tasks']
+        return self.body if isinstance(self.body, list) else [self.body]
+
+    def to_frames(self, protocol: str = Protocol.STRING, by_reference: bool = False) -> List[bytes]:
+        if by_reference and isinstance(self.body, Task):
+            return Message(self.message_type, self.sender, self.body.reference()).to_frames(protocol)
+
+        if by_reference and isinstance(self.body, list):
+            body = [task.reference() for task in self.body]
+            return Message(self.message_type, self.sender, body).to_frames(protocol)
+
+        if by_reference and isinstance(self.body, dict) and 'tasks' in self.body:
+            body = dict(self.body, tasks=[task.reference() for task in self.body['tasks']])
+            return Message(self.message_type, self.sender, body).to_frames(protocol)
+
+        if protocol == self.Protocol.STRING:
+            return [self.compose().encode()]
+
+        task_id = uuid.UUID(self.task_id).bytes if self.task_id else self.NO_ID
+        header = self.HEADER.pack(self.MAGIC, self.TYPE_CODES[self.message_type], uuid.UUID(self.sender).bytes, task_id)
+
+        if self.body is None:
+            return [header]
+        return [header, dill.dumps(self.body)]
+
+    @classmethod
+    def from_frames(cls, frames: list) -> 'Message':
+        # Frames received with copy=False are zmq.Frame objects, the payload is read through their buffer
+        frames = [frame.buffer if isinstance(frame, zmq.Frame) else frame for frame in frames]
+        header = bytes(frames[0][:cls.HEADER.size])
+
+        if not header.startswith(cls.MAGIC):
+            return cls.retrieve(bytes(frames[0]).decode())
+
+        _, code, sender, _ = cls.HEADER.unpack(header)
+        body = dill.loads(bytes(frames[1])) if len(frames) > 1 else None
+
+        return cls(cls.TYPES[code], str(uuid.UUID(bytes=sender)), body)
+
+    @staticmethod
+    def protocol_of(frames: list) -> str:
+        first = frames[0].buffer if isinstance(frames[0], zmq.Frame) else frames[0]
+        return Message.Protocol.BINARY if bytes(first[:1]) == Message.MAGIC else Message.Protocol.STRING
+
 
 class Worker(ABC):
+    """
+    Runs on a single thread polling the dispatcher socket and an Inbox of pool results. Pool callbacks only put the
+    finished task in the Inbox, so the socket is never shared between threads and needs no lock
+    """
+
     class Mechanism:
         PULL = 'PULL'
         PUSH = 'PUSH'
 
-    def __init__(self, mechanism, number_of_processes, master):
+    POLL_TIMEOUT = 1000  # (in milliseconds)
+    METRICS_INTERVAL = 5  # (in seconds)
+    WARM_FUNCTIONS = FunctionCache.MAX_SIZE
+
+    def __init__(self, mechanism, number_of_processes, master, max_processes=None):
         self.mechanism = mechanism
         self.no_of_workers = number_of_processes
-        self.pool = Pool(processes=number_of_processes)
-        self.queue = Queue()
-        self.lock = Lock()
+
+        # The pool only changes size if it is allowed to grow past the given number of processes
+        self.pool = ElasticPool(number_of_processes, max_processes)
+        self.autoscaler = Autoscaler(self.pool) if self.pool.max_processes > number_of_processes else None
+
+        # Tasks of thread and async functions run on a thread pool and an event loop next to the process pool
+        self.executors = Executors(self.pool)
+        self.results = Inbox()
         self.master = master
         self.id = str(uuid.uuid4())
         self.socket = self.create_socket()
 
+        # Messages are sent in the string protocol, with the function inside every task, until the dispatcher
+        # acknowledges the registration
+        self.protocol = Message.Protocol.STRING
+        self.by_reference = False
+
+        # Content hashes of the functions this worker has executed lately, its pool processes have them deserialized
+        self.warm = OrderedDict()
+
+        self.metrics = Metrics()
+
     @property
     def socket_type(self):
-        return zmq.REQ if self.mechanism == self.Mechanism.PULL else zmq.DEALER
+        return zmq.DEALER
 
     def create_socket(self):
         context = zmq.Context()
@@ -62,34 +177,148 @@ class Worker(ABC):
 
     @abstractmethod
     def get_task(self):
+        """
+        Handles the messages waiting on the socket
+        :return:
+        """
         pass
 
     @abstractmethod
     def submit_result(self, *args, **kwargs):
+        """
+        Sends the results waiting in the Inbox
+        :return:
+        """
         pass
 
     def handle_result(self, result):
-        self.queue.put(result)
+        self.results.put(result)
 
     def submit_task(self, task: Task):
-        self.pool.apply_async(task.execute, callback=self.handle_result)
+        self.executors.apply_async(task, callback=self.handle_result)
+
+    def start(self):
+        pass
+
+    def queue_depth(self) -> int:
+        """
+        Number of tasks waiting for a process, drives the autoscaler
+        :return:
+        """
+        return 0
+
+    def oldest_wait(self) -> Optional[float]:
+        return None
+
+    def resized(self):
+        """
+        Called once the pool has grown or shrunk, so the dispatcher can be told about the new capacity
+        :return:
+        """
+        pass
+
+    def autoscale(self):
+        if self.autoscaler is None:
+            return
+
+        size = self.autoscaler.check(self.queue_depth(), self.oldest_wait())
+        if size is None or size == self.pool.size:
+            return
+
+        print(f'Resizing the pool from {self.pool.size} to {size} processes')
+        self.no_of_workers = self.pool.resize(size)
+        self.resized()
 
     def execute(self):
         self.register()
 
-        get_task_thread = threading.Thread(target=self.get_task)
-        submit_result_thread = threading.Thread(target=self.submit_result)
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        poller.register(self.results.fd, zmq.POLLIN)
 
-        get_task_thread.start()
-        submit_result_thread.start()
+        self.start()
+        last_metrics = 0
+        while True:
+            events = dict(poller.poll(self.POLL_TIMEOUT))
 
-        get_task_thread.join()
-        submit_result_thread.join()
+            if self.socket in events:
+                self.get_task()
+            if self.results.fd in events:
+                self.submit_result()
+
+            self.autoscale()
+
+            if time.monotonic() - last_metrics > self.METRICS_INTERVAL:
+                self.publish_metrics()
+                last_metrics = time.monotonic()
+
+    def observe(self, tasks: List[Task]):
+        """
+        Records the execution time of the tasks that came back from the pool
+        :param tasks: Executed tasks
+        :return:
+        """
+        for task in tasks:
+            for duration in task.durations('run').values():
+                self.metrics.observe('faas_worker_run_seconds', duration)
+            self.metrics.inc('faas_worker_tasks_total', {'status': task.status})
+
+    def publish_metrics(self):
+        for executor in Function.Executor.ALL:
+            load = self.executors.running(executor)
+            if executor == Function.Executor.PROCESS:
+                load += self.queue_depth()
+            self.metrics.set('faas_worker_load', load, {'executor': executor})
+        self.metrics.set('faas_worker_processes', self.pool.size)
+        self.metrics.set('faas_function_cache_hits_total', function_cache.hits)
+        self.metrics.set('faas_function_cache_misses_total', function_cache.misses)
+
+        redis_queue.publish_metrics('worker', self.id, self.metrics.snapshot())
 
     @abstractmethod
     def register(self):
         pass
 
+    def warm_up(self, tasks: List[Task]):
+        """
+        Records the functions of the executed tasks as warm
+        :param tasks: Executed tasks
+        :return: Functions that became warm and functions that went cold
+        """
+        warmed, cooled = [], []
+        for task in tasks:
+            function_hash = task.function_hash
+            if function_hash not in self.warm:
+                warmed.append(function_hash)
+            self.warm[function_hash] = True
+            self.warm.move_to_end(function_hash)
+
+        while len(self.warm) > self.WARM_FUNCTIONS:
+            function_hash, _ = self.warm.popitem(last=False)
+            cooled.append(function_hash)
+
+        return warmed, cooled
+
+    def registration_message(self):
+        # Functions missing from the cache are fetched from the store, so tasks can be sent by reference
+        body = {
+            'protocols': Message.Protocol.SUPPORTED, 'by_reference': True, 'warm': list(self.warm),
+            'processes': self.no_of_workers
+        }
+        return self.create_message(Message.Type.REGISTRATION, body)
+
+    def accept_registration(self, message: Message):
+        # Dispatchers predating the binary protocol acknowledge without a body
+        if isinstance(message.body, dict):
+            self.protocol = message.body.get('protocol', Message.Protocol.STRING)
+            self.by_reference = message.body.get('by_reference', False)
+
+    def send(self, message: Message):
+        self.socket.send_multipart(message.to_frames(self.protocol, self.by_reference), copy=False)
+
+    def receive(self, flags=0) -> Message:
+        return Message.from_frames(self.socket.recv_multipart(flags=flags, copy=False))
+
     def create_message(self, message_type, body: Task = None):
         message = Message(message_type, self.id, body)
         return message
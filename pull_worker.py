@@ -1,69 +1,94 @@
 import sys
-from multiprocessing import Lock
+from collections import defaultdict
+
+import zmq
 
 from protocol import Message, Worker
+from task import Function
 
 
 class PullWorker(Worker):
+    """
+    Asks the dispatcher for as many tasks as it has idle processes, in one REQUEST_TASK. The dispatcher keeps the
+    request until it has tasks, so the worker does not poll, and results go back in batches without waiting for an ACK.
+    Idle threads and coroutine slots are asked for in requests of their own
+    """
+
+    def __init__(self, number_of_processes, master, batch_size=None, max_processes=None):
+        super().__init__(self.Mechanism.PULL, number_of_processes, master, max_processes)
+        self.batch_size = batch_size or number_of_processes
+
+        # Per execution class: tasks running, and tasks asked for but not received yet
+        self.load = defaultdict(int)
+        self.requested = defaultdict(int)
+
+        # Whether the dispatcher filled the last request at once: it has tasks waiting, as far as the worker can tell
+        self.backlog = False
+
+    def request_tasks(self):
+        for executor in Function.Executor.ALL:
+            if executor == Function.Executor.PROCESS:
+                count = min(self.no_of_workers - self.load[executor] - self.requested[executor], self.batch_size)
+            else:
+                count = self.executors.size(executor) - self.load[executor] - self.requested[executor]
+
+            if count <= 0:
+                continue
 
-    def __init__(self, number_of_processes, master):
-        super().__init__(self.Mechanism.PULL, number_of_processes, master)
-        self.load = 0
-        self.load_lock = Lock()
-
-    def handle_result(self, result):
-        self.queue.put(result)
-        self.load_lock.acquire()
-        self.load -= 1
-        self.load_lock.release()
+            self.requested[executor] += count
+            self.send(self.create_message(Message.Type.REQUEST_TASK, {'count': count, 'executor': executor}))
 
     def get_task(self):
         while True:
-            if self.load >= self.no_of_workers:
-                print('Avoiding tasks for some time: Hands full!')
-                continue
-
-            self.lock.acquire()
-
-            message = self.create_message(Message.Type.REQUEST_TASK)
-            self.socket.send_string(message.compose())
+            try:
+                message = self.receive(flags=zmq.NOBLOCK)
+            except zmq.Again:
+                return
 
-            response = self.socket.recv_string()
-            message = Message.retrieve(response)
-
-            self.lock.release()
-
-            if message.message_type == Message.Type.NO_TASK:
+            if message.message_type != Message.Type.NEW_TASK:
                 continue
 
-            self.submit_task(message.body)
-            self.load_lock.acquire()
-            self.load += 1
-            self.load_lock.release()
+            for task in message.tasks:
+                self.requested[task.executor] -= 1
+                self.load[task.executor] += 1
+                self.submit_task(task)
+
+            if any(task.executor == Function.Executor.PROCESS for task in message.tasks):
+                self.backlog = self.requested[Function.Executor.PROCESS] == 0
 
     def submit_result(self, *args, **kwargs):
-        while True:
-            if not self.queue.empty():
-                task = self.queue.get(block=False)
-                self.lock.acquire()
+        tasks = self.results.drain()
+        if not tasks:
+            return
+
+        for task in tasks:
+            self.load[task.executor] -= 1
+        self.observe(tasks)
+        self.send(self.create_message(Message.Type.RESULT_READY, tasks))
+        self.request_tasks()
 
-                message = self.create_message(Message.Type.RESULT_READY, task)
-                self.socket.send_string(message.compose())
-                self.socket.recv_string()
+    def queue_depth(self):
+        return int(self.backlog and self.load[Function.Executor.PROCESS] >= self.no_of_workers)
 
-                self.lock.release()
+    def resized(self):
+        # The dispatcher learns about the new size from the number of tasks asked for
+        self.request_tasks()
 
     def register(self):
-        message = Message(Message.Type.REGISTRATION, self.id)
-        self.socket.send_string(message.compose())
+        self.send(self.registration_message())
 
         # ACK message
-        self.socket.recv_string()
+        self.accept_registration(self.receive())
+
+    def start(self):
+        self.request_tasks()
 
 
 if __name__ == '__main__':
     num_worker_processors = int(sys.argv[1])
     dispatcher_url = sys.argv[2]
+    batch_size = int(sys.argv[3]) if len(sys.argv) > 3 else None
+    max_processes = int(sys.argv[4]) if len(sys.argv) > 4 else None
 
-    worker = PullWorker(num_worker_processors, dispatcher_url)
+    worker = PullWorker(num_worker_processors, dispatcher_url, batch_size, max_processes)
     worker.execute()
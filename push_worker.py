@@ -1,49 +1,130 @@
 import sys
+import time
+from collections import deque
 
 import zmq
-from zmq import Again
 
 from protocol import Message, Worker
+from task import Function
 
 
 class PushWorker(Worker):
-    
-    def __init__(self, number_of_processes, master):
-        super().__init__(self.Mechanism.PUSH, number_of_processes, master)
+    """
+    Runs the tasks pushed by the dispatcher. Tasks beyond the number of processes wait in a local queue rather than in
+    the pool, so the dispatcher can take them back (steal them) for a worker that has gone idle
+    """
+
+    # Tasks accepted on top of one per process, so a process never idles while its next task is on the wire
+    PREFETCH = 2
+
+    def __init__(self, number_of_processes, master, prefetch=PREFETCH, max_processes=None):
+        super().__init__(self.Mechanism.PUSH, number_of_processes, master, max_processes)
+        self.prefetch = prefetch
+
+        # Extensions of the protocol, used once the dispatcher's ACK says it supports them
+        self.locality = False
+        self.stealing = False
+
+        # Tasks received but not started yet (with the time they were received), and the number running in the pool.
+        # Tasks of the other execution classes start as soon as they arrive, the dispatcher never sends more than fit
+        self.queued = deque()
+        self.running = 0
+        self.idle_advertised = False
 
     def get_task(self):
         while True:
-            self.lock.acquire()
-
-            # Receive task
             try:
-                request = self.socket.recv_string(flags=zmq.NOBLOCK)
-                message = Message.retrieve(request)
+                message = self.receive(flags=zmq.NOBLOCK)
+            except zmq.Again:
+                break
+
+            if message.message_type == Message.Type.ACK:
+                self.accept_registration(message)
+                options = message.body if isinstance(message.body, dict) else {}
+                self.locality = options.get('locality', False)
+                self.stealing = options.get('stealing', False)
+            elif message.message_type == Message.Type.STEAL:
+                self.give_up_tasks(message.body['count'])
+            elif message.body.executor != Function.Executor.PROCESS:
                 self.submit_task(message.body)
-            except Again:
-                pass
+            else:
+                self.queued.append((message.body, time.time()))
+                self.idle_advertised = False
+
+        self.start_tasks()
+
+    def start_tasks(self):
+        while self.queued and self.running < self.no_of_workers:
+            self.running += 1
+            task, _ = self.queued.popleft()
+            self.submit_task(task)
+
+    def give_up_tasks(self, count):
+        # The tasks received last are the ones that would have waited longest here
+        tasks = [self.queued.pop()[0] for _ in range(min(count, len(self.queued)))]
+        self.send(self.create_message(Message.Type.STOLEN, tasks))
 
-            self.lock.release()
+    def advertise_idle(self):
+        free = self.no_of_workers - self.running
+        if not self.stealing or free <= 0 or self.queued or self.idle_advertised:
+            return
+
+        self.idle_advertised = True
+        self.send(self.create_message(Message.Type.IDLE, {'free': free}))
 
     def submit_result(self, *args, **kwargs):
-        while True:
-            if not self.queue.empty():
-                task = self.queue.get(block=False)
-                self.lock.acquire()
+        # Everything that finished since the last wake-up goes out in one message
+        tasks = self.results.drain()
+        if not tasks:
+            return
+
+        self.running -= sum(task.executor == Function.Executor.PROCESS for task in tasks)
+        self.start_tasks()
+        self.observe(tasks)
+
+        # Changes to the warm functions are only sent to dispatchers that understand them
+        warmed, cooled = self.warm_up(tasks)
+        if self.locality and (warmed or cooled):
+            body = {'tasks': tasks, 'warm': warmed, 'cold': cooled}
+        else:
+            body = tasks
+
+        self.send(self.create_message(Message.Type.RESULT_READY, body))
+        self.advertise_idle()
+
+    def queue_depth(self):
+        return len(self.queued)
+
+    def oldest_wait(self):
+        return time.time() - self.queued[0][1] if self.queued else 0
+
+    def resized(self):
+        self.send(self.create_message(Message.Type.CAPACITY, self.capacity))
+        self.start_tasks()
+
+    @property
+    def capacity(self):
+        # The dispatcher never has more than `capacity` tasks outstanding on the worker, and not more than fit in the
+        # executor of each class. Dispatchers that predate execution classes only read the capacity of the processes
+        capacity = self.no_of_workers + self.prefetch
+        executors = {**self.executors.capacity, Function.Executor.PROCESS: capacity}
 
-                message = self.create_message(Message.Type.RESULT_READY, task)
-                self.socket.send_string(message.compose())
+        return {'capacity': capacity, 'processes': self.no_of_workers, 'executors': executors}
 
-                self.lock.release()
+    def registration_message(self):
+        message = super().registration_message()
+        message.body.update(self.capacity)
+        return message
 
     def register(self):
-        message = self.create_message(Message.Type.REGISTRATION)
-        self.socket.send_string(message.compose())
+        self.send(self.registration_message())
 
 
 if __name__ == '__main__':
     num_worker_processors = int(sys.argv[1])
     dispatcher_url = sys.argv[2]
+    prefetch = int(sys.argv[3]) if len(sys.argv) > 3 else PushWorker.PREFETCH
+    max_processes = int(sys.argv[4]) if len(sys.argv) > 4 else None
 
-    worker = PushWorker(num_worker_processors, dispatcher_url)
+    worker = PushWorker(num_worker_processors, dispatcher_url, prefetch, max_processes)
     worker.execute()
@@ -1,37 +1,396 @@
 import json
-from typing import Any
+import os
+import time
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, List, Optional, Tuple
 
 import redis
+import redis.asyncio
 
+from store import AsyncStore, Store, decode_fields, decode_record, encode_record
 from utils import deserialize, serialize
 
+HOST = os.environ.get('FAAS_REDIS_HOST', 'localhost')
+PORT = int(os.environ.get('FAAS_REDIS_PORT', 6379))
 
-class Redis:
 
-    CHANNEL = 'tasks'
+def legacy_record(value: str) -> Optional[dict]:
+    # Only task and function records are migrated, other string keys are left alone
+    try:
+        record = json.loads(value)
+    except (TypeError, ValueError):
+        return None
 
-    def __init__(self):
-        self.r = redis.Redis(host='localhost', port=6379, decode_responses=True)
-        self.pubsub = self.r.pubsub(ignore_subscribe_messages=True)
-        self.pubsub.subscribe(self.CHANNEL)
+    return record if isinstance(record, dict) and 'function_id' in record else None
+
+
+class Redis(Store):
+    """
+    Records are hashes, streams are redis streams read by the dispatchers as one consumer group, and completions are
+    published on a channel
+    """
+
+    def __init__(self, host: str = HOST, port: int = PORT):
+        self.r = redis.Redis(host=host, port=port, decode_responses=True)
 
     def insert(self, key: str, value: dict):
-        self.r.set(key, json.dumps(value))
+        self.with_migration(key, self.r.hset, key, mapping=encode_record(value))
+
+    def insert_many(self, records: Dict[str, dict]):
+        pipeline = self.r.pipeline(transaction=False)
+        for key, value in records.items():
+            pipeline.hset(key, mapping=encode_record(value))
+        pipeline.execute()
+
+    def read(self, key: str) -> Optional[dict]:
+        return decode_record(self.with_migration(key, self.r.hgetall, key)) or None
+
+    def read_fields(self, key: str, fields: Iterable[str]) -> Optional[dict]:
+        fields = list(fields)
+        values = self.with_migration(key, self.r.hmget, key, fields)
+
+        return decode_fields(fields, values)
+
+    def read_fields_many(self, keys: List[str], fields: Iterable[str]) -> List[Optional[dict]]:
+        return [self.read_fields(key, fields) for key in keys]
+
+    def increment(self, key: str, field: str, amount: int = 1) -> int:
+        # JSON-encoded integers are plain integers to HINCRBY
+        return self.r.hincrby(key, field, amount)
+
+    def update_and_notify(self, key: str, value: dict, fields: Iterable[str] = None):
+        if fields is not None:
+            value = {field: value[field] for field in fields}
+
+        def persist():
+            pipeline = self.r.pipeline(transaction=False)
+            pipeline.hset(key, mapping=encode_record(value))
+            pipeline.publish(self.COMPLETIONS, key)
+            pipeline.execute()
+
+        self.with_migration(key, persist)
+
+    def subscribe(self, callback: Callable[[str], None]) -> Callable[[], None]:
+        pubsub = self.r.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{self.COMPLETIONS: lambda message: callback(message['data'])})
+
+        thread = pubsub.run_in_thread(sleep_time=1, daemon=True)
+        return thread.stop
+
+    def with_migration(self, key: str, operation: Callable, *args, **kwargs):
+        try:
+            return operation(*args, **kwargs)
+        except redis.ResponseError as exc:
+            if 'WRONGTYPE' not in str(exc):
+                raise
+
+        self.migrate(key)
+        return operation(*args, **kwargs)
+
+    def migrate(self, key: str) -> bool:
+        """
+        Converts a record stored in the original layout (one JSON string) into a hash with one field per attribute
+        :param key: Task or function id
+        :return: Whether the key was migrated
+        """
+        with self.r.pipeline(transaction=True) as pipeline:
+            try:
+                pipeline.watch(key)
+                if pipeline.type(key) != 'string':
+                    return False
+
+                record = legacy_record(pipeline.get(key))
+                if record is None:
+                    return False
+
+                pipeline.multi()
+                pipeline.delete(key)
+                pipeline.hset(key, mapping=encode_record(record))
+                pipeline.execute()
+            except redis.WatchError:
+                # Migrated (or changed) concurrently, the caller simply retries its operation
+                return False
+
+        return True
+
+    def migrate_all(self) -> int:
+        migrated = 0
+        for key in self.r.scan_iter(_type='STRING'):
+            migrated += self.migrate(key)
+
+        return migrated
+
+    def create_group(self, stream: str = Store.STREAM):
+        try:
+            self.r.xgroup_create(stream, self.GROUP, id='0', mkstream=True)
+        except redis.ResponseError as exc:
+            # Another dispatcher has already created the group
+            if 'BUSYGROUP' not in str(exc):
+                raise
+
+    def enqueue(self, message: Any, stream: str = Store.STREAM):
+        if type(message) != str:
+            message = serialize(message)
+
+        self.r.xadd(stream, {self.FIELD: message})
+
+    def enqueue_many(self, messages: Iterable[Any], stream: str = Store.STREAM):
+        pipeline = self.r.pipeline(transaction=False)
+        for message in messages:
+            if type(message) != str:
+                message = serialize(message)
+            pipeline.xadd(stream, {self.FIELD: message})
+        pipeline.execute()
+
+    def dequeue(self, consumer: str, streams: Iterable[str] = (Store.STREAM, ), count: int = Store.READ_COUNT,
+                block: int = Store.READ_BLOCK_TIME) -> List[Tuple[str, str, Any]]:
+        response = self.r.xreadgroup(self.GROUP, consumer, {stream: '>' for stream in streams}, count=count, block=block)
+        if not response:
+            return []
+
+        return [(stream, entry_id, task) for stream, entries in response for entry_id, task in self.parse_entries(entries)]
+
+    def acknowledge(self, *entry_ids: str, stream: str = Store.STREAM):
+        if not entry_ids:
+            return
+
+        pipeline = self.r.pipeline(transaction=False)
+        pipeline.xack(stream, self.GROUP, *entry_ids)
+        pipeline.xdel(stream, *entry_ids)
+        pipeline.execute()
+
+    def reclaim(self, consumer: str, stream: str = Store.STREAM, min_idle_time: int = Store.RECLAIM_IDLE_TIME,
+                count: int = Store.READ_COUNT) -> List[Tuple[str, str, Any]]:
+        # Takes over entries delivered to a consumer (dispatcher) that has not acknowledged them for too long
+        response = self.r.xautoclaim(stream, self.GROUP, consumer, min_idle_time, start_id='0-0', count=count)
+        return [(stream, entry_id, task) for entry_id, task in self.parse_entries(response[1])]
+
+    def touch(self, consumer: str, *entry_ids: str, stream: str = Store.STREAM):
+        if not entry_ids:
+            return
+
+        # Claiming its own entries again resets their idle time, entries already acknowledged are skipped by redis
+        self.r.xclaim(stream, self.GROUP, consumer, 0, list(entry_ids), justid=True)
+
+    @staticmethod
+    def parse_entries(entries) -> List[Tuple[str, Any]]:
+        # Entries deleted after delivery come back without fields
+        return [(entry_id, deserialize(fields[Redis.FIELD])) for entry_id, fields in entries if fields]
+
+    def heartbeat(self, shard: str):
+        # Shards are kept in a sorted set scored by their last heartbeat
+        self.r.zadd(self.SHARDS, {shard: time.time()})
+
+    def live_shards(self, timeout: float = Store.SHARD_TIMEOUT) -> List[str]:
+        # Sorted by name rather than by heartbeat, as in the other stores
+        return sorted(self.r.zrangebyscore(self.SHARDS, time.time() - timeout, '+inf'))
+
+    def dead_shards(self, timeout: float = Store.SHARD_TIMEOUT) -> List[str]:
+        return sorted(self.r.zrangebyscore(self.SHARDS, '-inf', f'({time.time() - timeout}'))
+
+    def remove_shard(self, shard: str):
+        self.r.zrem(self.SHARDS, shard)
+
+    def take_over(self, shard: str, owner: str, timeout: float = Store.SHARD_TIMEOUT) -> bool:
+        key = f'{self.TAKEOVER}:{shard}'
+        if self.r.set(key, owner, nx=True, ex=int(timeout)) or self.r.get(key) == owner:
+            self.r.expire(key, int(timeout))
+            return True
+
+        return False
 
-    def read(self, key: str) -> dict:
-        return json.loads(self.r.get(key))
+    def stream_length(self, stream: str) -> int:
+        # Acknowledged entries are deleted, so an empty stream has nothing pending either
+        return self.r.xlen(stream)
 
-    def update(self, key: str, value: dict):
-        self.insert(key, value)
+    def set_expiring(self, registry: str, member: str, value: str, ttl: int):
+        # Values expire with the process that sets them, unless it refreshes them. Their keys are kept in a registry
+        # sorted by expiry, so they are found without scanning the keyspace
+        pipeline = self.r.pipeline(transaction=False)
+        pipeline.set(f'{registry}:{member}', value, ex=ttl)
+        pipeline.zadd(registry, {member: time.time() + ttl})
+        pipeline.execute()
 
-    def publish_to_channel(self, message: Any):
+    def read_expiring(self, registry: str) -> Tuple[List[str], List[Optional[str]]]:
+        now = time.time()
+        pipeline = self.r.pipeline(transaction=False)
+        pipeline.zremrangebyscore(registry, '-inf', now)
+        pipeline.zrangebyscore(registry, now, '+inf')
+        _, members = pipeline.execute()
+
+        keys = [f'{registry}:{member}' for member in members]
+        return keys, self.r.mget(keys) if keys else []
+
+    def set_capacity(self, consumer: str, processes: int, ttl: int = Store.CAPACITY_TTL):
+        self.set_expiring(self.CAPACITY, consumer, processes, ttl)
+
+    def total_capacity(self) -> int:
+        _, capacities = self.read_expiring(self.CAPACITY)
+        return sum(int(processes) for processes in capacities if processes is not None)
+
+    def publish_metrics(self, component: str, instance: str, snapshot: dict, ttl: int = Store.METRICS_TTL):
+        self.set_expiring(self.METRICS, f'{component}:{instance}', json.dumps(snapshot), ttl)
+
+    def read_metrics(self) -> List[Tuple[dict, dict]]:
+        return parse_metrics(*self.read_expiring(self.METRICS))
+
+    def observe_cost(self, function_id: str, seconds: float, weight: float = Store.COST_WEIGHT):
+        # Exponentially weighted moving average, recent chunks count more
+        previous = self.r.hget(self.COSTS, function_id)
+        cost = seconds if previous is None else weight * seconds + (1 - weight) * float(previous)
+
+        self.r.hset(self.COSTS, function_id, cost)
+
+    def unit_cost(self, function_id: str) -> Optional[float]:
+        cost = self.r.hget(self.COSTS, function_id)
+        return float(cost) if cost is not None else None
+
+    def close(self):
+        self.r.close()
+
+
+def parse_metrics(keys: List[str], snapshots: List[Optional[str]]) -> List[Tuple[dict, dict]]:
+    metrics = []
+    for key, snapshot in zip(keys, snapshots):
+        if snapshot is not None:
+            _, component, instance = key.split(':', 2)
+            metrics.append(({'component': component, 'instance': instance}, json.loads(snapshot)))
+
+    return metrics
+
+
+class AsyncRedis(AsyncStore):
+    """
+    Asyncio counterpart of Redis for the web service, so a round trip to redis does not block the event loop. Requests
+    share one connection pool
+    """
+
+    MAX_CONNECTIONS = 64
+
+    def __init__(self, host: str = HOST, port: int = PORT, max_connections: int = MAX_CONNECTIONS):
+        self.pool = redis.asyncio.ConnectionPool(
+            host=host, port=port, decode_responses=True, max_connections=max_connections
+        )
+        self.r = redis.asyncio.Redis(connection_pool=self.pool)
+
+    async def insert(self, key: str, value: dict):
+        await self.with_migration(key, self.r.hset, key, mapping=encode_record(value))
+
+    async def insert_many(self, records: Dict[str, dict]):
+        pipeline = self.r.pipeline(transaction=False)
+        for key, value in records.items():
+            pipeline.hset(key, mapping=encode_record(value))
+        await pipeline.execute()
+
+    async def read(self, key: str) -> Optional[dict]:
+        return decode_record(await self.with_migration(key, self.r.hgetall, key)) or None
+
+    async def read_fields(self, key: str, fields: Iterable[str]) -> Optional[dict]:
+        fields = list(fields)
+        values = await self.with_migration(key, self.r.hmget, key, fields)
+
+        return decode_fields(fields, values)
+
+    async def read_fields_many(self, keys: List[str], fields: Iterable[str]) -> List[Optional[dict]]:
+        fields = list(fields)
+
+        pipeline = self.r.pipeline(transaction=False)
+        for key in keys:
+            pipeline.hmget(key, fields)
+        responses = await pipeline.execute(raise_on_error=False)
+
+        records = []
+        for key, values in zip(keys, responses):
+            if isinstance(values, redis.ResponseError):
+                records.append(await self.read_fields(key, fields))
+            else:
+                records.append(decode_fields(fields, values))
+
+        return records
+
+    async def with_migration(self, key: str, operation: Callable, *args, **kwargs):
+        try:
+            return await operation(*args, **kwargs)
+        except redis.ResponseError as exc:
+            if 'WRONGTYPE' not in str(exc):
+                raise
+
+        await self.migrate(key)
+        return await operation(*args, **kwargs)
+
+    async def migrate(self, key: str) -> bool:
+        async with self.r.pipeline(transaction=True) as pipeline:
+            try:
+                await pipeline.watch(key)
+                if await pipeline.type(key) != 'string':
+                    return False
+
+                record = legacy_record(await pipeline.get(key))
+                if record is None:
+                    return False
+
+                pipeline.multi()
+                pipeline.delete(key)
+                pipeline.hset(key, mapping=encode_record(record))
+                await pipeline.execute()
+            except redis.WatchError:
+                return False
+
+        return True
+
+    async def completions(self) -> AsyncIterator[str]:
+        pubsub = self.r.pubsub(ignore_subscribe_messages=True)
+        await pubsub.subscribe(Redis.COMPLETIONS)
+
+        try:
+            async for message in pubsub.listen():
+                if message['type'] == 'message':
+                    yield message['data']
+        finally:
+            await pubsub.close()
+
+    async def enqueue(self, message: Any, stream: str = Redis.STREAM):
         if type(message) != str:
             message = serialize(message)
 
-        self.r.publish(self.CHANNEL, message)
+        await self.r.xadd(stream, {Redis.FIELD: message})
+
+    async def enqueue_many(self, messages: Iterable[Any], stream: str = Redis.STREAM):
+        pipeline = self.r.pipeline(transaction=False)
+        for message in messages:
+            if type(message) != str:
+                message = serialize(message)
+            pipeline.xadd(stream, {Redis.FIELD: message})
+        await pipeline.execute()
+
+    async def live_shards(self, timeout: float = Redis.SHARD_TIMEOUT) -> List[str]:
+        return sorted(await self.r.zrangebyscore(Redis.SHARDS, time.time() - timeout, '+inf'))
+
+    async def read_expiring(self, registry: str) -> Tuple[List[str], List[Optional[str]]]:
+        # See Redis.set_expiring
+        now = time.time()
+        pipeline = self.r.pipeline(transaction=False)
+        pipeline.zremrangebyscore(registry, '-inf', now)
+        pipeline.zrangebyscore(registry, now, '+inf')
+        _, members = await pipeline.execute()
+
+        keys = [f'{registry}:{member}' for member in members]
+        return keys, await self.r.mget(keys) if keys else []
+
+    async def total_capacity(self) -> int:
+        _, capacities = await self.read_expiring(Redis.CAPACITY)
+        return sum(int(processes) for processes in capacities if processes is not None)
+
+    async def read_metrics(self) -> List[Tuple[dict, dict]]:
+        return parse_metrics(*await self.read_expiring(Redis.METRICS))
+
+    async def unit_cost(self, function_id: str) -> Optional[float]:
+        cost = await self.r.hget(Redis.COSTS, function_id)
+        return float(cost) if cost is not None else None
+
+    async def close(self):
+        await self.pool.disconnect()
 
-    def read_channel(self):
-        message = self.pubsub.get_message(ignore_subscribe_messages=True)
 
-        if message is not None:
-            return deserialize(message['data'])
+if __name__ == '__main__':
+    # Converts records written in the original string layout, they are otherwise migrated lazily on first access
+    print(f'Migrated {Redis().migrate_all()} records')
@@ -1,26 +1,103 @@
 import uuid
+from typing import Dict, List, Literal, Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, root_validator
 
 
 class RegisterFn(BaseModel):
     name: str
     payload: str
+    # Results of cacheable (pure) functions are reused for calls with the same payload
+    cacheable: bool = False
+    # Execution class of the tasks: processes for CPU-bound functions, threads for blocking I/O, async for coroutines
+    executor: Literal['process', 'thread', 'async'] = 'process'
 
 
 class RegisterFnRep(BaseModel):
     function_id: uuid.UUID
 
 
+Priority = Literal['high', 'normal', 'low']
+
+
 class ExecuteFnReq(BaseModel):
     function_id: uuid.UUID
     payload: str
+    priority: Priority = 'normal'
 
 
 class ExecuteFnRep(BaseModel):
     task_id: uuid.UUID
 
 
+class ExecuteBatchReq(BaseModel):
+    function_id: uuid.UUID
+    payloads: List[str]
+    priority: Priority = 'normal'
+
+
+class ExecuteBatchRep(BaseModel):
+    task_ids: List[uuid.UUID]
+
+
+class RangeSpec(BaseModel):
+    # The function is called as function(*args, low, high, **kwargs) on every sub-range [low, high) of [start, stop)
+    payload: str
+    start: int
+    stop: int
+
+
+class MapReq(BaseModel):
+    function_id: uuid.UUID
+    # Either one (args, kwargs) payload per item, or a range to split
+    payloads: Optional[List[str]] = None
+    range: Optional[RangeSpec] = None
+    # Chosen from the number of worker processes and the measured time per item if not given
+    chunk_size: Optional[int] = Field(None, ge=1)
+    # Stops the job at the first result that is not None
+    first_result: bool = False
+    priority: Priority = 'normal'
+
+    @root_validator(skip_on_failure=True)
+    def one_input(cls, values):
+        if (values.get('payloads') is None) == (values.get('range') is None):
+            raise ValueError('Exactly one of payloads and range is required')
+        return values
+
+
+class MapRep(BaseModel):
+    job_id: uuid.UUID
+    task_ids: List[uuid.UUID]
+    chunk_size: int
+
+
+class MapStatusRep(BaseModel):
+    job_id: uuid.UUID
+    status: str
+    # Whether the job stopped at its first result
+    cancelled: bool
+    completed: int
+    total: int
+
+
+class DagNode(BaseModel):
+    # Name of the node within the DAG, used to reference it as an input
+    name: str
+    function_id: uuid.UUID
+    # (args, kwargs) of the call. The results of the inputs are prepended to args, in the order of the inputs
+    payload: str
+    inputs: List[str] = []
+
+
+class DagReq(BaseModel):
+    nodes: List[DagNode]
+    priority: Priority = 'normal'
+
+
+class DagRep(BaseModel):
+    task_ids: Dict[str, uuid.UUID]
+
+
 class TaskStatusRep(BaseModel):
     task_id: uuid.UUID
     status: str
@@ -0,0 +1,126 @@
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from utils import content_hash
+
+
+class ResultCache:
+    """
+    Results of cacheable functions, keyed by the function content hash and the payload of the call. Entries expire
+    after a TTL and the least recently used ones are evicted once the cached results exceed the memory budget. Calls
+    still executing are tracked too, so identical requests share one execution instead of queueing a task each
+    """
+
+    TTL = 300  # (in seconds)
+    MAX_BYTES = 64 * 1024 * 1024
+
+    def __init__(self, ttl: float = TTL, max_bytes: int = MAX_BYTES):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+
+        # key -> (result, expiry), in least recently used order
+        self.entries = OrderedDict()
+        self.size = 0
+
+        # key -> (task id, expiry) of the execution in progress, and the way back from its task id
+        self.in_flight = {}
+        self.keys = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def key(function_hash: str, payload: str) -> str:
+        return content_hash(f'{function_hash}:{payload}')
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        result, expiry = entry
+        if expiry <= time.monotonic():
+            self.expirations += 1
+            self.misses += 1
+            self.remove(key)
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return result
+
+    def put(self, key: str, result: str):
+        if key in self.entries:
+            self.remove(key)
+
+        # Results are base64 strings, their length is close enough to the memory they hold
+        if len(result) > self.max_bytes:
+            return
+
+        self.entries[key] = (result, time.monotonic() + self.ttl)
+        self.size += len(result)
+
+        while self.size > self.max_bytes:
+            _, (evicted, _) = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+
+    def remove(self, key: str):
+        result, _ = self.entries.pop(key)
+        self.size -= len(result)
+
+    def running(self, key: str) -> Optional[str]:
+        """
+        Returns the id of the task already executing the call, if any
+        :param key: Cache key of the call
+        :return:
+        """
+        entry = self.in_flight.get(key)
+        if entry is None:
+            return None
+
+        task_id, expiry = entry
+        # A completion that was never heard of (e.g. the listener was reconnecting) must not pin the key forever
+        if expiry <= time.monotonic():
+            self.finish(task_id)
+            return None
+
+        self.coalesced += 1
+        return task_id
+
+    def start(self, key: str, task_id: str):
+        self.in_flight[key] = (task_id, time.monotonic() + self.ttl)
+        self.keys[task_id] = key
+
+    def key_of(self, task_id: str) -> Optional[str]:
+        return self.keys.get(task_id)
+
+    def finish(self, task_id: str):
+        key = self.keys.pop(task_id, None)
+        if key is not None and self.in_flight.get(key, (None,))[0] == task_id:
+            del self.in_flight[key]
+
+    @property
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'coalesced': self.coalesced,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'entries': len(self.entries),
+            'in_flight': len(self.in_flight),
+            'bytes': self.size,
+            'max_bytes': self.max_bytes
+        }
+
+
+# One per web service process
+result_cache = ResultCache()
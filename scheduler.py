@@ -0,0 +1,133 @@
+import heapq
+import itertools
+import time
+from collections import defaultdict
+from typing import Optional
+
+from metrics import LatencyCounters
+from task import Function, Task
+
+
+class FairScheduler:
+    """
+    Weighted fair queue of the tasks waiting for a worker. Every (priority, function id) pair is a flow, and flows share
+    the workers in proportion to the weight of their priority: a flow that submits many tasks only delays itself, and a
+    new flow is served right away instead of behind the backlog of the others.
+
+    Each task is tagged with the virtual time at which its flow would finish serving it, and tasks are served in tag
+    order
+    """
+
+    def __init__(self, weights: dict = None):
+        self.weights = weights or Task.Priority.WEIGHTS
+
+        self.heap = []
+        self.sequence = itertools.count()
+        self.virtual_time = 0.0
+
+        # Per flow: tag of its last queued task and number of queued tasks
+        self.last_finish = {}
+        self.flow_depth = defaultdict(int)
+
+        self.depth = defaultdict(int)
+        self.wait = LatencyCounters()
+
+    @staticmethod
+    def priority_of(task: Task) -> str:
+        # Tasks queued before priorities existed have none
+        return getattr(task, 'priority', Task.Priority.NORMAL)
+
+    def push(self, task: Task, enqueued_at: float = None):
+        priority = self.priority_of(task)
+        flow = (priority, task.function_id)
+
+        start = max(self.virtual_time, self.last_finish.get(flow, 0.0))
+        finish = start + 1 / self.weights.get(priority, 1)
+        self.last_finish[flow] = finish
+
+        self.flow_depth[flow] += 1
+        self.depth[priority] += 1
+
+        entry = (finish, next(self.sequence), start, flow, task, enqueued_at or time.time())
+        heapq.heappush(self.heap, entry)
+
+    def pop(self) -> Task:
+        _, _, start, flow, task, enqueued_at = heapq.heappop(self.heap)
+        self.virtual_time = max(self.virtual_time, start)
+
+        self.flow_depth[flow] -= 1
+        if not self.flow_depth[flow]:
+            # An idle flow starts over from the current virtual time
+            del self.flow_depth[flow]
+            del self.last_finish[flow]
+
+        priority, _ = flow
+        self.depth[priority] -= 1
+        self.wait.observe(priority, time.time() - enqueued_at)
+
+        return task
+
+    def oldest_wait(self) -> float:
+        # Tasks are ordered by tag rather than by age, so every one is looked at
+        now = time.time()
+        return max((now - entry[-1] for entry in self.heap), default=0)
+
+    def __len__(self):
+        return len(self.heap)
+
+    @property
+    def stats(self):
+        wait = self.wait.stats
+        return {
+            priority: {'depth': self.depth.get(priority, 0), 'wait': wait.get(priority)} for priority in self.weights
+        }
+
+    def __str__(self):
+        queues = ', '.join(f'{priority}: depth={depth}' for priority, depth in self.depth.items())
+        return f'{queues}; wait {self.wait}'
+
+
+class ExecutorScheduler:
+    """
+    One fair queue per execution class. The classes run on executors of their own, so a task only waits for the tasks
+    of its class: tasks of threads are not stuck behind the backlog of a busy process pool
+    """
+
+    def __init__(self, weights: dict = None):
+        self.schedulers = {executor: FairScheduler(weights) for executor in Function.Executor.ALL}
+        self.turn = itertools.count()
+
+    def push(self, task: Task, enqueued_at: float = None):
+        self.schedulers[task.executor].push(task, enqueued_at)
+
+    def waiting(self) -> list:
+        return [executor for executor, scheduler in self.schedulers.items() if scheduler]
+
+    def pop(self, executors=None) -> Optional[Task]:
+        """
+        :param executors: Classes with room for a task, all of them if None
+        :return: The next task of one of them, or None if none has any
+        """
+        waiting = [executor for executor in self.waiting() if executors is None or executor in executors]
+        if not waiting:
+            return None
+
+        # Classes share no executor, they take turns only to all make progress within one dispatch round
+        return self.schedulers[waiting[next(self.turn) % len(waiting)]].pop()
+
+    def depth(self, executor: str) -> int:
+        return len(self.schedulers[executor])
+
+    def oldest_wait(self, executor: str = None) -> float:
+        executors = [executor] if executor is not None else self.schedulers
+        return max(self.schedulers[executor].oldest_wait() for executor in executors)
+
+    def __len__(self):
+        return sum(len(scheduler) for scheduler in self.schedulers.values())
+
+    @property
+    def stats(self):
+        return {executor: scheduler.stats for executor, scheduler in self.schedulers.items()}
+
+    def __str__(self):
+        return ' | '.join(f'{executor} {scheduler}' for executor, scheduler in self.schedulers.items())
@@ -0,0 +1,72 @@
+import bisect
+import time
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional
+
+from store import AsyncStore, Store
+from utils import content_hash
+
+
+class HashRing:
+    """
+    Consistent hash ring of dispatcher shards. Every shard is placed on the ring several times, so keys spread evenly
+    and a shard joining or leaving only moves the keys of its own arcs
+    """
+
+    REPLICAS = 64
+
+    def __init__(self, shards: Iterable[str], replicas: int = REPLICAS):
+        self.shards = sorted(set(shards))
+        points = sorted((self.position(f'{shard}#{replica}'), shard)
+                        for shard in self.shards for replica in range(replicas))
+
+        self.positions = [position for position, _ in points]
+        self.owners = [shard for _, shard in points]
+
+    @staticmethod
+    def position(key: str) -> int:
+        return int(content_hash(key)[:16], 16)
+
+    def shard_for(self, key: str) -> Optional[str]:
+        if not self.owners:
+            return None
+
+        index = bisect.bisect(self.positions, self.position(key)) % len(self.positions)
+        return self.owners[index]
+
+
+class ShardRouter:
+    """
+    Picks the stream a task is enqueued to. Tasks are partitioned by task id over the live shards, and go to the shared
+    stream when no dispatcher runs as a shard
+    """
+
+    REFRESH_INTERVAL = 1  # (in seconds)
+
+    def __init__(self, store: AsyncStore):
+        self.store = store
+        self.ring = HashRing(())
+        self.refreshed = 0
+
+    async def refresh(self):
+        if time.monotonic() - self.refreshed < self.REFRESH_INTERVAL:
+            return
+
+        # The ring keeps its shards sorted, the store may not
+        shards = sorted(await self.store.live_shards())
+        if shards != self.ring.shards:
+            self.ring = HashRing(shards)
+        self.refreshed = time.monotonic()
+
+    async def stream_for(self, key: str) -> str:
+        await self.refresh()
+
+        shard = self.ring.shard_for(key)
+        return Store.shard_stream(shard) if shard is not None else Store.STREAM
+
+    async def partition(self, tasks: List) -> Dict[str, List]:
+        partitions = defaultdict(list)
+        for task in tasks:
+            partitions[await self.stream_for(task.task_id)].append(task)
+
+        return partitions
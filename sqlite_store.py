@@ -0,0 +1,337 @@
+import json
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from store import Store, decode_fields, decode_record, encode_record, entry_id
+from utils import deserialize, serialize
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS records (key TEXT, field TEXT, value TEXT, PRIMARY KEY (key, field)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, stream TEXT, message TEXT, enqueued REAL, consumer TEXT, delivered REAL
+);
+CREATE INDEX IF NOT EXISTS entries_by_stream ON entries (stream, consumer, id);
+CREATE TABLE IF NOT EXISTS expiring (key TEXT PRIMARY KEY, value TEXT, expiry REAL);
+CREATE TABLE IF NOT EXISTS shards (shard TEXT PRIMARY KEY, heartbeat REAL);
+CREATE TABLE IF NOT EXISTS costs (function_id TEXT PRIMARY KEY, cost REAL);
+CREATE TABLE IF NOT EXISTS completions (id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT, published REAL);
+'''
+
+
+class SQLiteStore(Store):
+    """
+    Store in a SQLite file, shared by the processes of a single machine without a server in between. Dispatchers
+    and the completion listener poll the file, as SQLite cannot wake up other processes
+    """
+
+    POLL_INTERVAL = 0.005  # (in seconds)
+
+    # Completions are read by polling, they are kept long enough for every listener to see them
+    COMPLETION_RETENTION = 60  # (in seconds)
+    PRUNE_EVERY = 1000
+    RETRY_DELAY = 1  # (in seconds)
+
+    def __init__(self, path: str):
+        self.path = path
+
+        # Connections cannot be shared between threads
+        self.local = threading.local()
+
+        self.subscribers = []
+        self.listener = None
+        self.notifications = 0
+
+        self.connection.executescript(SCHEMA)
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            # Transactions are started explicitly, see transaction()
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+
+        return connection
+
+    @contextmanager
+    def transaction(self):
+        # Takes the write lock right away, so two transactions never deadlock upgrading from a read
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        else:
+            connection.execute('COMMIT')
+
+    @staticmethod
+    def write(connection: sqlite3.Connection, key: str, value: dict):
+        connection.executemany(
+            'INSERT OR REPLACE INTO records (key, field, value) VALUES (?, ?, ?)',
+            [(key, field, field_value) for field, field_value in encode_record(value).items()]
+        )
+
+    def insert(self, key: str, value: dict):
+        with self.transaction() as connection:
+            self.write(connection, key, value)
+
+    def insert_many(self, records: Dict[str, dict]):
+        with self.transaction() as connection:
+            for key, value in records.items():
+                self.write(connection, key, value)
+
+    def read(self, key: str) -> Optional[dict]:
+        rows = self.connection.execute('SELECT field, value FROM records WHERE key = ?', (key, )).fetchall()
+        return decode_record(dict(rows)) or None
+
+    def read_fields(self, key: str, fields: Iterable[str]) -> Optional[dict]:
+        return self.read_fields_many([key], fields)[0]
+
+    def read_fields_many(self, keys: List[str], fields: Iterable[str]) -> List[Optional[dict]]:
+        fields = list(fields)
+        if not keys:
+            return []
+
+        placeholders = ', '.join('?' * len(keys))
+        rows = self.connection.execute(
+            f'SELECT key, field, value FROM records WHERE key IN ({placeholders})', keys
+        ).fetchall()
+
+        records = {key: {} for key in keys}
+        for key, field, value in rows:
+            records[key][field] = value
+
+        return [decode_fields(fields, [records[key].get(field) for field in fields]) for key in keys]
+
+    def increment(self, key: str, field: str, amount: int = 1) -> int:
+        with self.transaction() as connection:
+            row = connection.execute('SELECT value FROM records WHERE key = ? AND field = ?', (key, field)).fetchone()
+            value = (json.loads(row[0]) if row else 0) + amount
+            self.write(connection, key, {field: value})
+
+        return value
+
+    def update_and_notify(self, key: str, value: dict, fields: Iterable[str] = None):
+        if fields is not None:
+            value = {field: value[field] for field in fields}
+
+        with self.transaction() as connection:
+            self.write(connection, key, value)
+            connection.execute('INSERT INTO completions (key, published) VALUES (?, ?)', (key, time.time()))
+
+            self.notifications += 1
+            if self.notifications % self.PRUNE_EVERY == 0:
+                connection.execute(
+                    'DELETE FROM completions WHERE published < ?', (time.time() - self.COMPLETION_RETENTION, )
+                )
+
+    def subscribe(self, callback: Callable[[str], None]) -> Callable[[], None]:
+        self.subscribers.append(callback)
+
+        # One thread polls the completions for every subscriber of this process. It starts from the last completion
+        # before subscribe returns, so none published right after it is missed
+        if self.listener is None:
+            last_id = self.connection.execute('SELECT COALESCE(MAX(id), 0) FROM completions').fetchone()[0]
+            self.listener = threading.Thread(target=self.listen, args=(last_id, ), daemon=True)
+            self.listener.start()
+
+        return lambda: self.subscribers.remove(callback)
+
+    def listen(self, last_id: int):
+        while True:
+            try:
+                rows = self.connection.execute(
+                    'SELECT id, key FROM completions WHERE id > ? ORDER BY id', (last_id, )
+                ).fetchall()
+            except sqlite3.Error as exc:
+                # The listener serves every subscriber of the process, it must outlive a locked or unavailable file
+                print(f'Completion listener failed: {exc}')
+                time.sleep(self.RETRY_DELAY)
+                continue
+
+            for last_id, key in rows:
+                for callback in list(self.subscribers):
+                    try:
+                        callback(key)
+                    except Exception as exc:
+                        print(f'Completion callback failed: {exc}')
+
+            if not rows:
+                time.sleep(self.POLL_INTERVAL)
+
+    def create_group(self, stream: str = Store.STREAM):
+        pass
+
+    def enqueue(self, message: Any, stream: str = Store.STREAM):
+        self.enqueue_many([message], stream)
+
+    def enqueue_many(self, messages: Iterable[Any], stream: str = Store.STREAM):
+        now = time.time()
+        rows = [(stream, message if type(message) == str else serialize(message), now) for message in messages]
+
+        with self.transaction() as connection:
+            connection.executemany('INSERT INTO entries (stream, message, enqueued) VALUES (?, ?, ?)', rows)
+
+    @staticmethod
+    def parse_entries(rows) -> List[Tuple[str, str, Any]]:
+        return [
+            (stream, entry_id(enqueued, row_id), deserialize(message)) for row_id, stream, message, enqueued in rows
+        ]
+
+    @staticmethod
+    def row_id(entry: str) -> int:
+        return int(entry.split('-')[1])
+
+    def dequeue(self, consumer: str, streams: Iterable[str] = (Store.STREAM, ), count: int = Store.READ_COUNT,
+                block: int = Store.READ_BLOCK_TIME) -> List[Tuple[str, str, Any]]:
+        streams = list(streams)
+        placeholders = ', '.join('?' * len(streams))
+        deadline = time.monotonic() + block / 1000
+
+        waiting = f'SELECT 1 FROM entries WHERE stream IN ({placeholders}) AND consumer IS NULL LIMIT 1'
+
+        while True:
+            # Looked up without the write lock first, polling an empty stream must not hold up the writers
+            if self.connection.execute(waiting, streams).fetchone() is None:
+                if time.monotonic() >= deadline:
+                    return []
+
+                time.sleep(self.POLL_INTERVAL)
+                continue
+
+            with self.transaction() as connection:
+                rows = connection.execute(
+                    f'SELECT id, stream, message, enqueued FROM entries '
+                    f'WHERE stream IN ({placeholders}) AND consumer IS NULL ORDER BY id LIMIT ?', streams + [count]
+                ).fetchall()
+
+                connection.executemany(
+                    'UPDATE entries SET consumer = ?, delivered = ? WHERE id = ?',
+                    [(consumer, time.time(), row[0]) for row in rows]
+                )
+
+            if rows:
+                return self.parse_entries(rows)
+
+    def acknowledge(self, *entry_ids: str, stream: str = Store.STREAM):
+        if not entry_ids:
+            return
+
+        with self.transaction() as connection:
+            connection.executemany('DELETE FROM entries WHERE id = ?', [(self.row_id(entry), ) for entry in entry_ids])
+
+    def reclaim(self, consumer: str, stream: str = Store.STREAM, min_idle_time: int = Store.RECLAIM_IDLE_TIME,
+                count: int = Store.READ_COUNT) -> List[Tuple[str, str, Any]]:
+        with self.transaction() as connection:
+            rows = connection.execute(
+                'SELECT id, stream, message, enqueued FROM entries '
+                'WHERE stream = ? AND consumer IS NOT NULL AND delivered <= ? ORDER BY id LIMIT ?',
+                (stream, time.time() - min_idle_time / 1000, count)
+            ).fetchall()
+
+            connection.executemany(
+                'UPDATE entries SET consumer = ?, delivered = ? WHERE id = ?',
+                [(consumer, time.time(), row[0]) for row in rows]
+            )
+
+        return self.parse_entries(rows)
+
+    def touch(self, consumer: str, *entry_ids: str, stream: str = Store.STREAM):
+        if not entry_ids:
+            return
+
+        with self.transaction() as connection:
+            connection.executemany(
+                'UPDATE entries SET delivered = ? WHERE id = ? AND consumer = ?',
+                [(time.time(), self.row_id(entry), consumer) for entry in entry_ids]
+            )
+
+    def stream_length(self, stream: str) -> int:
+        return self.connection.execute('SELECT COUNT(*) FROM entries WHERE stream = ?', (stream, )).fetchone()[0]
+
+    def heartbeat(self, shard: str):
+        with self.transaction() as connection:
+            connection.execute('INSERT OR REPLACE INTO shards (shard, heartbeat) VALUES (?, ?)', (shard, time.time()))
+
+    def live_shards(self, timeout: float = Store.SHARD_TIMEOUT) -> List[str]:
+        rows = self.connection.execute(
+            'SELECT shard FROM shards WHERE heartbeat >= ? ORDER BY shard', (time.time() - timeout, )
+        ).fetchall()
+        return [shard for shard, in rows]
+
+    def dead_shards(self, timeout: float = Store.SHARD_TIMEOUT) -> List[str]:
+        rows = self.connection.execute(
+            'SELECT shard FROM shards WHERE heartbeat < ? ORDER BY shard', (time.time() - timeout, )
+        ).fetchall()
+        return [shard for shard, in rows]
+
+    def remove_shard(self, shard: str):
+        with self.transaction() as connection:
+            connection.execute('DELETE FROM shards WHERE shard = ?', (shard, ))
+
+    def take_over(self, shard: str, owner: str, timeout: float = Store.SHARD_TIMEOUT) -> bool:
+        key = f'{self.TAKEOVER}:{shard}'
+
+        with self.transaction() as connection:
+            row = connection.execute(
+                'SELECT value FROM expiring WHERE key = ? AND expiry > ?', (key, time.time())
+            ).fetchone()
+            if row is not None and row[0] != owner:
+                return False
+
+            self.set_expiring(connection, key, owner, timeout)
+            return True
+
+    @staticmethod
+    def set_expiring(connection: sqlite3.Connection, key: str, value: str, ttl: float):
+        connection.execute(
+            'INSERT OR REPLACE INTO expiring (key, value, expiry) VALUES (?, ?, ?)', (key, value, time.time() + ttl)
+        )
+
+    def read_expiring(self, prefix: str) -> Dict[str, str]:
+        rows = self.connection.execute(
+            'SELECT key, value FROM expiring WHERE key LIKE ? AND expiry > ?', (f'{prefix}%', time.time())
+        ).fetchall()
+        return dict(rows)
+
+    def set_capacity(self, consumer: str, processes: int, ttl: int = Store.CAPACITY_TTL):
+        with self.transaction() as connection:
+            self.set_expiring(connection, f'{self.CAPACITY}:{consumer}', str(processes), ttl)
+
+    def total_capacity(self) -> int:
+        return sum(int(processes) for processes in self.read_expiring(f'{self.CAPACITY}:').values())
+
+    def publish_metrics(self, component: str, instance: str, snapshot: dict, ttl: int = Store.METRICS_TTL):
+        with self.transaction() as connection:
+            self.set_expiring(connection, f'{self.METRICS}:{component}:{instance}', json.dumps(snapshot), ttl)
+
+    def read_metrics(self) -> List[Tuple[dict, dict]]:
+        snapshots = []
+        for key, snapshot in self.read_expiring(f'{self.METRICS}:').items():
+            _, component, instance = key.split(':', 2)
+            snapshots.append(({'component': component, 'instance': instance}, json.loads(snapshot)))
+
+        return snapshots
+
+    def observe_cost(self, function_id: str, seconds: float, weight: float = Store.COST_WEIGHT):
+        with self.transaction() as connection:
+            row = connection.execute('SELECT cost FROM costs WHERE function_id = ?', (function_id, )).fetchone()
+            cost = seconds if row is None else weight * seconds + (1 - weight) * row[0]
+            connection.execute('INSERT OR REPLACE INTO costs (function_id, cost) VALUES (?, ?)', (function_id, cost))
+
+    def unit_cost(self, function_id: str) -> Optional[float]:
+        row = self.connection.execute('SELECT cost FROM costs WHERE function_id = ?', (function_id, )).fetchone()
+        return row[0] if row else None
+
+    def close(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
@@ -0,0 +1,381 @@
+import asyncio
+import json
+import os
+from abc import ABC, abstractmethod
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, List, Optional, Tuple
+
+# Backend of the records and task streams, for every process of a deployment: the web service, the dispatchers and the
+# workers. The memory store only lives in one process, so it needs the dispatcher embedded in the web service
+REDIS = 'redis'
+MEMORY = 'memory'
+SQLITE = 'sqlite'
+
+STORE = os.environ.get('FAAS_STORE', REDIS)
+SQLITE_PATH = os.environ.get('FAAS_SQLITE_PATH', 'faas.db')
+
+
+# Task and function records have one JSON-encoded value per field, so a single field (e.g. status) can be read or
+# written without touching the rest of the record
+def encode_record(value: dict) -> dict:
+    return {field: json.dumps(field_value) for field, field_value in value.items()}
+
+
+def decode_record(record: dict) -> dict:
+    return {field: json.loads(field_value) for field, field_value in record.items()}
+
+
+def decode_fields(fields: List[str], values: List[Optional[str]]) -> Optional[dict]:
+    # A record never lacks all of the requested fields, unless it does not exist
+    if all(value is None for value in values):
+        return None
+
+    return {field: json.loads(value) if value is not None else None for field, value in zip(fields, values)}
+
+
+def entry_id(timestamp: float, sequence: int) -> str:
+    # Same layout as the ids of redis streams: the dispatchers read the enqueue time from them
+    return f'{int(timestamp * 1000)}-{sequence}'
+
+
+class Store(ABC):
+    """
+    Records (tasks, functions, map jobs) and the task streams the dispatchers read from, with the bookkeeping of the
+    dispatchers around them: shards, capacity, metrics and the cost of mapped functions
+    """
+
+    STREAM = 'tasks'
+    GROUP = 'dispatchers'
+    FIELD = 'task'
+    COMPLETIONS = 'completions'
+
+    # Registry of dispatcher shards, and the claims on the streams of dead ones
+    SHARDS = 'shards'
+    TAKEOVER = 'takeover'
+    SHARD_TIMEOUT = 10  # (in seconds)
+
+    READ_COUNT = 64
+    READ_BLOCK_TIME = 5000  # (in milliseconds)
+    RECLAIM_IDLE_TIME = 60000  # (in milliseconds)
+
+    # Worker processes behind each dispatcher, and the time per item of mapped functions, used to size map chunks
+    CAPACITY = 'capacity'
+    CAPACITY_TTL = 15  # (in seconds)
+    COSTS = 'costs'
+    COST_WEIGHT = 0.3
+
+    # Metric snapshots of the dispatchers and workers, rendered by the web service
+    METRICS = 'metrics'
+    METRICS_TTL = 30  # (in seconds)
+
+    # Whether calls wait on I/O, and must be kept off the event loop of the web service
+    BLOCKING = True
+
+    @staticmethod
+    def shard_stream(shard: str) -> str:
+        return f'{Store.STREAM}:{shard}'
+
+    @abstractmethod
+    def insert(self, key: str, value: dict):
+        pass
+
+    @abstractmethod
+    def insert_many(self, records: Dict[str, dict]):
+        pass
+
+    @abstractmethod
+    def read(self, key: str) -> Optional[dict]:
+        pass
+
+    @abstractmethod
+    def read_fields(self, key: str, fields: Iterable[str]) -> Optional[dict]:
+        pass
+
+    @abstractmethod
+    def read_fields_many(self, keys: List[str], fields: Iterable[str]) -> List[Optional[dict]]:
+        pass
+
+    def update(self, key: str, value: dict, fields: Iterable[str] = None):
+        # Only the given fields are written, the rest of the record is left as it is
+        if fields is not None:
+            value = {field: value[field] for field in fields}
+
+        self.insert(key, value)
+
+    @abstractmethod
+    def increment(self, key: str, field: str, amount: int = 1) -> int:
+        pass
+
+    @abstractmethod
+    def update_and_notify(self, key: str, value: dict, fields: Iterable[str] = None):
+        """
+        Updates a record and wakes up the listeners (long-polls, streams) waiting on it, once the record is final
+        :param key: Task id
+        :param value: Record
+        :param fields: Fields to write, all of them if None
+        :return:
+        """
+        pass
+
+    @abstractmethod
+    def subscribe(self, callback: Callable[[str], None]) -> Callable[[], None]:
+        """
+        Calls back with the key of every record updated through update_and_notify, from a thread of the store
+        :param callback: Must not block
+        :return: Function that cancels the subscription
+        """
+        pass
+
+    @abstractmethod
+    def create_group(self, stream: str = STREAM):
+        pass
+
+    @abstractmethod
+    def enqueue(self, message: Any, stream: str = STREAM):
+        pass
+
+    @abstractmethod
+    def enqueue_many(self, messages: Iterable[Any], stream: str = STREAM):
+        pass
+
+    @abstractmethod
+    def dequeue(self, consumer: str, streams: Iterable[str] = (STREAM, ), count: int = READ_COUNT,
+                block: int = READ_BLOCK_TIME) -> List[Tuple[str, str, Any]]:
+        """
+        Delivers entries no consumer has been given yet. They stay pending until acknowledged
+        :param consumer: Dispatcher
+        :param streams: Streams to read from
+        :param count: Maximum number of entries
+        :param block: Time to wait for entries (in milliseconds)
+        :return: (stream, entry id, message) of every entry
+        """
+        pass
+
+    @abstractmethod
+    def acknowledge(self, *entry_ids: str, stream: str = STREAM):
+        pass
+
+    @abstractmethod
+    def reclaim(self, consumer: str, stream: str = STREAM, min_idle_time: int = RECLAIM_IDLE_TIME,
+                count: int = READ_COUNT) -> List[Tuple[str, str, Any]]:
+        """
+        Takes over entries delivered to a consumer (dispatcher) that has not acknowledged them for too long
+        """
+        pass
+
+    @abstractmethod
+    def touch(self, consumer: str, *entry_ids: str, stream: str = STREAM):
+        """
+        Resets the idle time of entries a live consumer is still working on, so they are not reclaimed from it
+        """
+        pass
+
+    @abstractmethod
+    def stream_length(self, stream: str) -> int:
+        pass
+
+    @abstractmethod
+    def heartbeat(self, shard: str):
+        pass
+
+    @abstractmethod
+    def live_shards(self, timeout: float = SHARD_TIMEOUT) -> List[str]:
+        """
+        :return: Shards that sent a heartbeat within the timeout, sorted by name
+        """
+        pass
+
+    @abstractmethod
+    def dead_shards(self, timeout: float = SHARD_TIMEOUT) -> List[str]:
+        pass
+
+    @abstractmethod
+    def remove_shard(self, shard: str):
+        pass
+
+    @abstractmethod
+    def take_over(self, shard: str, owner: str, timeout: float = SHARD_TIMEOUT) -> bool:
+        """
+        Claims the stream of a dead shard, so that a single live shard drains it. The claim expires unless it is renewed
+        :param shard: Dead shard
+        :param owner: Shard taking it over
+        :param timeout: Lifetime of the claim (in seconds)
+        :return: Whether the owner holds the claim
+        """
+        pass
+
+    @abstractmethod
+    def set_capacity(self, consumer: str, processes: int, ttl: int = CAPACITY_TTL):
+        pass
+
+    @abstractmethod
+    def total_capacity(self) -> int:
+        pass
+
+    @abstractmethod
+    def publish_metrics(self, component: str, instance: str, snapshot: dict, ttl: int = METRICS_TTL):
+        pass
+
+    @abstractmethod
+    def read_metrics(self) -> List[Tuple[dict, dict]]:
+        pass
+
+    @abstractmethod
+    def observe_cost(self, function_id: str, seconds: float, weight: float = COST_WEIGHT):
+        pass
+
+    @abstractmethod
+    def unit_cost(self, function_id: str) -> Optional[float]:
+        pass
+
+    def close(self):
+        pass
+
+
+class AsyncStore(ABC):
+    """
+    The part of the store the web service uses, without blocking its event loop
+    """
+
+    @abstractmethod
+    async def insert(self, key: str, value: dict):
+        pass
+
+    @abstractmethod
+    async def insert_many(self, records: Dict[str, dict]):
+        pass
+
+    @abstractmethod
+    async def read(self, key: str) -> Optional[dict]:
+        pass
+
+    @abstractmethod
+    async def read_fields(self, key: str, fields: Iterable[str]) -> Optional[dict]:
+        pass
+
+    @abstractmethod
+    async def read_fields_many(self, keys: List[str], fields: Iterable[str]) -> List[Optional[dict]]:
+        pass
+
+    @abstractmethod
+    def completions(self) -> AsyncIterator[str]:
+        """
+        Yields the key of every record updated through update_and_notify
+        """
+        pass
+
+    @abstractmethod
+    async def enqueue(self, message: Any, stream: str = Store.STREAM):
+        pass
+
+    @abstractmethod
+    async def enqueue_many(self, messages: Iterable[Any], stream: str = Store.STREAM):
+        pass
+
+    @abstractmethod
+    async def live_shards(self, timeout: float = Store.SHARD_TIMEOUT) -> List[str]:
+        pass
+
+    @abstractmethod
+    async def total_capacity(self) -> int:
+        pass
+
+    @abstractmethod
+    async def read_metrics(self) -> List[Tuple[dict, dict]]:
+        pass
+
+    @abstractmethod
+    async def unit_cost(self, function_id: str) -> Optional[float]:
+        pass
+
+    @abstractmethod
+    async def close(self):
+        pass
+
+
+class AsyncAdapter(AsyncStore):
+    """
+    AsyncStore over a synchronous store. Calls that wait on I/O run in the default executor, the others (the memory
+    store) are made right away
+    """
+
+    def __init__(self, store: Store):
+        self.store = store
+
+    async def call(self, method: Callable, *args, **kwargs):
+        if not self.store.BLOCKING:
+            return method(*args, **kwargs)
+
+        return await asyncio.get_running_loop().run_in_executor(None, lambda: method(*args, **kwargs))
+
+    async def insert(self, key: str, value: dict):
+        await self.call(self.store.insert, key, value)
+
+    async def insert_many(self, records: Dict[str, dict]):
+        await self.call(self.store.insert_many, records)
+
+    async def read(self, key: str) -> Optional[dict]:
+        return await self.call(self.store.read, key)
+
+    async def read_fields(self, key: str, fields: Iterable[str]) -> Optional[dict]:
+        return await self.call(self.store.read_fields, key, list(fields))
+
+    async def read_fields_many(self, keys: List[str], fields: Iterable[str]) -> List[Optional[dict]]:
+        return await self.call(self.store.read_fields_many, keys, list(fields))
+
+    async def completions(self) -> AsyncIterator[str]:
+        loop = asyncio.get_running_loop()
+        keys = asyncio.Queue()
+
+        # The store calls back from its own threads, the keys are handed over to the event loop
+        unsubscribe = self.store.subscribe(lambda key: loop.call_soon_threadsafe(keys.put_nowait, key))
+        try:
+            while True:
+                yield await keys.get()
+        finally:
+            unsubscribe()
+
+    async def enqueue(self, message: Any, stream: str = Store.STREAM):
+        await self.call(self.store.enqueue, message, stream)
+
+    async def enqueue_many(self, messages: Iterable[Any], stream: str = Store.STREAM):
+        await self.call(self.store.enqueue_many, list(messages), stream)
+
+    async def live_shards(self, timeout: float = Store.SHARD_TIMEOUT) -> List[str]:
+        return await self.call(self.store.live_shards, timeout)
+
+    async def total_capacity(self) -> int:
+        return await self.call(self.store.total_capacity)
+
+    async def read_metrics(self) -> List[Tuple[dict, dict]]:
+        return await self.call(self.store.read_metrics)
+
+    async def unit_cost(self, function_id: str) -> Optional[float]:
+        return await self.call(self.store.unit_cost, function_id)
+
+    async def close(self):
+        await self.call(self.store.close)
+
+
+def create_store(kind: str = STORE) -> Store:
+    # Backends are imported on demand, so only the client library of the one in use has to be installed
+    if kind == REDIS:
+        from redis_store import Redis
+        return Redis()
+    if kind == MEMORY:
+        from memory_store import MemoryStore
+        return MemoryStore()
+    if kind == SQLITE:
+        from sqlite_store import SQLiteStore
+        return SQLiteStore(SQLITE_PATH)
+
+    raise ValueError(f'Unknown store {kind}, expected one of {REDIS}, {MEMORY} and {SQLITE}')
+
+
+def create_async_store(store: Store, kind: str = STORE) -> AsyncStore:
+    if kind == REDIS:
+        from redis_store import AsyncRedis
+        return AsyncRedis()
+
+    # The other backends share the synchronous store, the memory store has to: it only exists in this process
+    return AsyncAdapter(store)
+
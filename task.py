@@ -1,27 +1,53 @@
+import asyncio
+import inspect
+import time
 import uuid
 
-from redis_store import Redis
-from utils import deserialize, serialize
+from chunking import run_chunk
+from function_cache import function_cache
+from store import create_async_store, create_store
+from utils import content_hash, deserialize, serialize
 
-redis_queue = Redis()
+# Backend selected by FAAS_STORE, Redis by default
+redis_queue = create_store()
+# Only for use inside an event loop (the web service)
+async_redis_queue = create_async_store(redis_queue)
 
 
 class Function:
 
-    def __init__(self, name, payload):
+    class Executor:
+        # Where the tasks of a function run: worker processes for CPU-bound functions, a large pool of threads for
+        # blocking I/O, and an event loop for coroutine functions
+        PROCESS = 'process'
+        THREAD = 'thread'
+        ASYNC = 'async'
+
+        ALL = (PROCESS, THREAD, ASYNC)
+
+    def __init__(self, name, payload, cacheable=False, executor=Executor.PROCESS):
         self.name = name
         self.payload = payload
+        self.cacheable = cacheable
+        self.executor = executor
         self.function_id = str(uuid.uuid4())
+        self.function_hash = content_hash(payload)
 
     def register(self):
         redis_queue.insert(self.function_id, self.db_record)
 
+    async def register_async(self):
+        await async_redis_queue.insert(self.function_id, self.db_record)
+
     @property
     def db_record(self):
         return {
             'name': self.name,
             'function_id': self.function_id,
-            'payload': self.payload
+            'payload': self.payload,
+            'function_hash': self.function_hash,
+            'cacheable': self.cacheable,
+            'executor': self.executor
         }
 
 
@@ -35,18 +61,117 @@ class Task:
         COMPLETED = 'COMPLETED'
         FAILED = 'FAILED'
 
-    def __init__(self, function_id, payload):
+        # Chunks of a map job left unexecuted once the job had its result
+        CANCELLED = 'CANCELLED'
+
+        TERMINAL = (COMPLETED, FAILED, CANCELLED)
+
+    class Priority:
+        HIGH = 'high'
+        NORMAL = 'normal'
+        LOW = 'low'
+
+        # Share of the workers a flow of each priority gets when all of them have tasks waiting
+        WEIGHTS = {HIGH: 8, NORMAL: 4, LOW: 1}
+
+    class Event:
+        # Lifecycle transitions, timestamped on the task as it moves through the web service, a dispatcher and a worker
+        ACCEPTED = 'accepted'
+        ENQUEUED = 'enqueued'
+        DISPATCHED = 'dispatched'
+        STARTED = 'started'
+        FINISHED = 'finished'
+        PERSISTED = 'persisted'
+
+        # Stages of the lifecycle, between two transitions. Accepting is timed by the web service, the other stages
+        # by the dispatcher that persists the task
+        STAGES = {
+            'accept': (ACCEPTED, ENQUEUED),
+            'queue': (ENQUEUED, DISPATCHED),
+            'worker_queue': (DISPATCHED, STARTED),
+            'run': (STARTED, FINISHED),
+            'return': (FINISHED, PERSISTED),
+            'total': (ACCEPTED, PERSISTED)
+        }
+
+    # Tasks queued before timestamps existed have none
+    timestamps = {}
+
+    # Only set on the chunks of a map job, which are recorded with the id of the job
+    job_id = None
+    first_result = False
+
+    # Only set on the tasks of a DAG: the tasks whose results are prepended to the arguments, and the tasks waiting for
+    # this one. The results of the inputs are attached by the dispatcher once they are all available
+    inputs = ()
+    dependents = ()
+    _input_results = ()
+
+    # Tasks of functions registered before execution classes existed run on processes
+    _executor = Function.Executor.PROCESS
+
+    def __init__(self, function_id, payload, function_record: dict = None, priority: str = Priority.NORMAL):
         self.function_id = str(function_id)
         self.payload = payload
         self.task_id = str(uuid.uuid4())
         self.status = self.TaskState.QUEUED
         self.result = ''
+        self.priority = priority
+        self.timestamps = {self.Event.ACCEPTED: time.time()}
+
+        self._function = self.get_function(function_record)
+
+    def get_function(self, record: dict = None):
+        if record is None:
+            record = redis_queue.read(self.function_id)
+
+        self._function_payload = record['payload']
+        # Functions registered before hashes were stored are hashed on the fly
+        self.function_hash = record.get('function_hash') or content_hash(self._function_payload)
+        self._cacheable = record.get('cacheable', False)
+        self._executor = record.get('executor', Function.Executor.PROCESS)
+
+        return function_cache.get(self.function_hash, self._function_payload)
 
-        self.function = self.get_function()
+    @property
+    def function(self):
+        # Resolved on first use, so processes that only route the task never deserialize the function
+        if self._function is None:
+            self._function = self.resolve_function()
+
+        return self._function
+
+    @property
+    def cacheable(self) -> bool:
+        return self._cacheable
+
+    @property
+    def executor(self) -> str:
+        # Chunks of a map job call the function once per item, the chunks of coroutine functions run on threads
+        if self._executor == Function.Executor.ASYNC and self.job_id is not None:
+            return Function.Executor.THREAD
+
+        return self._executor
+
+    def resolve_function(self):
+        if self._function_payload is not None or self.function_hash in function_cache:
+            function = function_cache.get(self.function_hash, self._function_payload)
+            if function is not None:
+                return function
+
+        # Received by reference and not cached in this process yet: fetched from the store once
+        return self.get_function()
 
-    def get_function(self):
-        obj = redis_queue.read(self.function_id)['payload']
-        return deserialize(obj)
+    def reference(self) -> 'Task':
+        """
+        Copy of the task that carries only the function id and content hash instead of the serialized function
+        :return:
+        """
+        reference = object.__new__(Task)
+        reference.__dict__.update(self.__dict__)
+        reference._function_payload = None
+
+        return reference
 
     @classmethod
     def from_dict(cls, record):
@@ -63,35 +188,153 @@ class Task:
 
         return task
 
+    @classmethod
+    def from_payloads(cls, function_id, payloads):
+        # The function record is read once for the whole batch
+        function_record = redis_queue.read(str(function_id))
+        return [cls(function_id, payload, function_record) for payload in payloads]
+
+    @classmethod
+    async def create_async(cls, function_id, payload, priority=Priority.NORMAL):
+        function_record = await async_redis_queue.read(str(function_id))
+        return cls(function_id, payload, function_record, priority)
+
+    @classmethod
+    async def from_payloads_async(cls, function_id, payloads, priority=Priority.NORMAL):
+        function_record = await async_redis_queue.read(str(function_id))
+        return [cls(function_id, payload, function_record, priority) for payload in payloads]
+
+    @staticmethod
+    def insert_many(tasks):
+        redis_queue.insert_many({task.task_id: task.db_record for task in tasks})
+
+    @staticmethod
+    async def insert_many_async(tasks):
+        await async_redis_queue.insert_many({task.task_id: task.db_record for task in tasks})
+
     def insert(self):
         redis_queue.insert(self.task_id, self.db_record)
 
+    async def insert_async(self):
+        await async_redis_queue.insert(self.task_id, self.db_record)
+
+    def stamp(self, event: str):
+        # Copied rather than updated, the default is shared by the class
+        self.timestamps = {**self.timestamps, event: time.time()}
+
+    def durations(self, *stages) -> dict:
+        """
+        Time spent in the given stages of the lifecycle, the ones missing a transition are left out. Transitions are
+        timestamped on different machines, the stages across them are only as accurate as their clocks agree
+        :param stages: Names of Event.STAGES, all of them if none is given
+        :return: Duration (in seconds) per stage
+        """
+        durations = {}
+        for stage in stages or self.Event.STAGES:
+            start, end = self.Event.STAGES[stage]
+            if start in self.timestamps and end in self.timestamps:
+                durations[stage] = self.timestamps[end] - self.timestamps[start]
+
+        return durations
+
     def execute(self):
+        self.stamp(self.Event.STARTED)
+        task = self.execute_chunk() if self.job_id is not None else self.execute_call()
+        task.stamp(self.Event.FINISHED)
+
+        return task
+
+    def arguments(self) -> tuple:
+        inputs = deserialize(self.payload)
+        args = inputs[0]
+        kwargs = inputs[1]
+
+        if self._input_results:
+            args = tuple(deserialize(result) for result in self._input_results) + tuple(args)
+
+        return args, kwargs
+
+    def call(self, *args, **kwargs):
+        # Coroutine functions run to completion on an event loop of their own outside of the async executor
+        result = self.function(*args, **kwargs)
+        return asyncio.run(result) if inspect.iscoroutine(result) else result
+
+    def execute_call(self):
         try:
-            inputs = deserialize(self.payload)
-            args = inputs[0]
-            kwargs = inputs[1]
+            args, kwargs = self.arguments()
+            self.result = self.call(*args, **kwargs)
+            self.status = self.TaskState.COMPLETED
 
-            self.result = self.function(*args, **kwargs)
+        except Exception as exc:
+            self.status = self.TaskState.FAILED
+            self.result = exc
+
+        self.result = serialize(self.result)
+        return self
+
+    async def execute_async(self):
+        """
+        Runs the task on the running event loop. Functions that are not coroutine functions run in its default
+        executor, so they never block the loop
+        :return:
+        """
+        self.stamp(self.Event.STARTED)
+
+        try:
+            args, kwargs = self.arguments()
+            if inspect.iscoroutinefunction(self.function):
+                self.result = await self.function(*args, **kwargs)
+            else:
+                self.result = await asyncio.get_running_loop().run_in_executor(None, lambda: self.call(*args, **kwargs))
             self.status = self.TaskState.COMPLETED
 
         except Exception as exc:
             self.status = self.TaskState.FAILED
             self.result = exc
 
+        self.result = serialize(self.result)
+        self.stamp(self.Event.FINISHED)
+        return self
+
+    def execute_chunk(self):
+        # Time and size of the chunk travel back to the dispatcher, which keeps the cost per item of the function
+        started = time.perf_counter()
+        self.units = 0
+        self.found = False
+
+        try:
+            self.result, self.units, self.found = run_chunk(self.call, deserialize(self.payload), self.first_result)
+            self.status = self.TaskState.COMPLETED
+
+        except Exception as exc:
+            self.status = self.TaskState.FAILED
+            self.result = exc
+
+        self.elapsed = time.perf_counter() - started
         self.result = serialize(self.result)
         return self
 
     def mark_running(self):
         self.status = self.TaskState.RUNNING
-        self.update()
+        self.update('status')
 
     def mark_termination(self, *args, **kwargs):
-        self.update()
+        redis_queue.update_and_notify(self.task_id, self.db_record, ('status', 'result', 'timestamps'))
+
+    def update(self, *fields):
+        # Without fields the whole record is written
+        redis_queue.update(self.task_id, self.db_record, fields or None)
 
-    def update(self):
-        redis_queue.update(self.task_id, self.db_record)
+    def __getstate__(self):
+        # The function travels as its serialized form (or only as its hash, see reference) so the receiving process
+        # can resolve it through its own cache
+        state = self.__dict__.copy()
+        state['_function'] = None
+        return state
 
     @property
     def db_record(self):
-        return {key: value for key, value in self.__dict__.items() if not callable(getattr(self, key))}
+        return {
+            key: value for key, value in self.__dict__.items()
+            if not key.startswith('_') and not callable(getattr(self, key))
+        }
@@ -1,13 +1,26 @@
 import argparse
+import heapq
+import itertools
+import math
 import threading
+import time
+import uuid
 from abc import ABC, abstractmethod
-from collections import defaultdict
-from multiprocessing import Pool, Queue
+from collections import OrderedDict, defaultdict
+from typing import Optional
 
 import zmq
 
+from elastic_pool import Autoscaler, ElasticPool
+from executors import Executors
+from function_cache import function_cache
+from inbox import Inbox
+from metrics import LatencyCounters, Metrics
 from protocol import Message
-from task import Task, redis_queue
+from scheduler import ExecutorScheduler
+from store import Store
+from task import Function, Task, redis_queue
+from utils import serialize
 
 
 class TaskDispatcher(ABC):
@@ -17,60 +30,692 @@ class TaskDispatcher(ABC):
         PUSH = 'push'
         PULL = 'pull'
 
+    class Stage:
+        QUEUE = 'queue'
+        DISPATCH = 'dispatch'
+        EXECUTION = 'execution'
+        PERSIST = 'persist'
+
+    RECLAIM_INTERVAL = 10  # (in seconds)
+    # Entries still in flight are touched well within the idle time after which other dispatchers reclaim them
+    TOUCH_INTERVAL = Store.RECLAIM_IDLE_TIME / 1000 / 3  # (in seconds)
+    HEARTBEAT_INTERVAL = 2  # (in seconds)
+    POLL_TIMEOUT = 1000  # (in milliseconds)
+    STATS_INTERVAL = 60  # (in seconds)
+    CAPACITY_INTERVAL = 5  # (in seconds)
+    METRICS_INTERVAL = 5  # (in seconds)
+    # A job found not cancelled is not looked up in the store again for this long
+    CANCELLATION_TTL = 1  # (in seconds)
+    MAX_JOB_CHECKS = 1024
+
     @property
     @abstractmethod
     def mode(self):
         pass
 
-    def __init__(self, no_of_workers, port=None):
+    def __init__(self, no_of_workers, port=None, shard=None):
         self.no_of_workers = no_of_workers
         self.port = port
-        self.id = 'MASTER'
+        self.shard = shard
+        self.id = str(uuid.uuid4())
+
+        # Name of this dispatcher in the consumer group, several dispatchers can share the task stream
+        self.consumer = f'{self.mode}-{self.id}'
+
+        # A shard reads its own stream on top of the shared one, and the streams of dead shards it has taken over
+        self.streams = [Store.STREAM] + ([Store.shard_stream(shard)] if shard is not None else [])
+        self.adopted = frozenset()
+        for stream in self.streams:
+            redis_queue.create_group(stream)
+
+        # Task id -> (stream, entry id) of the tasks to acknowledge once completed
+        self.entries = {}
+
+        # Everything below is only touched by the event loop thread
+        self.poller = zmq.Poller()
+        self.handlers = {}
+        self.latency = LatencyCounters()
+        self.stage_times = {}
+        self.metrics = Metrics()
+
+        # Options negotiated with each worker at registration (protocol, whether tasks are sent by reference)
+        self.peers = {}
 
+        # Tasks read from the stream by the reader thread
+        self.tasks = Inbox()
+        self.register_handler(self.tasks.fd, self.receive_tasks)
+
+        # Tasks waiting for a worker, handed out by priority and fairly across functions, per execution class
+        self.scheduler = ExecutorScheduler()
+        self.cancelled_jobs = set()
+        self.job_checks = {}
+
+    @property
     @abstractmethod
-    def submit(self, task: Task):
+    def worker_processes(self) -> int:
         pass
 
     @abstractmethod
+    def dispatch_pending(self):
+        """
+        Hands the tasks waiting in the scheduler to the workers that have room for them
+        :return:
+        """
+        pass
+
+    def submit(self, task: Task):
+        self.scheduler.push(task, self.stage_times.get(task.task_id))
+        self.dispatch_pending()
+
+    def register_handler(self, source, handler):
+        self.poller.register(source, zmq.POLLIN)
+        self.handlers[source] = handler
+
+    def read_stream(self):
+        # Spends its time blocked inside XREADGROUP, so it does not compete with the event loop for the GIL
+        last_reclaim = time.monotonic()
+        adopted = frozenset()
+
+        while True:
+            entries = []
+
+            # Entries a dead shard read but never acknowledged are claimed at once, nobody else is working on them
+            for stream in self.adopted - adopted:
+                redis_queue.create_group(stream)
+                entries += redis_queue.reclaim(self.consumer, stream, min_idle_time=0)
+            adopted = self.adopted
+
+            entries += redis_queue.dequeue(self.consumer, self.streams + sorted(adopted))
+
+            if time.monotonic() - last_reclaim > self.RECLAIM_INTERVAL:
+                for stream in self.streams + sorted(adopted):
+                    entries += redis_queue.reclaim(self.consumer, stream)
+                last_reclaim = time.monotonic()
+
+            for entry in entries:
+                self.tasks.put(entry)
+
+    def heartbeat(self):
+        """
+        Keeps the shard in the registry, and takes over the streams of shards that stopped sending heartbeats. A
+        taken-over stream is read until the shard comes back, or until it is drained and the shard is forgotten
+        :return:
+        """
+        while True:
+            redis_queue.heartbeat(self.shard)
+
+            adopted = set()
+            for shard in redis_queue.dead_shards():
+                stream = Store.shard_stream(shard)
+
+                if stream in self.adopted and redis_queue.stream_length(stream) == 0:
+                    redis_queue.remove_shard(shard)
+                    print(f'Drained the stream of shard {shard}')
+                elif redis_queue.take_over(shard, self.shard):
+                    adopted.add(stream)
+
+            for stream in adopted - self.adopted:
+                print(f'Taking over {stream}')
+            self.adopted = frozenset(adopted)
+
+            time.sleep(self.HEARTBEAT_INTERVAL)
+
+    def receive_tasks(self):
+        for stream, entry_id, task in self.tasks.drain():
+            # Long-running tasks of this dispatcher are reclaimed as well, they must not be submitted twice
+            if task.task_id in self.entries:
+                continue
+
+            self.entries[task.task_id] = (stream, entry_id)
+
+            # Stream entry ids start with the millisecond timestamp at which the task was enqueued
+            self.stage_times[task.task_id] = int(entry_id.split('-')[0]) / 1000
+            self.record_stage(task, self.Stage.QUEUE)
+
+            self.scheduler.push(task, self.stage_times[task.task_id])
+
+        # The whole batch is queued before any of it is dispatched, so it is ordered by priority as well
+        self.dispatch_pending()
+
+    def record_stage(self, task: Task, stage):
+        now = time.time()
+        started = self.stage_times.get(task.task_id)
+
+        if started is not None:
+            self.latency.observe(stage, now - started)
+        self.stage_times[task.task_id] = now
+
+    def next_task(self, executors=None) -> Optional[Task]:
+        """
+        Takes the next task out of the scheduler. Chunks of map jobs that already have their result are cancelled on
+        the way instead of being dispatched
+        :param executors: Execution classes the task may belong to, any if None
+        :return: The task, or None once the scheduler has none of them
+        """
+        while True:
+            task = self.scheduler.pop(executors)
+            if task is None:
+                return None
+            if not self.job_cancelled(task):
+                return task
+
+            task.status = Task.TaskState.CANCELLED
+            task.result = serialize(None)
+            task.mark_termination()
+            self.acknowledge(task)
+
+    def job_cancelled(self, task: Task) -> bool:
+        # Only jobs that stop at their first result are ever cancelled
+        if task.job_id is None or not task.first_result:
+            return False
+        if task.job_id in self.cancelled_jobs:
+            return True
+
+        # Jobs can be cancelled by the other dispatchers (shards) as well. The store is asked at most once per TTL, not
+        # for every chunk
+        now = time.monotonic()
+        if now - self.job_checks.get(task.job_id, -math.inf) < self.CANCELLATION_TTL:
+            return False
+
+        if len(self.job_checks) > self.MAX_JOB_CHECKS:
+            self.job_checks = {
+                job_id: checked for job_id, checked in self.job_checks.items() if now - checked < self.CANCELLATION_TTL
+            }
+
+        job = redis_queue.read_fields(task.job_id, ['cancelled'])
+        if job is None or not job['cancelled']:
+            self.job_checks[task.job_id] = now
+            return False
+
+        self.cancelled_jobs.add(task.job_id)
+        return True
+
+    def dispatched(self, task: Task):
+        task.stamp(Task.Event.DISPATCHED)
+        task.mark_running()
+        self.record_stage(task, self.Stage.DISPATCH)
+
+    def complete(self, task: Task, worker: str = None):
+        self.record_stage(task, self.Stage.EXECUTION)
+        task.mark_termination()
+        self.acknowledge(task)
+
+        # Stamped once the result is written, so the stages up to it include the write. The record is final before
+        # the stamp, which follows it in a write of its own
+        task.stamp(Task.Event.PERSISTED)
+        task.update('timestamps')
+
+        self.record_stage(task, self.Stage.PERSIST)
+        self.stage_times.pop(task.task_id, None)
+        self.observe_lifecycle(task)
+
+        if task.job_id is not None:
+            self.complete_chunk(task)
+        if task.dependents:
+            self.release_dependents(task, worker)
+
+    def release_dependents(self, task: Task, worker: str = None):
+        """
+        Submits the DAG tasks whose last input was the given task, straight to this dispatcher. The dispatcher that
+        completes the last input submits the task, so it runs as soon as its inputs are ready. A failed input fails the
+        tasks depending on it, and the tasks depending on those
+        :param task: Terminated task
+        :param worker: Worker that executed it, preferred for the dependent tasks
+        :return:
+        """
+        for task_id in task.dependents:
+            if task.status != Task.TaskState.COMPLETED:
+                self.fail_dependent(task_id, task)
+                continue
+
+            if redis_queue.increment(task_id, 'pending_inputs', -1) > 0:
+                continue
+
+            dependent = Task.from_db(task_id)
+            if dependent.status in Task.TaskState.TERMINAL:
+                # Failed by another of its inputs
+                continue
+
+            dependent._input_results = [
+                task.result if input_id == task.task_id else redis_queue.read_fields(input_id, ['result'])['result']
+                for input_id in dependent.inputs
+            ]
+            dependent._affinity = worker
+            self.submit(dependent)
+
+    def fail_dependent(self, task_id: str, failed_input: Task):
+        dependent = Task.from_db(task_id)
+        if dependent.status in Task.TaskState.TERMINAL:
+            return
+
+        dependent.status = Task.TaskState.FAILED
+        dependent.result = serialize(RuntimeError(f'Input {failed_input.task_id} {failed_input.status.lower()}'))
+        dependent.mark_termination()
+
+        self.release_dependents(dependent)
+
+    def observe_lifecycle(self, task: Task):
+        # Accepting is timed by the web service
+        stages = [stage for stage in Task.Event.STAGES if stage != 'accept']
+        for stage, duration in task.durations(*stages).items():
+            self.metrics.observe('faas_stage_seconds', duration, {'stage': stage})
+
+        self.metrics.inc('faas_tasks_total', {'status': task.status})
+
+    def complete_chunk(self, task: Task):
+        if task.units:
+            redis_queue.observe_cost(task.function_id, task.elapsed / task.units)
+
+        # The first result ends the whole job
+        if task.first_result and task.found and task.job_id not in self.cancelled_jobs:
+            self.cancelled_jobs.add(task.job_id)
+            redis_queue.update(task.job_id, {'cancelled': True})
+
+    def acknowledge(self, task: Task):
+        entry = self.entries.pop(task.task_id, None)
+        if entry is not None:
+            stream, entry_id = entry
+            redis_queue.acknowledge(entry_id, stream=stream)
+        self.stage_times.pop(task.task_id, None)
+
+    def touch_entries(self):
+        """
+        Keeps the entries of the tasks this dispatcher has not completed yet from being reclaimed by other dispatchers
+        while they run: only the entries of a dispatcher that stopped touching them are idle for long enough
+        :return:
+        """
+        by_stream = defaultdict(list)
+        for stream, entry_id in self.entries.values():
+            by_stream[stream].append(entry_id)
+
+        for stream, entry_ids in by_stream.items():
+            redis_queue.touch(self.consumer, *entry_ids, stream=stream)
+
     def execute(self):
+        reader_thread = threading.Thread(target=self.read_stream, daemon=True)
+        reader_thread.start()
+
+        if self.shard is not None:
+            threading.Thread(target=self.heartbeat, daemon=True).start()
+
+        last_stats = time.monotonic()
+        last_capacity = 0
+        last_metrics = 0
+        last_touch = time.monotonic()
+        while True:
+            for source, _ in self.poller.poll(self.POLL_TIMEOUT):
+                self.handlers[source]()
+
+            self.autoscale()
+
+            # Map jobs are chunked for the number of processes behind all dispatchers
+            if time.monotonic() - last_capacity > self.CAPACITY_INTERVAL:
+                redis_queue.set_capacity(self.consumer, self.worker_processes)
+                last_capacity = time.monotonic()
+
+            if time.monotonic() - last_metrics > self.METRICS_INTERVAL:
+                self.publish_metrics()
+                last_metrics = time.monotonic()
+
+            if time.monotonic() - last_touch > self.TOUCH_INTERVAL:
+                self.touch_entries()
+                last_touch = time.monotonic()
+
+            if time.monotonic() - last_stats > self.STATS_INTERVAL:
+                if self.latency.count:
+                    self.print_stats()
+                last_stats = time.monotonic()
+
+    def autoscale(self):
         pass
 
+    def worker_loads(self) -> dict:
+        """
+        :return: Tasks outstanding on each worker
+        """
+        return {}
+
+    def publish_metrics(self):
+        for executor, scheduler_stats in self.scheduler.stats.items():
+            for priority, stats in scheduler_stats.items():
+                self.metrics.set('faas_queue_depth', stats['depth'], {'executor': executor, 'priority': priority})
+        for worker, load in self.worker_loads().items():
+            self.metrics.set('faas_worker_load', load, {'worker': worker})
+        self.metrics.set('faas_worker_processes', self.worker_processes)
+        self.metrics.set('faas_function_cache_hits_total', function_cache.hits)
+        self.metrics.set('faas_function_cache_misses_total', function_cache.misses)
+
+        redis_queue.publish_metrics('dispatcher', self.consumer, self.metrics.snapshot())
+
+    def print_stats(self):
+        print(f'Latency: {self.latency}')
+        print(f'Queues: {self.scheduler}')
+
     def create_message(self, message_type, body: Task = None):
         message = Message(message_type, self.id, body)
         return message
 
+    def registration_ack(self, registration: Message) -> Message:
+        offer = registration.body if isinstance(registration.body, dict) else {}
+        body = {
+            'protocol': Message.Protocol.negotiate(offer.get('protocols')),
+            'by_reference': offer.get('by_reference', False)
+        }
+
+        self.peers[registration.sender] = body
+        return self.create_message(Message.Type.ACK, body)
+
+    def encode(self, message: Message, peer: str, protocol: str = None) -> list:
+        options = self.peers.get(peer, {})
+        protocol = protocol or options.get('protocol', Message.Protocol.STRING)
+
+        return message.to_frames(protocol, options.get('by_reference', False))
+
+    def send(self, worker: str, message: Message):
+        self.socket.send_multipart([str.encode(worker)] + self.encode(message, worker), copy=False)
+
 
 class LocalTaskDispatcher(TaskDispatcher):
 
-    def __init__(self, no_of_workers, port: int = None):
-        super().__init__(no_of_workers, port)
-        self.pool = Pool(self.no_of_workers)
+    def __init__(self, no_of_workers, port: int = None, shard: str = None, max_workers: int = None):
+        super().__init__(no_of_workers, port, shard)
+        self.pool = ElasticPool(no_of_workers, max_workers)
+        self.autoscaler = Autoscaler(self.pool) if self.pool.max_processes > no_of_workers else None
+
+        # Tasks of thread and async functions run on a thread pool and an event loop next to the process pool
+        self.executors = Executors(self.pool)
+
+        # Callbacks run in the result threads of the executors and are handed back to the event loop
+        self.results = Inbox()
+        self.register_handler(self.results.fd, self.receive_results)
+
+        # Executors run their queue in FIFO order, so each is only given as many tasks as it has room for
+        self.running = defaultdict(int)
 
     @property
     def mode(self):
         return self.Mode.LOCAL
 
-    def submit(self, task: Task):
-        task.mark_running()
-        self.pool.apply_async(task.execute, callback=lambda result: result.mark_termination())
+    @property
+    def worker_processes(self):
+        return self.pool.size
 
-    def execute(self):
+    def dispatch_pending(self):
         while True:
-            task = redis_queue.read_channel()
-            if task:
-                self.submit(task)
+            free = [executor for executor in Function.Executor.ALL
+                    if self.running[executor] < self.executors.size(executor)]
+            task = self.next_task(free)
+            if task is None:
+                return
+
+            self.running[task.executor] += 1
+
+            self.dispatched(task)
+            self.executors.apply_async(task, callback=self.results.put)
+
+    def receive_results(self):
+        for task in self.results.drain():
+            self.running[task.executor] -= 1
+            self.complete(task)
+
+        self.dispatch_pending()
+
+    def worker_loads(self):
+        # The executors of the dispatcher are its only worker
+        return {self.consumer: sum(self.running.values())}
+
+    def autoscale(self):
+        if self.autoscaler is None:
+            return
+
+        # Only the tasks waiting for a process say anything about the size of the pool
+        process = Function.Executor.PROCESS
+        size = self.autoscaler.check(self.scheduler.depth(process), self.scheduler.oldest_wait(process))
+        if size is not None and size != self.pool.size:
+            print(f'Resizing the pool from {self.pool.size} to {size} processes')
+            self.no_of_workers = self.pool.resize(size)
+            self.dispatch_pending()
 
 
 class PushWorkerTaskDispatcher(TaskDispatcher):
 
-    def __init__(self, no_of_workers, port):
-        super().__init__(no_of_workers, port)
+    # A worker that has the function of a task warm is preferred over the least loaded one, unless it has more than this
+    # many tasks over it
+    LOCALITY_SLACK = 1
+
+    # A heap of free workers is rebuilt once it holds this many entries per worker
+    COMPACTION_FACTOR = 4
+
+    def __init__(self, no_of_workers, port, shard=None, locality_slack=LOCALITY_SLACK):
+        super().__init__(no_of_workers, port, shard)
         self.socket_type = zmq.ROUTER
         self.socket = self.create_socket()
         self.worker_load = defaultdict(int)
+        self.register_handler(self.socket, self.receive_from_workers)
+
+        # Credit-based flow control: a worker holds at most `capacity` tasks, the rest wait in the scheduler
+        self.capacity = {}
+
+        # Credits per execution class, for the workers that report them. The others take tasks of any class
+        self.executor_capacity = {}
+        self.executor_load = defaultdict(lambda: defaultdict(int))
+
+        # Per execution class, heap of (load, sequence, worker) for workers with a free credit. Entries are not removed
+        # when a load changes, a popped entry whose load is no longer current is simply skipped, and the heap is
+        # compacted before the stale entries outnumber the workers. Only the heaps of the classes with tasks waiting are
+        # kept, the heap of a class is built again from every worker once it has tasks again
+        self.free_workers = {}
+        self.sequence = itertools.count()
+
+        # Function hash -> workers that have it warm, and the other way around
+        self.locality_slack = locality_slack
+        self.warm_workers = defaultdict(set)
+        self.worker_warm = defaultdict(set)
+        self.warm_hits = 0
+        self.cold_starts = 0
+
+        # Work stealing: processes of each worker (tasks over that are queued on the worker, not started) and the
+        # workers asked to give tasks back that have not answered yet. Stolen tasks are kept with the worker they were
+        # taken from until they are dispatched again
+        self.processes = {}
+        self.stealing = set()
+        self.reassigned = {}
+        self.stolen = 0
+
+    def find_least_loaded_worker(self, executor: str) -> Optional[str]:
+        free_workers = self.free_workers.get(executor, [])
+        while free_workers:
+            load, _, worker = heapq.heappop(free_workers)
+            if self.is_free(worker, load, executor):
+                return worker
+
+        return None
+
+    def is_free(self, worker: str, load: int, executor: str) -> bool:
+        # Whether an entry of the heap of free workers is still current
+        if load != self.worker_load.get(worker) or load >= self.capacity[worker]:
+            return False
+
+        return self.has_executor_room(worker, executor)
+
+    def offer_credit(self, worker: str):
+        load = self.worker_load[worker]
+        if load < self.capacity[worker]:
+            for executor in self.free_workers:
+                if self.has_executor_room(worker, executor):
+                    self.push_credit(executor, worker, load)
+
+    def track_credits(self, executors):
+        """
+        Keeps the heaps of free workers of the given execution classes only, so credits of classes that have no tasks
+        are not collected
+        :param executors: Classes with tasks waiting in the scheduler
+        :return:
+        """
+        for executor in set(self.free_workers) - set(executors):
+            del self.free_workers[executor]
+
+        for executor in set(executors) - set(self.free_workers):
+            free_workers = [
+                (self.worker_load[worker], next(self.sequence), worker) for worker in self.capacity
+                if self.is_free(worker, self.worker_load[worker], executor)
+            ]
+            heapq.heapify(free_workers)
+            self.free_workers[executor] = free_workers
+
+    def push_credit(self, executor: str, worker: str, load: int):
+        free_workers = self.free_workers[executor]
+        heapq.heappush(free_workers, (load, next(self.sequence), worker))
+
+        # Under light load the top entry stays current and the stale ones below it are never popped, so the heap is
+        # rebuilt from the current entries (one per worker) before it grows with the number of tasks
+        if len(free_workers) > self.COMPACTION_FACTOR * len(self.capacity):
+            current = {}
+            for load, sequence, worker in sorted(free_workers):
+                if worker not in current and self.is_free(worker, load, executor):
+                    current[worker] = (load, sequence, worker)
+
+            free_workers[:] = current.values()
+            heapq.heapify(free_workers)
+
+    def has_executor_room(self, worker: str, executor: str) -> bool:
+        capacity = self.executor_capacity.get(worker)
+        return capacity is None or self.executor_load[worker][executor] < capacity.get(executor, 0)
+
+    def set_capacity(self, worker: str, body: dict):
+        # Workers that run every class on their processes only report the capacity of those
+        executors = body.get('executors')
+        if executors:
+            self.executor_capacity[worker] = executors
+            self.capacity[worker] = sum(executors.values())
+        else:
+            self.executor_capacity.pop(worker, None)
+            self.capacity[worker] = body.get('capacity', math.inf)
+
+    def assign(self, worker: str, task: Task, count: int = 1):
+        self.worker_load[worker] += count
+        self.executor_load[worker][task.executor] += count
+
+    def prefer_warm_worker(self, task: Task, least_loaded: str) -> str:
+        """
+        Picks the least loaded of the workers that have the function of the task warm, if it is within the slack of the
+        least loaded worker overall
+        :param task: Task to dispatch
+        :param least_loaded: Least loaded worker, its credit was taken
+        :return: Worker to send the task to, or None if the task has to wait for another worker
+        """
+        # A stolen task must not go back to the busy worker it was taken from
+        victim = self.reassigned.pop(task.task_id, None)
+        if victim is not None:
+            return self.avoid_victim(task, victim, least_loaded)
+
+        # DAG tasks follow the worker that produced their last input, it has the function of the chain warm
+        affinity = getattr(task, '_affinity', None)
+        limit = self.worker_load[least_loaded] + self.locality_slack
+        if affinity is not None and self.has_room(affinity, limit, task.executor):
+            if affinity != least_loaded:
+                self.offer_credit(least_loaded)
+            self.warm_hits += 1
+            return affinity
+
+        function_hash = task.function_hash
+        if function_hash in self.worker_warm[least_loaded]:
+            self.warm_hits += 1
+            return least_loaded
+
+        candidates = [
+            worker for worker in self.warm_workers.get(function_hash, ()) if self.has_room(worker, limit, task.executor)
+        ]
+        if not candidates:
+            self.cold_starts += 1
+            return least_loaded
+
+        self.warm_hits += 1
+        self.offer_credit(least_loaded)
+        return min(candidates, key=self.worker_load.get)
+
+    def avoid_victim(self, task: Task, victim: str, least_loaded: str) -> Optional[str]:
+        if least_loaded != victim:
+            return least_loaded
+
+        # The victim got its credit back when the task was returned, the next least loaded worker takes the task
+        other = self.find_least_loaded_worker(task.executor)
+        while other == victim:
+            other = self.find_least_loaded_worker(task.executor)
+        self.offer_credit(victim)
+
+        if other is None:
+            self.reassigned[task.task_id] = victim
+        return other
+
+    def has_room(self, worker: str, limit: int, executor: str) -> bool:
+        if worker not in self.capacity:
+            return False
+
+        load = self.worker_load[worker]
+        return load <= limit and load < self.capacity[worker] and self.has_executor_room(worker, executor)
+
+    def mark_warm(self, worker: str, warm=(), cold=()):
+        for function_hash in warm:
+            self.warm_workers[function_hash].add(worker)
+            self.worker_warm[worker].add(function_hash)
+
+        for function_hash in cold:
+            self.warm_workers[function_hash].discard(worker)
+            self.worker_warm[worker].discard(function_hash)
+
+    def worker_loads(self):
+        return dict(self.worker_load)
 
-    def find_least_loaded_worker(self) -> str:
-        return min(self.worker_load, key=self.worker_load.get)
+    @property
+    def warm_hit_rate(self) -> float:
+        dispatched = self.warm_hits + self.cold_starts
+        return self.warm_hits / dispatched if dispatched else 0.0
+
+    def steal_for(self, thief: str, free: int):
+        """
+        Asks the worker with the most tasks queued (received but not started) to give some back, so they can be
+        reassigned to an idle worker. Tasks are only stolen when nothing is waiting in the scheduler
+        :param thief: Idle worker
+        :param free: Number of idle processes on it
+        :return:
+        """
+        if self.scheduler:
+            return
+
+        # Only tasks waiting for a process are queued, the other classes start as soon as they arrive
+        queued = {
+            worker: self.process_load(worker) - processes for worker, processes in self.processes.items()
+            if worker != thief and worker not in self.stealing
+        }
+        victim = max(queued, key=queued.get, default=None)
+        if victim is None or queued[victim] <= 0:
+            return
+
+        self.stealing.add(victim)
+        self.send(victim, self.create_message(Message.Type.STEAL, {'count': min(free, queued[victim])}))
+
+    def process_load(self, worker: str) -> int:
+        if worker in self.executor_capacity:
+            return self.executor_load[worker][Function.Executor.PROCESS]
+
+        return self.worker_load[worker]
+
+    def reassign(self, victim: str, tasks):
+        self.stealing.discard(victim)
+
+        for task in tasks:
+            self.assign(victim, task, -1)
+            self.reassigned[task.task_id] = victim
+            self.scheduler.push(task, self.stage_times.get(task.task_id))
+
+        self.stolen += len(tasks)
+        self.offer_credit(victim)
+
+    def print_stats(self):
+        super().print_stats()
+        print(f'Locality: warm hit rate={self.warm_hit_rate:.2%} ({self.warm_hits} warm, {self.cold_starts} cold)')
+        print(f'Stolen tasks: {self.stolen}')
 
     def create_socket(self):
         context = zmq.Context()
@@ -84,53 +729,121 @@ class PushWorkerTaskDispatcher(TaskDispatcher):
     def mode(self):
         return self.Mode.PUSH
 
-    def submit(self, task: Task):
-        send_to = self.find_least_loaded_worker()
-        task.mark_running()
-        message = self.create_message(Message.Type.NEW_TASK, task)
-
-        self.worker_load[send_to] += 1
-        self.socket.send_multipart([str.encode(send_to), str.encode(message.compose())])
+    @property
+    def worker_processes(self):
+        return sum(self.processes.values())
+
+    def dispatch_pending(self):
+        # Execution classes take turns, a class whose workers are all busy does not hold up the others
+        dispatching = True
+        while dispatching:
+            dispatching = False
+
+            waiting = self.scheduler.waiting()
+            self.track_credits(waiting)
+            for executor in waiting:
+                send_to = self.find_least_loaded_worker(executor)
+                if send_to is None:
+                    continue
+
+                task = self.next_task([executor])
+                if task is None:
+                    self.offer_credit(send_to)
+                    continue
+
+                send_to = self.prefer_warm_worker(task, send_to)
+                if send_to is None:
+                    # A stolen task that only the worker it came from has room for waits for another worker
+                    self.scheduler.push(task, self.stage_times.get(task.task_id))
+                    continue
+
+                self.dispatched(task)
+                message = self.create_message(Message.Type.NEW_TASK, task)
+
+                # The function is warm there once the task has run, later tasks of the function follow it right away
+                self.mark_warm(send_to, warm=[task.function_hash])
+
+                self.assign(send_to, task)
+                self.offer_credit(send_to)
+                self.send(send_to, message)
+                dispatching = True
 
     def receive_from_workers(self):
         while True:
-            identity, message_body = self.socket.recv_multipart()
-            message = Message.retrieve(message_body.decode())
+            try:
+                identity, *frames = self.socket.recv_multipart(flags=zmq.NOBLOCK, copy=False)
+            except zmq.Again:
+                break
+
+            worker = identity.bytes.decode()
+            message = Message.from_frames(frames)
 
             if message.message_type == Message.Type.REGISTRATION:
-                self.worker_load[identity.decode()] = 0
-                print(f'Registered {identity.decode()}')
+                # Workers that do not advertise a capacity are not limited, as before flow control
+                self.worker_load[worker] = 0
+                self.executor_load.pop(worker, None)
+                self.set_capacity(worker, message.body if isinstance(message.body, dict) else {})
+                capacity = self.executor_capacity.get(worker, self.capacity[worker])
+
+                # Workers that queue tasks locally report how many they run at once, the others cannot be stolen from
+                if isinstance(message.body, dict) and 'processes' in message.body:
+                    self.processes[worker] = message.body['processes']
+                print(f'Registered {worker} (capacity: {capacity})')
+
+                # Workers predating the binary protocol register without a body and do not expect an ACK. The ACK
+                # itself still goes out in the string protocol the worker registered with
+                ack = self.registration_ack(message)
+                if isinstance(message.body, dict):
+                    self.mark_warm(worker, warm=message.body.get('warm', ()))
+                    ack.body['locality'] = True
+                    ack.body['stealing'] = True
+                    self.socket.send_multipart([identity.bytes] + ack.to_frames(), copy=False)
+
+                self.offer_credit(worker)
             elif message.message_type == Message.Type.RESULT_READY:
-                task = message.body
-                task.mark_termination()
-                self.worker_load[identity.decode()] -= 1
+                if isinstance(message.body, dict):
+                    self.mark_warm(worker, message.body.get('warm', ()), message.body.get('cold', ()))
+
+                for task in message.tasks:
+                    self.complete(task, worker)
+                    self.assign(worker, task, -1)
+                self.offer_credit(worker)
+            elif message.message_type == Message.Type.IDLE:
+                self.steal_for(worker, message.body['free'])
+            elif message.message_type == Message.Type.STOLEN:
+                self.reassign(worker, message.tasks)
+            elif message.message_type == Message.Type.CAPACITY:
+                # The worker's pool was resized. Tasks over a reduced capacity are simply not replaced as they finish
+                self.set_capacity(worker, message.body)
+                self.processes[worker] = message.body['processes']
+                print(f'Resized {worker} (capacity: {self.executor_capacity.get(worker, self.capacity[worker])})')
+                self.offer_credit(worker)
             else:
                 raise NotImplementedError
 
-    def get_task(self):
-        while True:
-            task = redis_queue.read_channel()
-            if task:
-                self.submit(task)
-
-    def execute(self):
-        get_task_thread = threading.Thread(target=self.get_task)
-        receive_from_workers_thread = threading.Thread(target=self.receive_from_workers)
-
-        get_task_thread.start()
-        receive_from_workers_thread.start()
-
-        get_task_thread.join()
-        receive_from_workers_thread.join()
+        # Credits returned by the messages above are handed out once the whole batch is read
+        self.dispatch_pending()
 
 
 class PullWorkerTaskDispatcher(TaskDispatcher):
-
-    def __init__(self, no_of_workers, port):
-        super().__init__(no_of_workers, port)
-        self.socket_type = zmq.REP
+    """
+    Serves two kinds of pull workers on one ROUTER socket:
+    - Lockstep workers (REQ sockets) ask for one task at a time and get NO_TASK when the queue is empty
+    - Batched workers (DEALER sockets) ask for up to N tasks at once. The request is parked until tasks arrive, and
+      results come back in batches without an ACK
+    """
+
+    def __init__(self, no_of_workers, port, shard=None):
+        super().__init__(no_of_workers, port, shard)
+        self.socket_type = zmq.ROUTER
         self.socket = self.create_socket()
-        self.queue = Queue()
+        self.register_handler(self.socket, self.respond_to_workers)
+
+        # Batched workers waiting for tasks with the number of tasks they asked for, served in arrival order. Workers
+        # ask for each execution class on its own, (worker, None) asks for tasks of any class
+        self.parked = OrderedDict()
+        self.processes = {}
+        self.worker_load = defaultdict(int)
 
     def create_socket(self):
         context = zmq.Context()
@@ -143,63 +856,115 @@ class PullWorkerTaskDispatcher(TaskDispatcher):
     def mode(self):
         return self.Mode.PULL
 
-    def submit(self, task: Task):
-        message = self.create_message(Message.Type.NEW_TASK, task)
-        self.queue.put((task, message))
+    @property
+    def worker_processes(self):
+        return sum(self.processes.values())
+
+    def worker_loads(self):
+        return dict(self.worker_load)
+
+    def dispatch_pending(self):
+        # Parked requests are served in arrival order, the ones for a class without waiting tasks keep their place
+        for request in list(self.parked):
+            waiting = self.scheduler.waiting()
+            if not waiting:
+                return
+
+            worker, executor = request
+            if executor is not None and executor not in waiting:
+                continue
+
+            executors = [executor] if executor is not None else None
+            count = self.parked.pop(request)
+
+            tasks = []
+            while len(tasks) < count:
+                task = self.next_task(executors)
+                if task is None:
+                    break
+                tasks.append(task)
+
+            if not tasks:
+                # Only cancelled chunks were left, the worker keeps its place
+                self.parked[request] = count
+                self.parked.move_to_end(request, last=False)
+                continue
+
+            for task in tasks:
+                self.dispatched(task)
+            self.worker_load[worker] += len(tasks)
+            self.send(worker, self.create_message(Message.Type.NEW_TASK, tasks))
+
+            if count > len(tasks):
+                self.parked[request] = count - len(tasks)
 
     def respond_to_workers(self):
         while True:
-            message = self.socket.recv_string()
-            request = Message.retrieve(message)
+            try:
+                identity, *frames = self.socket.recv_multipart(flags=zmq.NOBLOCK, copy=False)
+            except zmq.Again:
+                break
 
-            if request.message_type == Message.Type.REGISTRATION:
-                response = self.create_message(Message.Type.ACK)
-                self.socket.send_string(response.compose())
+            # REQ sockets put an empty delimiter in front of the message and wait for exactly one reply
+            lockstep = len(frames[0]) == 0
+            if lockstep:
+                frames = frames[1:]
 
-            elif request.message_type == Message.Type.REQUEST_TASK:
-                if self.queue.empty():
-                    message = self.create_message(Message.Type.NO_TASK)
+            worker = identity.bytes.decode()
+            protocol = Message.protocol_of(frames)
+            request = Message.from_frames(frames)
+            response = None
+
+            if request.message_type == Message.Type.REGISTRATION:
+                response = self.registration_ack(request)
+                if isinstance(request.body, dict):
+                    self.processes[worker] = request.body.get('processes', 1)
+
+            elif request.message_type == Message.Type.REQUEST_TASK and lockstep:
+                task = self.next_task()
+                if task is None:
+                    response = self.create_message(Message.Type.NO_TASK)
                 else:
-                    task, message = self.queue.get(block=False)
-                    task.mark_running()
+                    self.dispatched(task)
+                    self.worker_load[worker] += 1
+                    response = self.create_message(Message.Type.NEW_TASK, task)
 
-                self.socket.send_string(message.compose())
+            elif request.message_type == Message.Type.REQUEST_TASK:
+                parked = (worker, request.body.get('executor'))
+                self.parked[parked] = self.parked.get(parked, 0) + request.body['count']
 
             elif request.message_type == Message.Type.RESULT_READY:
-                task = request.body
-                task.mark_termination()
+                for task in request.tasks:
+                    self.complete(task, worker)
+                    self.worker_load[worker] -= 1
 
-                response = self.create_message(Message.Type.ACK)
-                self.socket.send_string(response.compose())
+                if lockstep:
+                    response = self.create_message(Message.Type.ACK)
 
             else:
                 raise NotImplementedError
 
-    def get_task(self):
-        while True:
-            task = redis_queue.read_channel()
-            if task:
-                self.submit(task)
-
-    def execute(self):
-        get_task_thread = threading.Thread(target=self.get_task)
-        respond_to_workers_thread = threading.Thread(target=self.respond_to_workers)
+            if response is not None:
+                envelope = [identity.bytes, b''] if lockstep else [identity.bytes]
+                self.socket.send_multipart(envelope + self.encode(response, worker, protocol), copy=False)
 
-        get_task_thread.start()
-        respond_to_workers_thread.start()
+        self.dispatch_pending()
 
-        get_task_thread.join()
-        respond_to_workers_thread.join()
 
-
-def initiate_task_dispatcher(mode, no_of_workers, port):
+def initiate_task_dispatcher(mode, no_of_workers, port, shard=None, locality_slack=None, max_workers=None):
     mapping = {
         TaskDispatcher.Mode.LOCAL: LocalTaskDispatcher,
         TaskDispatcher.Mode.PULL: PullWorkerTaskDispatcher,
         TaskDispatcher.Mode.PUSH: PushWorkerTaskDispatcher
     }
 
-    task_dispatcher = mapping[mode](no_of_workers, port)
+    options = {}
+    if mode == TaskDispatcher.Mode.PUSH and locality_slack is not None:
+        options['locality_slack'] = locality_slack
+    if mode == TaskDispatcher.Mode.LOCAL and max_workers is not None:
+        options['max_workers'] = max_workers
+
+    task_dispatcher = mapping[mode](no_of_workers, port, shard, **options)
     task_dispatcher.execute()
 
 
@@ -208,7 +973,15 @@ if __name__ == '__main__':
     parser.add_argument('-mode', type=str, help='Choose among local/pull/push')
     parser.add_argument('-port', type=int, help='The port for the PULL and PUSH mode')
     parser.add_argument('-workers', type=int, help='The number of workers to be spawned in the pool')
+    parser.add_argument('-shard', type=str, default=None,
+                        help='Name of this dispatcher shard, tasks are partitioned over the running shards')
+    parser.add_argument('-slack', type=int, default=None,
+                        help='Extra load accepted on a worker with the function warm (PUSH mode)')
+    parser.add_argument('-max-workers', type=int, default=None,
+                        help='Lets the pool grow up to this many workers with the queue (LOCAL mode)')
 
     arguments = parser.parse_args()
 
-    initiate_task_dispatcher(arguments.mode, arguments.workers, arguments.port)
+    initiate_task_dispatcher(
+        arguments.mode, arguments.workers, arguments.port, arguments.shard, arguments.slack, arguments.max_workers
+    )
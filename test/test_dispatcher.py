@@ -0,0 +1,62 @@
+import itertools
+import uuid
+
+from task import Task
+from task_dispatcher import PushWorkerTaskDispatcher
+
+from .serialize import serialize
+from .utils import double
+
+ports = itertools.count(5590)
+
+
+def create_task():
+    record = {'payload': serialize(double)}
+    return Task(uuid.uuid4(), serialize(((1, ), {})), record)
+
+
+class TestPushDispatcherStealing:
+
+    def setup_method(self):
+        # Every test has its own dispatcher and workers
+        self.dispatcher = PushWorkerTaskDispatcher(1, next(ports))
+
+    def register(self, worker, load):
+        self.dispatcher.set_capacity(worker, {'capacity': 3, 'processes': 1})
+        self.dispatcher.processes[worker] = 1
+
+        for _ in range(load):
+            self.dispatcher.assign(worker, create_task())
+
+    def test_stolen_task_goes_to_another_worker(self):
+        victim, thief = str(uuid.uuid4()), str(uuid.uuid4())
+        self.register(victim, 2)
+        self.register(thief, 2)
+
+        # Once its task is taken back the victim is the least loaded worker, the task goes to the thief anyway
+        self.dispatcher.reassign(victim, [create_task()])
+        self.dispatcher.dispatch_pending()
+
+        assert self.dispatcher.worker_load[victim] == 1
+        assert self.dispatcher.worker_load[thief] == 3
+        assert not self.dispatcher.scheduler
+
+    def test_stolen_task_waits_for_another_worker(self):
+        victim, thief = str(uuid.uuid4()), str(uuid.uuid4())
+        self.register(victim, 2)
+        self.register(thief, 3)
+
+        # Only the victim has room, the task stays in the scheduler
+        self.dispatcher.reassign(victim, [create_task()])
+        self.dispatcher.dispatch_pending()
+
+        assert self.dispatcher.worker_load[victim] == 1
+        assert len(self.dispatcher.scheduler) == 1
+
+        # A result frees a credit on the other worker
+        self.dispatcher.assign(thief, create_task(), -1)
+        self.dispatcher.offer_credit(thief)
+        self.dispatcher.dispatch_pending()
+
+        assert self.dispatcher.worker_load[thief] == 3
+        assert not self.dispatcher.scheduler
@@ -0,0 +1,51 @@
+import uuid
+from collections import Counter
+
+from scheduler import FairScheduler
+from task import Task
+
+from .serialize import serialize
+from .utils import double
+
+
+def create_task(function_id, priority):
+    record = {'payload': serialize(double)}
+    return Task(function_id, serialize(((1, ), {})), record, priority)
+
+
+class TestFairScheduler:
+
+    def test_high_priority_overtakes_backlog(self):
+        scheduler = FairScheduler()
+        function_id = uuid.uuid4()
+
+        for _ in range(10):
+            scheduler.push(create_task(function_id, Task.Priority.LOW))
+        scheduler.push(create_task(function_id, Task.Priority.NORMAL))
+        scheduler.push(create_task(function_id, Task.Priority.HIGH))
+
+        # In FIFO order both would wait behind the whole backlog of low tasks
+        priorities = [scheduler.pop().priority for _ in range(3)]
+        assert priorities[:2] == [Task.Priority.HIGH, Task.Priority.NORMAL]
+
+    def test_priorities_share_by_weight(self):
+        scheduler = FairScheduler()
+        function_id = uuid.uuid4()
+
+        for _ in range(100):
+            for priority in Task.Priority.WEIGHTS:
+                scheduler.push(create_task(function_id, priority))
+
+        served = Counter(scheduler.pop().priority for _ in range(26))
+        assert served == {Task.Priority.HIGH: 16, Task.Priority.NORMAL: 8, Task.Priority.LOW: 2}
+
+    def test_new_flow_skips_backlog(self):
+        scheduler = FairScheduler()
+        busy, idle = uuid.uuid4(), uuid.uuid4()
+
+        for _ in range(10):
+            scheduler.push(create_task(busy, Task.Priority.NORMAL))
+        scheduler.push(create_task(idle, Task.Priority.NORMAL))
+
+        function_ids = [scheduler.pop().function_id for _ in range(2)]
+        assert str(idle) in function_ids
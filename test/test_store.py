@@ -0,0 +1,68 @@
+import threading
+import time
+
+import pytest
+
+from memory_store import MemoryStore
+from sqlite_store import SQLiteStore
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    # Every store must behave the same behind the dispatchers and the web service
+    store = MemoryStore() if request.param == 'memory' else SQLiteStore(str(tmp_path / 'faas.db'))
+    store.create_group()
+    yield store
+    store.close()
+
+
+class TestStore:
+
+    def test_missing_record(self, store):
+        assert store.read_fields('missing', ['status']) is None
+
+    def test_dequeue_in_order(self, store):
+        store.enqueue_many([1, 2, 3])
+
+        entries = store.dequeue('consumer', count=2, block=100)
+        assert [message for _, _, message in entries] == [1, 2]
+
+        # Acknowledged entries are done, the rest is delivered on the next read
+        store.acknowledge(*[entry_id for _, entry_id, _ in entries])
+        assert [message for _, _, message in store.dequeue('consumer', block=100)] == [3]
+
+        # Only the entry left unacknowledged is still pending
+        assert [message for _, _, message in store.reclaim('other', min_idle_time=0)] == [3]
+
+    def test_reclaim_after_idle(self, store):
+        store.enqueue({'task_id': 'task'})
+        [(_, entry_id, _)] = store.dequeue('consumer', block=100)
+
+        assert store.reclaim('other', min_idle_time=100) == []
+        time.sleep(0.2)
+        assert [claimed for _, claimed, _ in store.reclaim('other', min_idle_time=100)] == [entry_id]
+
+    def test_touch_prevents_reclaim(self, store):
+        store.enqueue({'task_id': 'task'})
+        [(_, entry_id, _)] = store.dequeue('consumer', block=100)
+
+        time.sleep(0.2)
+        store.touch('consumer', entry_id)
+        assert store.reclaim('other', min_idle_time=100) == []
+
+    def test_capacity_expires(self, store):
+        store.set_capacity('first', 2, ttl=1)
+        store.set_capacity('second', 3, ttl=10)
+        assert store.total_capacity() == 5
+
+        time.sleep(1.2)
+        assert store.total_capacity() == 3
+
+    def test_subscribe_delivers_completions(self, store):
+        completed = threading.Event()
+        unsubscribe = store.subscribe(lambda key: key == 'task' and completed.set())
+
+        # Published right after subscribing, before the store had a chance to poll
+        store.update_and_notify('task', {'status': 'COMPLETED'})
+        assert completed.wait(5)
+        unsubscribe()
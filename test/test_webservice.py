@@ -1,3 +1,4 @@
+import json
 import logging
 import random
 import time
@@ -6,7 +7,8 @@ import uuid
 import requests
 
 from .serialize import serialize, deserialize
-from .utils import no_op, double, error_function, calculate_fibonacci, bruteforce_password, sleep_for_5s
+from .utils import no_op, double, error_function, calculate_fibonacci, bruteforce_password, sleep_for_5s, timed_sleep, \
+    timed_sleep_async
 
 base_url = 'http://127.0.0.1:8000'
 valid_statuses = ['QUEUED', 'RUNNING', 'COMPLETED', 'FAILED']
@@ -20,20 +22,30 @@ class FAAS:
     class StatusCode:
         register = 201
         execute = 201
+        execute_batch = 201
+        map = 201
+        dag = 201
         status_check = 200
         result = 200
 
     class URLs:
         register = f'{base_url}/register_function'
         execute = f'{base_url}/execute_function'
+        execute_batch = f'{base_url}/execute_batch'
         status_check = f'{base_url}/status/{{task_id}}'
         result = f'{base_url}/result/{{task_id}}'
+        stream = f'{base_url}/results/stream'
+        map = f'{base_url}/map'
+        dag = f'{base_url}/dag'
+        map_status = f'{base_url}/map/{{job_id}}'
+        map_stream = f'{base_url}/map/{{job_id}}/stream'
+        metrics = f'{base_url}/metrics'
 
 
 class Base(FAAS):
 
-    def register(self, function):
-        data = {'name': str(uuid.uuid4()), 'payload': serialize(function)}
+    def register(self, function, cacheable=False, executor='process'):
+        data = {'name': str(uuid.uuid4()), 'payload': serialize(function), 'cacheable': cacheable, 'executor': executor}
         response = requests.post(self.URLs.register, json=data)
 
         assert response.status_code == self.StatusCode.register
@@ -42,8 +54,8 @@ class Base(FAAS):
         function_id = response.json().get('function_id')
         return function_id
 
-    def execute(self, function_id, function_args):
-        data = {'function_id': function_id, 'payload': serialize(function_args)}
+    def execute(self, function_id, function_args, priority='normal'):
+        data = {'function_id': function_id, 'payload': serialize(function_args), 'priority': priority}
         response = requests.post(self.URLs.execute, json=data)
 
         assert response.status_code == self.StatusCode.execute
@@ -52,6 +64,15 @@ class Base(FAAS):
         task_id = response.json().get('task_id')
         return task_id
 
+    def execute_batch(self, function_id, batch_args):
+        data = {'function_id': function_id, 'payloads': [serialize(function_args) for function_args in batch_args]}
+        response = requests.post(self.URLs.execute_batch, json=data)
+
+        assert response.status_code == self.StatusCode.execute_batch
+        assert len(response.json().get('task_ids')) == len(batch_args)
+
+        return response.json().get('task_ids')
+
     def status(self, task_id):
         response = requests.get(self.URLs.status_check.format(task_id=task_id))
         response_data = response.json()
@@ -134,3 +155,246 @@ class TestWebServiceSpectrum(Base):
         task_id = self.execute(function_id, ((), {}))
         result = self.result(task_id)
         assert isinstance(result, NotImplementedError)
+
+
+class TestWebServiceBatch(Base):
+
+    def test_batch_results_in_order(self):
+        function_id = self.register(double)
+        numbers = [random.randint(0, 10000) for _ in range(10)]
+        task_ids = self.execute_batch(function_id, [((number, ), {}) for number in numbers])
+
+        results = [self.result(task_id) for task_id in task_ids]
+        assert results == [number * 2 for number in numbers]
+
+
+class TestWebServiceNotification(Base):
+
+    def test_long_poll(self):
+        function_id = self.register(double)
+        task_id = self.execute(function_id, ((21, ), {}))
+
+        response = requests.get(self.URLs.result.format(task_id=task_id), params={'wait': 10})
+        response_data = response.json()
+
+        assert response.status_code == 200
+        assert response_data['status'] == 'COMPLETED'
+        assert deserialize(response_data['result']) == 42
+
+    def test_stream(self):
+        function_id = self.register(double)
+        task_ids = {self.execute(function_id, ((number, ), {})): number for number in range(5)}
+
+        results = {}
+        response = requests.get(self.URLs.stream, params={'task_ids': list(task_ids)}, stream=True, timeout=30)
+        for line in response.iter_lines(decode_unicode=True):
+            if line.startswith('data: '):
+                response_data = json.loads(line[len('data: '):])
+                results[response_data['task_id']] = deserialize(response_data['result'])
+
+        assert results == {task_id: number * 2 for task_id, number in task_ids.items()}
+
+
+class TestWebServicePriority(Base):
+
+    def test_priorities(self):
+        function_id = self.register(double)
+        task_ids = {self.execute(function_id, ((number, ), {}), priority): number
+                    for number, priority in enumerate(['low', 'normal', 'high'])}
+
+        for task_id, number in task_ids.items():
+            assert self.result(task_id) == number * 2
+
+    def test_unknown_priority(self):
+        function_id = self.register(double)
+        data = {'function_id': function_id, 'payload': serialize(((1, ), {})), 'priority': 'urgent'}
+
+        response = requests.post(self.URLs.execute, json=data)
+        assert response.status_code == 422
+
+
+class TestWebServiceMemoization(Base):
+
+    def test_cached_result(self):
+        function_id = self.register(sleep_for_5s, cacheable=True)
+
+        # Identical calls made while the first one runs share its task
+        task_id = self.execute(function_id, ((), {}))
+        assert self.execute(function_id, ((), {})) == task_id
+
+        response = requests.get(self.URLs.result.format(task_id=task_id), params={'wait': 30})
+        assert response.json()['status'] == 'COMPLETED'
+
+        # Once cached, the call completes without being executed again
+        time.sleep(FAAS.wait_time)
+        cached_task_id = self.execute(function_id, ((), {}))
+        assert cached_task_id != task_id
+
+        response = requests.get(self.URLs.result.format(task_id=cached_task_id))
+        assert response.json()['status'] == 'COMPLETED'
+        assert deserialize(response.json()['result']) is None
+
+
+class TestWebServiceMap(Base):
+
+    def map(self, data):
+        response = requests.post(self.URLs.map, json=data)
+
+        assert response.status_code == self.StatusCode.map
+        return response.json()
+
+    def stream_job(self, job_id):
+        results = {}
+        response = requests.get(self.URLs.map_stream.format(job_id=job_id), stream=True, timeout=30)
+        for line in response.iter_lines(decode_unicode=True):
+            if line.startswith('data: '):
+                response_data = json.loads(line[len('data: '):])
+                results[response_data['task_id']] = (response_data['status'], deserialize(response_data['result']))
+
+        return results
+
+    def test_map_items(self):
+        function_id = self.register(double)
+        numbers = list(range(10))
+        job = self.map({'function_id': function_id, 'payloads': [serialize(((number, ), {})) for number in numbers]})
+
+        results = self.stream_job(job['job_id'])
+        chunks = [results[task_id] for task_id in job['task_ids']]
+
+        assert all(status == 'COMPLETED' for status, _ in chunks)
+        assert [result for _, chunk in chunks for result in chunk] == [number * 2 for number in numbers]
+
+        response = requests.get(self.URLs.map_status.format(job_id=job['job_id']))
+        assert response.json()['status'] == 'COMPLETED'
+        assert response.json()['total'] == len(job['task_ids'])
+
+    def test_map_first_result(self):
+        function_id = self.register(bruteforce_password)
+        data = {
+            'function_id': function_id,
+            'range': {'payload': serialize((('3cab3e11c1104722a842f0095235881f', ), {})), 'start': 0, 'stop': 100000},
+            'chunk_size': 10000,
+            'first_result': True
+        }
+        job = self.map(data)
+        assert len(job['task_ids']) == 10
+
+        results = self.stream_job(job['job_id'])
+        assert ('COMPLETED', 52040) in results.values()
+
+        response = requests.get(self.URLs.map_status.format(job_id=job['job_id']))
+        assert response.json()['cancelled']
+
+    def test_map_requires_one_input(self):
+        function_id = self.register(double)
+
+        response = requests.post(self.URLs.map, json={'function_id': function_id})
+        assert response.status_code == 422
+
+
+class TestWebServiceDag(Base):
+
+    def dag(self, nodes):
+        response = requests.post(self.URLs.dag, json={'nodes': nodes})
+
+        assert response.status_code == self.StatusCode.dag
+        return response.json()['task_ids']
+
+    def test_chain(self):
+        function_id = self.register(double)
+        task_ids = self.dag([
+            {'name': 'first', 'function_id': function_id, 'payload': serialize(((3, ), {}))},
+            {'name': 'second', 'function_id': function_id, 'payload': serialize(((), {})), 'inputs': ['first']},
+            {'name': 'third', 'function_id': function_id, 'payload': serialize(((), {})), 'inputs': ['second']}
+        ])
+
+        assert self.result(task_ids['third']) == 24
+        assert self.result(task_ids['first']) == 6
+
+    def test_failed_input(self):
+        failing_id = self.register(error_function)
+        function_id = self.register(double)
+        task_ids = self.dag([
+            {'name': 'failing', 'function_id': failing_id, 'payload': serialize(((), {}))},
+            {'name': 'dependent', 'function_id': function_id, 'payload': serialize(((), {})), 'inputs': ['failing']}
+        ])
+
+        response = requests.get(self.URLs.result.format(task_id=task_ids['dependent']), params={'wait': 10})
+        assert response.json()['status'] == 'FAILED'
+
+    def test_cycle(self):
+        function_id = self.register(double)
+        nodes = [
+            {'name': 'first', 'function_id': function_id, 'payload': serialize(((), {})), 'inputs': ['second']},
+            {'name': 'second', 'function_id': function_id, 'payload': serialize(((), {})), 'inputs': ['first']}
+        ]
+
+        response = requests.post(self.URLs.dag, json={'nodes': nodes})
+        assert response.status_code == 422
+
+
+class TestWebServiceMetrics(Base):
+
+    def test_stage_latencies(self):
+        function_id = self.register(double)
+        assert self.result(self.execute(function_id, ((2, ), {}))) == 4
+
+        # Dispatchers publish their metrics every few seconds
+        for i in range(100):
+            response = requests.get(self.URLs.metrics)
+            assert response.status_code == 200
+
+            if 'faas_stage_seconds_count{component="dispatcher"' in response.text and 'stage="run"' in response.text:
+                break
+            time.sleep(FAAS.wait_time)
+        else:
+            assert False
+
+        assert 'faas_stage_seconds_count{component="api"' in response.text
+        assert 'faas_stage_quantile_seconds' in response.text
+        assert 'faas_requests_total' in response.text
+        assert '# TYPE faas_function_cache_hits_total counter' in response.text
+        assert 'faas_function_cache_misses_total{component="dispatcher"' in response.text
+
+
+class TestWebServiceExecutors(Base):
+
+    # More tasks than there are processes, they only all sleep at the same time on threads or on an event loop
+    tasks = 32
+
+    def sleep_together(self, function, executor):
+        function_id = self.register(function, executor=executor)
+        task_ids = self.execute_batch(function_id, [((1, ), {})] * self.tasks)
+
+        sleeps = []
+        for task_id in task_ids:
+            response = requests.get(self.URLs.result.format(task_id=task_id), params={'wait': 30})
+            assert response.json()['status'] == 'COMPLETED'
+            sleeps.append(deserialize(response.json()['result']))
+
+        # The last task started before the first one finished
+        assert max(started for started, _ in sleeps) < min(finished for _, finished in sleeps)
+
+    def test_thread_executor(self):
+        self.sleep_together(timed_sleep, 'thread')
+
+    def test_async_executor(self):
+        self.sleep_together(timed_sleep_async, 'async')
+
+    def test_unknown_executor(self):
+        data = {'name': str(uuid.uuid4()), 'payload': serialize(double), 'executor': 'gpu'}
+
+        response = requests.post(self.URLs.register, json=data)
+        assert response.status_code == 422
+
+
+class TestWebServiceLookup(Base):
+
+    def test_unknown_task(self):
+        task_id = str(uuid.uuid4())
+
+        response = requests.get(self.URLs.status_check.format(task_id=task_id))
+        assert response.status_code == 404
+
+        response = requests.get(self.URLs.result.format(task_id=task_id))
+        assert response.status_code == 404
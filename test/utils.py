@@ -1,3 +1,4 @@
+import asyncio
 import hashlib
 import time
 
@@ -35,6 +36,37 @@ def sleep_for_1s():
     time.sleep(1)
 
 
+def sleep_for(seconds: float):
+    """
+    Sleeps for the given number of seconds
+    :param seconds:
+    :return:
+    """
+    time.sleep(seconds)
+
+
+def timed_sleep(seconds: float):
+    """
+    Sleeps for the given number of seconds
+    :param seconds:
+    :return: Start and end of the sleep
+    """
+    started = time.time()
+    time.sleep(seconds)
+    return started, time.time()
+
+
+async def timed_sleep_async(seconds: float):
+    """
+    Sleeps for the given number of seconds without blocking the event loop
+    :param seconds:
+    :return: Start and end of the sleep
+    """
+    started = time.time()
+    await asyncio.sleep(seconds)
+    return started, time.time()
+
+
 def error_function():
     """
 
@@ -1,4 +1,5 @@
 import codecs
+import hashlib
 
 import dill
 
@@ -10,4 +11,8 @@ def serialize(obj):
 
 
 def deserialize(obj):
-    return dill.loads(codecs.decode(obj.encode(), ENCODING))
\ No newline at end of file
+    return dill.loads(codecs.decode(obj.encode(), ENCODING))
+
+
+def content_hash(obj: str) -> str:
+    return hashlib.sha256(obj.encode()).hexdigest()